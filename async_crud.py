@@ -0,0 +1,438 @@
+from datetime import datetime, timezone
+
+from bson.objectid import ObjectId
+from pymongo import DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from fastapi import HTTPException, status
+from database import async_movies_collection, async_users_collection, async_ratings_collection, async_comments_collection, async_leaderboard_collection, async_similar_movies_collection, async_rating_batches_collection
+from schema import MovieCreate, MovieUpdate, UserCreate, UserBase, UserInDb, UserUpdate, CommentCreate, RatingCreate
+from serializer import movie_serializer, user_serializer, comment_serializer, rating_serializer, user_serializer_password, rating_summary_serializer, comment_projection, rating_projection, movie_projection, user_projection, user_password_projection, rating_summary_projection, movie_validator_projection, leaderboard_serializer, leaderboard_projection, movie_detail_serializer, enriched_movie_projection, enriched_movie_serializer
+from crud import STREAM_BATCH_SIZE, touch_movie, rating_aggregate_increments, ratings_aggregate_increments, bulk_results, owned_movie_filter, movie_write_allowed, movie_changes, movie_changed_by, changed_movie_filter, movie_update, raise_for_missed_movie_write, new_movie_document, new_user_document, new_comment_document, new_rating_document
+from pagination import keyset_query, keyset_page
+from search import title_prefix_query, text_search_pipeline
+from movie_detail import movie_detail_pipeline
+from cache import movie_cache, movie_key, movie_first_page_key, MOVIE_FIRST_PAGES
+from cache import principal_cache
+from leaderboards import trending_field
+
+
+# Async (motor) versions of the services in crud.py. The API routes use these so a
+# request waiting on Mongo does not hold one of Starlette's worker threads.
+
+
+async def insert_many_unordered(collection, documents: list) -> dict:
+    """Inserts documents with one unordered insert_many, returns the errors by document index"""
+    try:
+        await collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        return {error["index"]: error["errmsg"] for error in e.details["writeErrors"]}
+    return {}
+
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+# Only the first pages of the movie listing are cached, and only for usual page sizes
+CACHED_FIRST_PAGE_MAX_LIMIT = 100
+
+
+def page_matches(page: dict, validators: list, limit: int) -> bool:
+    """Whether a cached page holds the movies and versions `validators` were read with
+
+    Each worker caches its own pages, so after a write handled by another worker a cached page can
+    be older than the validators the ETag is built from.
+    """
+    cached = [(movie["id"], movie.get("version", 0)) for movie in page["data"]]
+    current = [(str(validator["_id"]), validator.get("version", 0)) for validator in validators[:limit]]
+    return cached == current and (page["next_cursor"] is not None) == (len(validators) > limit)
+
+
+async def invalidate_movie(movie_id: str = None):
+    """Drops a movie and the cached first pages of the listing after a write"""
+    await movie_cache.invalidate(*([movie_key(movie_id)] if movie_id else []), groups=[MOVIE_FIRST_PAGES])
+
+
+class AsyncMovieCRUDservice:
+
+    @staticmethod
+    async def movie_create(movie_data: MovieCreate, user: UserBase):
+        movie_document = new_movie_document(movie_data, user)
+        await async_movies_collection.insert_one(movie_document)
+        await invalidate_movie()
+        return movie_serializer(movie_document)
+
+    @staticmethod
+    async def bulk_create_movies(movies_data: list, user: UserBase):
+        movie_documents = [new_movie_document(movie_data, user) for movie_data in movies_data]
+        write_errors = await insert_many_unordered(async_movies_collection, movie_documents)
+        await invalidate_movie()
+        return bulk_results(movie_documents, write_errors, movie_serializer)
+
+    @staticmethod
+    async def get_all_movies(skip: int = 0, limit: int = 5, enrichments: tuple = ()):
+        movies = async_movies_collection.find({}, enriched_movie_projection(enrichments)).sort("_id", 1).skip(skip).limit(limit)
+        serializer = enriched_movie_serializer(enrichments)
+        return [serializer(movie) async for movie in movies]
+
+    @staticmethod
+    async def get_movies_page(limit: int = 5, cursor: str = None, enrichments: tuple = (), validators: list = None):
+        """Page of the listing, `validators` are those of get_movies_page_validators the response is tagged with"""
+        async def load():
+            movies = async_movies_collection.find(keyset_query({}, cursor), enriched_movie_projection(enrichments)).sort("_id", 1).limit(limit + 1)
+            movies, next_cursor = keyset_page([movie async for movie in movies], limit, enriched_movie_serializer(enrichments))
+            return {"data": movies, "next_cursor": next_cursor}
+
+        if cursor is None and limit <= CACHED_FIRST_PAGE_MAX_LIMIT:
+            key = movie_first_page_key(limit, enrichments)
+            page = await movie_cache.get_or_load(key, load, group=MOVIE_FIRST_PAGES)
+            if validators is not None and not page_matches(page, validators, limit):
+                # Stale copy, reloaded so the body matches its ETag
+                await movie_cache.invalidate(key)
+                page = await movie_cache.get_or_load(key, load, group=MOVIE_FIRST_PAGES)
+        else:
+            page = await load()
+        return page["data"], page["next_cursor"]
+
+    @staticmethod
+    async def get_movies_by_ids(movie_ids: list, enrichments: tuple = ()):
+        movies = {movie["_id"]: movie async for movie in async_movies_collection.find({"_id": {"$in": movie_ids}}, enriched_movie_projection(enrichments))}
+        serializer = enriched_movie_serializer(enrichments)
+        return [serializer(movies[movie_id]) for movie_id in movie_ids if movie_id in movies]
+
+    @staticmethod
+    async def search_movies(q: str, mode: str = "text", limit: int = 20, cursor: str = None, enrichments: tuple = ()):
+        projection = enriched_movie_projection(enrichments)
+        if mode == "prefix":
+            movies = async_movies_collection.find(title_prefix_query(q, cursor), {**projection, "title_key": 1}).sort([("title_key", 1), ("_id", 1)]).limit(limit + 1)
+        else:
+            movies = async_movies_collection.aggregate(text_search_pipeline(q, limit, projection, cursor))
+        return keyset_page([movie async for movie in movies], limit, enriched_movie_serializer(enrichments), key="title_key" if mode == "prefix" else "text_score")
+
+    @staticmethod
+    async def get_movies_by_id(movie_id: str, validator: dict = None):
+        """The movie, `validator` is the get_movie_validators read the response is tagged with"""
+        async def load():
+            movie = await async_movies_collection.find_one({"_id": ObjectId(movie_id)}, movie_projection)
+            if movie:
+                movie["user_id"] = movie.get("user_id", None)
+                return movie_serializer(movie)
+            return None
+
+        key = movie_key(movie_id)
+        movie = await movie_cache.get_or_load(key, load)
+        if validator is not None and movie is not None and (movie.get("version") or 0) != (validator.get("version") or 0):
+            # Stale copy, cached by this worker before a write another worker handled
+            await movie_cache.invalidate(key)
+            movie = await movie_cache.get_or_load(key, load)
+        return movie
+
+    @staticmethod
+    async def get_movie_detail(movie_id: str, fields: tuple, include: tuple, comments_limit: int = 5):
+        movies = await async_movies_collection.aggregate(movie_detail_pipeline(movie_id, fields, include, comments_limit)).to_list(1)
+        if movies:
+            return movie_detail_serializer(movies[0], fields, include, comments_limit)
+        return None
+
+    @staticmethod
+    async def get_similar_movies(movie_id: str, limit: int = 10):
+        # Neighbors precomputed by recommendations.refresh_similar_movies, best first
+        entry = await async_similar_movies_collection.find_one({"_id": movie_id}, {"neighbors": {"$slice": limit}})
+        if entry:
+            return entry["neighbors"]
+        # A movie rated by no one yet has no entry
+        if ObjectId.is_valid(movie_id) and await async_movies_collection.find_one({"_id": ObjectId(movie_id)}, {"_id": 1}):
+            return []
+        return None
+
+    @staticmethod
+    async def get_movie_validators(movie_id: str):
+        """version and updated_at of a movie, enough to answer a conditional GET"""
+        if not ObjectId.is_valid(movie_id):
+            return None
+        return await async_movies_collection.find_one({"_id": ObjectId(movie_id)}, movie_validator_projection)
+
+    @staticmethod
+    async def get_movies_page_validators(limit: int = 5, cursor: str = None, skip: int = None):
+        query = async_movies_collection.find(keyset_query({}, cursor), movie_validator_projection).sort("_id", 1)
+        if skip is not None:
+            return [movie async for movie in query.skip(skip).limit(limit)]
+        return [movie async for movie in query.limit(limit + 1)]
+
+    @staticmethod
+    async def update_movie(movie_id: str, movie_update_in: MovieUpdate, user: UserInDb, version: int = None):
+        # Ownership (and the expected version) is part of the filter, so the check and the write are one atomic command
+        changes = movie_changes(movie_update_in)
+        if changes:
+            movie_updated = await async_movies_collection.find_one_and_update(
+                changed_movie_filter(movie_id, user, version, changes), movie_update(changes),
+                projection=movie_projection, return_document=ReturnDocument.AFTER,
+            )
+            if movie_updated:
+                await invalidate_movie(movie_id)
+                return movie_serializer(movie_updated)
+        # Nothing written: the update changes nothing, or the movie is missing, someone else's or at another version
+        movie = await async_movies_collection.find_one({"_id": ObjectId(movie_id)}, {**movie_projection, **dict.fromkeys(changes, 1)})
+        if not movie:
+            return None
+        if movie_write_allowed(movie, user, version) and not movie_changed_by(movie, changes):
+            return movie_serializer(movie)
+        raise_for_missed_movie_write(movie, user, "update")
+
+    @staticmethod
+    async def delete_movie(movie_id: str, user: UserInDb, version: int = None):
+        movie_deleted = await async_movies_collection.find_one_and_delete(owned_movie_filter(movie_id, user, version), {"_id": 1})
+        if movie_deleted:
+            await async_leaderboard_collection.delete_one({"_id": movie_id})
+            await async_similar_movies_collection.delete_one({"_id": movie_id})
+            await invalidate_movie(movie_id)
+            return True
+        movie = await async_movies_collection.find_one({"_id": ObjectId(movie_id)}, {"user_id": 1})
+        if not movie:
+            return None
+        raise_for_missed_movie_write(movie, user, "delete")
+
+    @staticmethod
+    async def add_comment_to_movie(movie_id: str):
+        # Only a counter is kept on the movie, its comments are found by their indexed movie_id
+        await async_movies_collection.update_one({"_id": ObjectId(movie_id)}, touch_movie({"$inc": {"comment_count": 1}}))
+        await invalidate_movie(movie_id)
+
+    @staticmethod
+    async def add_rating_to_movie(movie_id: str, rating: float):
+        await async_movies_collection.update_one(
+            {"_id": ObjectId(movie_id)},
+            touch_movie({"$inc": rating_aggregate_increments(rating)}),
+        )
+        await invalidate_movie(movie_id)
+
+    @staticmethod
+    async def add_comments_to_movie(movie_id: str, comment_count: int):
+        await async_movies_collection.update_one({"_id": ObjectId(movie_id)}, touch_movie({"$inc": {"comment_count": comment_count}}))
+        await invalidate_movie(movie_id)
+
+    @staticmethod
+    async def add_ratings_to_movie(movie_id: str, ratings: list):
+        await async_movies_collection.update_one(
+            {"_id": ObjectId(movie_id)},
+            touch_movie({"$inc": ratings_aggregate_increments(ratings)}),
+        )
+        await invalidate_movie(movie_id)
+
+    @staticmethod
+    async def get_rating_summary(movie_id: str):
+        if not ObjectId.is_valid(movie_id):
+            return None
+        movie = await async_movies_collection.find_one(
+            {"_id": ObjectId(movie_id)}, rating_summary_projection
+        )
+        if movie:
+            return rating_summary_serializer(movie)
+        return None
+
+    @staticmethod
+    async def get_movie_id(movie_id: str):
+        movie = await async_movies_collection.find_one({"_id": ObjectId(movie_id)}, {"title": 1})
+        return movie.get("title")
+
+async_movie_crud_service = AsyncMovieCRUDservice
+
+
+class AsyncUserCRUDservice:
+
+    @staticmethod
+    async def user_create(user_data: UserCreate, hashed_password: str):
+        # The unique username index rejects duplicates, no need to look the user up first
+        user_document = new_user_document(user_data, hashed_password)
+        try:
+            await async_users_collection.insert_one(user_document)
+        except DuplicateKeyError:
+            raise HTTPException(detail="Username already registered", status_code=status.HTTP_400_BAD_REQUEST)
+        return user_serializer(user_document)
+
+    @staticmethod
+    async def get_all_users(skip: int = 0, limit: int = 5):
+        users = async_users_collection.find({}, user_projection).skip(skip).limit(limit)
+        return [user_serializer(user) async for user in users]
+
+    @staticmethod
+    async def get_user_by_username(username: str) -> UserInDb:
+        user = await async_users_collection.find_one({"username": username}, user_projection)
+        if user:
+            return user_serializer(user)
+        return None
+
+    @staticmethod
+    async def get_user_by_username_with_hash(username: str) -> UserInDb:
+        user = await async_users_collection.find_one({"username": username}, user_password_projection)
+        if user:
+            return user_serializer_password(user)
+        return None
+
+    @staticmethod
+    async def update_user(username: str, user_data: UserUpdate):
+        user = await async_users_collection.find_one({"username": username}, {"_id": 1})
+
+        if not user:
+            return None
+
+        user_update_data = user_data.model_dump(exclude_unset=True)
+        user_updated = await async_users_collection.find_one_and_update(
+            {"username": user_data.username}, {"$set": user_update_data}, projection=user_projection, return_document=True
+        )
+        principal_cache.invalidate_user(username)
+        principal_cache.invalidate_user(user_data.username)
+
+        return user_serializer(user_updated)
+
+    @staticmethod
+    async def update_password_hash(username: str, hashed_password: str):
+        await async_users_collection.update_one({"username": username}, {"$set": {"hashed_password": hashed_password}})
+
+    @staticmethod
+    async def delete_user(username: str):
+        user_deleted = await async_users_collection.find_one_and_delete({"username": username})
+        principal_cache.invalidate_user(username)
+        return user_deleted
+
+async_user_crud_service = AsyncUserCRUDservice
+
+
+class AsyncCommentCRUDservice:
+
+    @staticmethod
+    async def create_comment(comment_data: CommentCreate, user: UserBase, movie_id: str):
+        comment_document = new_comment_document(comment_data, user, movie_id)
+        await async_comments_collection.insert_one(comment_document)
+        await async_movie_crud_service.add_comment_to_movie(movie_id)
+        return comment_serializer(comment_document)
+
+    @staticmethod
+    async def bulk_create_comments(comments_data: list, user: UserBase, movie_id: str):
+        comment_documents = [new_comment_document(comment_data, user, movie_id) for comment_data in comments_data]
+        write_errors = await insert_many_unordered(async_comments_collection, comment_documents)
+        comment_count = len(comment_documents) - len(write_errors)
+        if comment_count:
+            await async_movie_crud_service.add_comments_to_movie(movie_id, comment_count)
+        return bulk_results(comment_documents, write_errors, comment_serializer)
+
+    @staticmethod
+    async def get_comments_by_movie(movie_id: str):
+        comments = async_comments_collection.find({"movie_id": movie_id}, comment_projection)
+        return [comment_serializer(comment) async for comment in comments]
+
+    @staticmethod
+    async def stream_comments_by_movie(movie_id: str):
+        comments = async_comments_collection.find({"movie_id": movie_id}, comment_projection).sort("_id", 1).batch_size(STREAM_BATCH_SIZE)
+        async for comment in comments:
+            yield comment_serializer(comment)
+
+    @staticmethod
+    async def get_comments_page(movie_id: str, limit: int = 20, cursor: str = None):
+        comments = async_comments_collection.find(keyset_query({"movie_id": movie_id}, cursor), comment_projection).sort("_id", 1).limit(limit + 1)
+        return keyset_page([comment async for comment in comments], limit, comment_serializer)
+
+async_comment_crud_service = AsyncCommentCRUDservice
+
+
+class AsyncRatingCRUDservice:
+
+    @staticmethod
+    async def create_rating(rating_data: RatingCreate, user: UserBase, movie_id: str):
+        rating_document = new_rating_document(rating_data, user, movie_id)
+        await async_ratings_collection.insert_one(rating_document)
+        await async_movie_crud_service.add_rating_to_movie(movie_id, rating_document["rating"])
+        return rating_serializer(rating_document)
+
+    @staticmethod
+    async def bulk_create_ratings(ratings_data: list, user: UserBase, movie_id: str):
+        rating_documents = [new_rating_document(rating_data, user, movie_id) for rating_data in ratings_data]
+        write_errors = await insert_many_unordered(async_ratings_collection, rating_documents)
+        inserted = [document for index, document in enumerate(rating_documents) if index not in write_errors]
+        if inserted:
+            # One update applies the aggregates of the whole batch
+            await async_movie_crud_service.add_ratings_to_movie(movie_id, [document["rating"] for document in inserted])
+        return bulk_results(rating_documents, write_errors, rating_serializer)
+
+    @staticmethod
+    async def write_ratings_batch(rating_documents: list, batch_id: ObjectId) -> int:
+        """Writes ratings of any number of movies, returns how many were inserted
+
+        One insert for the ratings, then one bulk write holding a single aggregate update per movie.
+        Calling it again with the same documents and `batch_id` after a failure finishes the write
+        without counting anything twice, whatever other batches were written meanwhile: ratings
+        already inserted are recognized by their _id, and the aggregates by the (batch_id, movie_id)
+        documents of the rating_batches collection, which a TTL index drops after a day.
+
+        The batch id is also pushed on the movie by the aggregate update itself, and pulled once
+        recorded in rating_batches, so a failure between the two cannot count the batch again.
+        """
+        try:
+            await async_ratings_collection.insert_many(rating_documents, ordered=False)
+            rejected = set()
+        except BulkWriteError as e:
+            rejected = {error["index"] for error in e.details["writeErrors"] if error["code"] != DUPLICATE_KEY_ERROR}
+        ratings_by_movie = {}
+        for index, document in enumerate(rating_documents):
+            if index not in rejected:
+                ratings_by_movie.setdefault(document["movie_id"], []).append(document["rating"])
+        if ratings_by_movie:
+            markers = {movie_id: {"batch_id": batch_id, "movie_id": movie_id} for movie_id in ratings_by_movie}
+            applied = {
+                marker["_id"]["movie_id"]
+                async for marker in async_rating_batches_collection.find({"_id": {"$in": list(markers.values())}}, {"_id": 1})
+            }
+            pending = [movie_id for movie_id in ratings_by_movie if movie_id not in applied]
+            if pending:
+                await async_movies_collection.bulk_write([
+                    UpdateOne(
+                        {"_id": ObjectId(movie_id), "rating_batches": {"$ne": batch_id}},
+                        touch_movie({"$inc": ratings_aggregate_increments(ratings_by_movie[movie_id]), "$push": {"rating_batches": batch_id}}),
+                    )
+                    for movie_id in pending
+                ], ordered=False)
+                applied_at = datetime.now(timezone.utc)
+                await async_rating_batches_collection.bulk_write([
+                    UpdateOne({"_id": markers[movie_id]}, {"$setOnInsert": {"applied_at": applied_at}}, upsert=True)
+                    for movie_id in pending
+                ], ordered=False)
+            await async_movies_collection.update_many(
+                {"_id": {"$in": [ObjectId(movie_id) for movie_id in ratings_by_movie]}, "rating_batches": batch_id},
+                {"$pull": {"rating_batches": batch_id}},
+            )
+            await movie_cache.invalidate(*(movie_key(movie_id) for movie_id in ratings_by_movie), groups=[MOVIE_FIRST_PAGES])
+        return len(rating_documents) - len(rejected)
+
+    @staticmethod
+    async def get_ratings_by_movie(movie_id: str, skip: int = 0, limit: int = 20):
+        ratings = async_ratings_collection.find({"movie_id": movie_id}, rating_projection).skip(skip).limit(limit)
+        return [rating_serializer(rating) async for rating in ratings]
+
+    @staticmethod
+    async def stream_ratings_by_movie(movie_id: str):
+        ratings = async_ratings_collection.find({"movie_id": movie_id}, rating_projection).sort("_id", 1).batch_size(STREAM_BATCH_SIZE)
+        async for rating in ratings:
+            yield rating_serializer(rating)
+
+    @staticmethod
+    async def get_ratings_page(movie_id: str, limit: int = 20, cursor: str = None):
+        ratings = async_ratings_collection.find(keyset_query({"movie_id": movie_id}, cursor), rating_projection).sort("_id", 1).limit(limit + 1)
+        return keyset_page([rating async for rating in ratings], limit, rating_serializer)
+
+async_rating_crud_service = AsyncRatingCRUDservice
+
+
+class AsyncLeaderboardCRUDservice:
+
+    @staticmethod
+    async def get_top_movies(limit: int = 20):
+        entries = async_leaderboard_collection.find({"rating_count": {"$gt": 0}}, leaderboard_projection).sort("score", DESCENDING).limit(limit)
+        return [leaderboard_serializer(entry) async for entry in entries]
+
+    @staticmethod
+    async def get_trending_movies(window_days: int, limit: int = 20):
+        field = trending_field(window_days)
+        entries = async_leaderboard_collection.find({field: {"$gt": 0}}, leaderboard_projection).sort(field, DESCENDING).limit(limit)
+        return [leaderboard_serializer(entry) async for entry in entries]
+
+
+async_leaderboard_crud_service = AsyncLeaderboardCRUDservice
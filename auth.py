@@ -1,37 +1,44 @@
-import os
-
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 from jose import JWTError, jwt # type: ignore
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from dotenv import load_dotenv
-from logger import logger
+from logger import get_logger
+
+from repositories import get_repository
+from cache import principal_cache
+import passwords
+from passwords import pwd_context
+from settings import settings
 
-from crud import user_crud_service
 
+logger = get_logger(__name__)
 
 UTC = timezone(offset=timedelta(0))
-load_dotenv()
 
-SECRET_KEY = os.environ.get('SECRET_KEY') 
-ALGORITHM = os.environ.get('ALGORITHM')
-ACCESS_TOKEN_EXPIRE_MINUTES = os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES')
+SECRET_KEY = settings.secret_key
+ALGORITHM = settings.algorithm
+ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 def verify_password(plain_password, hashed_password):
-    logger.info('Password verified Successfully')
     return pwd_context.verify(plain_password, hashed_password)
 
-def authenticate_user(username: str, password: str):
-    user = user_crud_service.get_user_by_username_with_hash(username)
-    if not user or not verify_password(password, user.get('hashed_password')):
-        logger.warning(f'User with {user.username} not authenticated')
+async def authenticate_user(username: str, password: str, users):
+    user = await users.get_user_by_username_with_hash(username)
+    if not user:
+        logger.warning('User %s not authenticated', username)
+        return False
+    # bcrypt runs in the password process pool, off the event loop
+    verified, new_hash = await passwords.verify_password(password, user.get('hashed_password'))
+    if not verified:
+        logger.warning('User %s not authenticated', username)
         return False
-    logger.info('User Successfully authenticated')
+    if new_hash:
+        # Stored hash was made with another bcrypt cost, replace it now that we know the password
+        await users.update_password_hash(username, new_hash)
+    logger.info('User %s authenticated', username)
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -44,7 +51,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(token: str = Depends(oauth2_scheme), repository=Depends(get_repository)):
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
@@ -56,11 +63,17 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         if not username:
             raise credentials_exception
     except JWTError:
-        logger.exception(f'User credentials nor for {get_current_user} ')
+        logger.warning('Invalid access token')
         raise credentials_exception
-    user = user_crud_service.get_user_by_username(username=username)
+    # Resolved users are cached per token, and never longer than the token is valid
+    expires_at = payload.get("exp")
+    user = principal_cache.get((username, expires_at))
+    if user is not None:
+        return user
+    user = await repository.users.get_user_by_username(username=username)
     if user is None:
         raise credentials_exception
-    logger.info('user gotten succesfully')
+    principal_cache.set((username, expires_at), user, ttl=expires_at - datetime.now(UTC).timestamp() if expires_at else None)
+    logger.debug('User %s resolved from the database', username)
     return user
 
@@ -0,0 +1,67 @@
+"""Compares ingestion throughput of the single-item and bulk routes.
+
+Runs against a live server:
+    uvicorn main:app
+    python benchmarks/bench_bulk_ingest.py --base-url http://localhost:8000 --count 2000 --batch-size 500
+"""
+import argparse
+import random
+import string
+import time
+
+import httpx
+
+
+def signup_and_login(client: httpx.Client) -> dict:
+    username = "bench_" + ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+    client.post("/signup", json={"username": username, "full_name": "Bench User", "password": "password"}).raise_for_status()
+    response = client.post("/login", data={"username": username, "password": "password"})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def timed(function) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def report(name: str, count: int, single_seconds: float, bulk_seconds: float):
+    single_rate, bulk_rate = count / single_seconds, count / bulk_seconds
+    print(f"{name:<10} single {single_rate:>10.1f} docs/s   bulk {bulk_rate:>10.1f} docs/s   x{bulk_rate / single_rate:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--count", type=int, default=1000, help="documents written per route")
+    parser.add_argument("--batch-size", type=int, default=500, help="documents per bulk request")
+    args = parser.parse_args()
+
+    with httpx.Client(base_url=args.base_url, timeout=60) as client:
+        headers = signup_and_login(client)
+        movie = {"title": "Bench Movie", "description": "description", "user_id": "bench"}
+        movie_id = client.post("/movies", json=movie, headers=headers).json()["data"]["id"]
+        comment = {"comment": "bench comment", "movie_id": movie_id}
+        rating = {"rating": 4.0, "movie_id": movie_id}
+
+        def single(path, document):
+            return lambda: [client.post(path, json=document, headers=headers).raise_for_status() for _ in range(args.count)]
+
+        def bulk(path, document):
+            def run():
+                for start in range(0, args.count, args.batch_size):
+                    batch = [document] * min(args.batch_size, args.count - start)
+                    client.post(path, json=batch, headers=headers).raise_for_status()
+            return run
+
+        for name, path, document in (
+            ("movies", "/movies", movie),
+            ("comments", f"/movies/{movie_id}/comments", comment),
+            ("ratings", f"/movies/{movie_id}/ratings", rating),
+        ):
+            report(name, args.count, timed(single(path, document)), timed(bulk(f"{path}/bulk", document)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""Load test of every route of main.py, with throughput and latency percentiles per endpoint.
+
+Seeds users, movies, comments and ratings through the API, then sends --requests requests to
+each endpoint from --concurrency concurrent clients. Results are printed and written as JSON,
+and compared with a previous run when --baseline is given:
+
+    python benchmarks/bench_endpoints.py --output benchmarks/baseline.json
+    python benchmarks/bench_endpoints.py --baseline benchmarks/baseline.json --tolerance 0.2
+
+By default the app runs in this process against MONGO_DB_CONNECTION_URL (use a local mongod,
+the benchmark writes to it). --backend memory runs it on the in-memory repository, which
+measures the app layer apart from database latency. --backend mongomock runs the Mongo code on
+mongomock/mongomock_motor, which need to be installed and do not support every query.
+--base-url drives an already running server. Exits with 1 when an endpoint regressed past the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import secrets
+import string
+import sys
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def use_mongomock_backend():
+    """Gives database.py mongomock clients in place of the ones it would connect with"""
+    import mongomock
+    import mongomock_motor
+    from database import mongo
+
+    mongo.client, mongo.async_client = mongomock.MongoClient(), mongomock_motor.AsyncMongoMockClient()
+
+
+@asynccontextmanager
+async def http_client(args):
+    if args.base_url:
+        async with httpx.AsyncClient(base_url=args.base_url, timeout=60) as client:
+            yield client
+        return
+    if args.backend == "memory":
+        # Read by settings.py when main is imported below
+        os.environ["REPOSITORY_BACKEND"] = "memory"
+    elif args.backend == "mongomock":
+        use_mongomock_backend()
+    import main
+
+    async with main.lifespan(main.app):
+        # Unhandled errors of the app count as 500 responses, as behind a server
+        transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            yield client
+
+
+def random_name(prefix: str) -> str:
+    # Not drawn from the seeded random, so usernames differ between runs on the same database
+    return prefix + secrets.token_hex(5)
+
+
+class Seed:
+    """Ids and credentials created before the measurements, shared by the endpoint scenarios"""
+
+    def __init__(self):
+        self.headers = None
+        self.user = None
+        self.words = ["".join(random.choices(string.ascii_lowercase, k=random.randint(4, 9))) for _ in range(500)]
+        self.movie_ids = []
+        self.deletable_movie_ids = []
+
+
+async def bounded_gather(coroutines, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+
+async def create_movies(client, seed: Seed, count: int, bulk_size: int, concurrency: int) -> list:
+    def movie():
+        return {"title": " ".join(random.choices(seed.words, k=3)).title(), "description": " ".join(random.choices(seed.words, k=20)), "user_id": seed.user["username"]}
+
+    async def batch(size):
+        response = await client.post("/movies/bulk", json=[movie() for _ in range(size)], headers=seed.headers)
+        response.raise_for_status()
+        return [result["data"]["id"] for result in response.json()["data"] if result["status"] == "created"]
+
+    sizes = [min(bulk_size, count - start) for start in range(0, count, bulk_size)]
+    return [movie_id for ids in await bounded_gather([batch(size) for size in sizes], concurrency) for movie_id in ids]
+
+
+async def seed_data(client, args) -> Seed:
+    seed = Seed()
+    seed.user = {"username": random_name("bench_"), "full_name": "Bench User", "password": "password"}
+    (await client.post("/signup", json=seed.user)).raise_for_status()
+    response = await client.post("/login", data={"username": seed.user["username"], "password": seed.user["password"]})
+    response.raise_for_status()
+    seed.headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    seed.movie_ids = await create_movies(client, seed, args.movies, args.bulk_size, args.concurrency)
+    seed.deletable_movie_ids = await create_movies(client, seed, args.requests, args.bulk_size, args.concurrency)
+
+    async def children(movie_id):
+        if args.comments_per_movie:
+            comments = [{"comment": " ".join(random.choices(seed.words, k=8)), "movie_id": movie_id} for _ in range(args.comments_per_movie)]
+            (await client.post(f"/movies/{movie_id}/comments/bulk", json=comments, headers=seed.headers)).raise_for_status()
+        if args.ratings_per_movie:
+            ratings = [{"rating": random.randint(1, 5), "movie_id": movie_id} for _ in range(args.ratings_per_movie)]
+            (await client.post(f"/movies/{movie_id}/ratings/bulk", json=ratings, headers=seed.headers)).raise_for_status()
+
+    await bounded_gather([children(movie_id) for movie_id in seed.movie_ids], args.concurrency)
+    if not args.base_url and args.backend != "memory":
+        await asyncio.to_thread(refresh_similar_movies)
+    return seed
+
+
+def refresh_similar_movies():
+    """Runs the refresh-similar-movies job over the seeded ratings, so /similar reads real neighbor lists
+
+    The memory repository computes them on read instead, and a server behind --base-url serves what
+    its own last refresh wrote.
+    """
+    from database import database
+    from recommendations import SIMILAR_MOVIES_SETTLE_SECONDS, refresh_similar_movies as refresh
+
+    # Run as if the settle delay had passed, ratings seeded just now would be left for the next run otherwise
+    refresh(database, full=True, now=datetime.now(timezone.utc) + timedelta(seconds=SIMILAR_MOVIES_SETTLE_SECONDS))
+
+
+def scenarios(seed: Seed, args) -> list:
+    """(endpoint name, request count, function sending the i-th request) for every route"""
+    movie_id = lambda: random.choice(seed.movie_ids)  # noqa: E731
+    movie = lambda: {"title": " ".join(random.choices(seed.words, k=3)), "description": "description", "user_id": seed.user["username"]}  # noqa: E731
+    comment = lambda movie_id: {"comment": "benchmark comment", "movie_id": movie_id}  # noqa: E731
+    rating = lambda movie_id: {"rating": random.randint(1, 5), "movie_id": movie_id}  # noqa: E731
+    headers = seed.headers
+
+    def child_post(path, document, bulk=False):
+        def send(client, i):
+            target = movie_id()
+            body = [document(target) for _ in range(args.bulk_size)] if bulk else document(target)
+            return client.post(f"/movies/{target}/{path}", json=body, headers=headers)
+        return send
+
+    return [
+        ("POST /signup", args.auth_requests, lambda client, i: client.post("/signup", json={**seed.user, "username": random_name("bench_")})),
+        ("POST /login", args.auth_requests, lambda client, i: client.post("/login", data={"username": seed.user["username"], "password": seed.user["password"]})),
+        ("POST /movies", args.requests, lambda client, i: client.post("/movies", json=movie(), headers=headers)),
+        ("POST /movies/bulk", args.requests, lambda client, i: client.post("/movies/bulk", json=[movie() for _ in range(args.bulk_size)], headers=headers)),
+        ("GET /movies", args.requests, lambda client, i: client.get("/movies", params={"limit": 20})),
+        ("GET /movies?skip", args.requests, lambda client, i: client.get("/movies", params={"limit": 20, "skip": random.randrange(len(seed.movie_ids))})),
+        ("GET /movies?ids&with", args.requests, lambda client, i: client.get("/movies", params={"ids": ",".join(movie_id() for _ in range(20)), "with": "rating_summary"})),
+        ("GET /movies/{id}", args.requests, lambda client, i: client.get(f"/movies/{movie_id()}")),
+        ("GET /movies/{id}/detail", args.requests, lambda client, i: client.get(f"/movies/{movie_id()}/detail")),
+        ("GET /movies/{id}/similar", args.requests, lambda client, i: client.get(f"/movies/{movie_id()}/similar")),
+        ("GET /movies/search", args.requests, lambda client, i: client.get("/movies/search", params={"q": random.choice(seed.words)})),
+        ("GET /movies/search?mode=prefix", args.requests, lambda client, i: client.get("/movies/search", params={"q": random.choice(seed.words)[:3], "mode": "prefix"})),
+        ("GET /movies/top", args.requests, lambda client, i: client.get("/movies/top")),
+        ("GET /movies/trending", args.requests, lambda client, i: client.get("/movies/trending")),
+        ("PUT /movies/{id}", args.requests, lambda client, i: client.put(f"/movies/{movie_id()}", json={"title": random.choice(seed.words), "user_id": seed.user["username"]}, headers=headers)),
+        ("DELETE /movies/{id}", args.requests, lambda client, i: client.delete(f"/movies/{seed.deletable_movie_ids[i]}", headers=headers)),
+        ("POST /movies/{id}/comments", args.requests, child_post("comments", comment)),
+        ("POST /movies/{id}/comments/bulk", args.requests, child_post("comments/bulk", comment, bulk=True)),
+        ("GET /movies/{id}/comments", args.requests, lambda client, i: client.get(f"/movies/{movie_id()}/comments")),
+        ("GET /movies/{id}/comments?stream", args.requests, lambda client, i: client.get(f"/movies/{movie_id()}/comments", params={"stream": "true"})),
+        ("POST /movies/{id}/ratings", args.requests, child_post("ratings", rating)),
+        ("POST /movies/{id}/ratings/bulk", args.requests, child_post("ratings/bulk", rating, bulk=True)),
+        ("GET /movies/{id}/ratings", args.requests, lambda client, i: client.get(f"/movies/{movie_id()}/ratings")),
+        ("GET /movies/{id}/ratings/list", args.requests, lambda client, i: client.get(f"/movies/{movie_id()}/ratings/list")),
+    ]
+
+
+def percentile(samples: list, fraction: float) -> float:
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else None
+
+
+async def measure(client, send, count: int, concurrency: int) -> dict:
+    latencies, errors = [], 0
+    indexes = iter(range(count))
+
+    async def worker():
+        nonlocal errors
+        # The workers share one iterator, so each request index is sent exactly once
+        for index in indexes:
+            start = time.perf_counter()
+            try:
+                response = await send(client, index)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": count,
+        "errors": errors,
+        "throughput_rps": round(count / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Endpoints slower or with less throughput than the baseline by more than `tolerance`"""
+    regressions = []
+    for endpoint, result in results["endpoints"].items():
+        base = baseline["endpoints"].get(endpoint)
+        if not base:
+            continue
+        p95_change = result["p95_ms"] / base["p95_ms"] - 1 if base["p95_ms"] else 0
+        throughput_change = result["throughput_rps"] / base["throughput_rps"] - 1 if base["throughput_rps"] else 0
+        regressed = p95_change > tolerance or throughput_change < -tolerance
+        print(f"{endpoint:<38}p95 {p95_change:>+8.1%}   throughput {throughput_change:>+8.1%}{'   REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(endpoint)
+    return regressions
+
+
+async def run(args) -> dict:
+    async with http_client(args) as client:
+        seed = await seed_data(client, args)
+        endpoints = {}
+        print(f"{'endpoint':<38}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        for name, count, send in scenarios(seed, args):
+            if args.only and not any(pattern in name for pattern in args.only):
+                continue
+            result = endpoints[name] = await measure(client, send, count, args.concurrency)
+            print(f"{name:<38}{result['throughput_rps']:>10}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}{result['errors']:>8}")
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "endpoints": endpoints,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["mongo", "memory", "mongomock"], default="mongo")
+    parser.add_argument("--base-url", help="drive a running server instead of the app in this process")
+    parser.add_argument("--movies", type=int, default=1000, help="movies seeded")
+    parser.add_argument("--comments-per-movie", type=int, default=20)
+    parser.add_argument("--ratings-per-movie", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--auth-requests", type=int, default=20, help="requests to /signup and /login, which spend most of their time in bcrypt")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--bulk-size", type=int, default=100, help="items per bulk request")
+    parser.add_argument("--only", nargs="+", help="measure only the endpoints whose name contains one of these")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, for comparable runs")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change of p95 or throughput counted as a regression")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    # One line per request from httpx would drown the results
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if compare(results, json.load(baseline), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Latency of the movie search queries on a large collection.
+
+Seeds a separate database with synthetic movies (skipped when it already holds enough), creates
+the indexes of indexes.py, then times the text and prefix queries GET /movies/search sends:
+
+    python benchmarks/bench_search.py --movies 1000000 --queries 2000
+
+Needs MONGO_DB_CONNECTION_URL, like the app. Drop the database afterwards with --drop.
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import MONGO_DB_CONNECTION_URL  # noqa: E402
+from indexes import apply_indexes, find_collection_scans  # noqa: E402
+from search import normalize_title, title_prefix_query, text_search_pipeline  # noqa: E402
+from serializer import movie_projection  # noqa: E402
+
+SEED_BATCH_SIZE = 10000
+
+
+def vocabulary(size: int) -> list:
+    rng = random.Random(0)
+    return ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10))) for _ in range(size)]
+
+
+def seed(collection, count: int, words: list):
+    # Zipf-like word frequencies, so some terms match a lot of movies and most match few
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+    for start in range(0, count, SEED_BATCH_SIZE):
+        movies = []
+        for _ in range(min(SEED_BATCH_SIZE, count - start)):
+            title = " ".join(random.choices(words, weights, k=random.randint(1, 5))).title()
+            movies.append({
+                "_id": ObjectId(),
+                "title": title,
+                "title_key": normalize_title(title),
+                "description": " ".join(random.choices(words, weights, k=random.randint(10, 40))),
+                "user_id": "bench",
+                "version": 1,
+            })
+        collection.insert_many(movies, ordered=False)
+        print(f"seeded {start + len(movies)}/{count}", end="\r", flush=True)
+    print()
+
+
+def percentile(samples: list, fraction: float) -> float:
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def report(name: str, samples: list):
+    samples = sorted(samples)
+    print(
+        f"{name:<8}{len(samples):>8}{percentile(samples, 0.5):>10.2f}{percentile(samples, 0.95):>10.2f}"
+        f"{percentile(samples, 0.99):>10.2f}{samples[-1]:>10.2f}"
+    )
+
+
+def timed_ms(function) -> float:
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--movies", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=1000, help="queries timed per mode")
+    parser.add_argument("--limit", type=int, default=20, help="page size")
+    parser.add_argument("--database", default="Movie_app_search_bench")
+    parser.add_argument("--drop", action="store_true", help="drop the benchmark database and exit")
+    args = parser.parse_args()
+
+    client = MongoClient(MONGO_DB_CONNECTION_URL)
+    if args.drop:
+        client.drop_database(args.database)
+        return
+    database = client[args.database]
+    movies = database["movies"]
+    words = vocabulary(20000)
+
+    missing = args.movies - movies.estimated_document_count()
+    if missing > 0:
+        seed(movies, missing, words)
+    apply_indexes(database)
+    for collection_name, query, sort in find_collection_scans(database):
+        if collection_name == "movies":
+            print(f"warning: COLLSCAN for {query}")
+
+    print(f"{'mode':<8}{'queries':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    text = [
+        timed_ms(lambda: list(movies.aggregate(text_search_pipeline(random.choice(words), args.limit, movie_projection))))
+        for _ in range(args.queries)
+    ]
+    report("text", text)
+    prefix = [
+        timed_ms(lambda: list(
+            movies.find(title_prefix_query(random.choice(words)[:random.randint(1, 4)]), movie_projection)
+            .sort([("title_key", 1), ("_id", 1)]).limit(args.limit + 1)
+        ))
+        for _ in range(args.queries)
+    ]
+    report("prefix", prefix)
+
+
+if __name__ == "__main__":
+    main()
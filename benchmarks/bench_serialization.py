@@ -0,0 +1,85 @@
+"""Per-request serialization cost of the list endpoints, before and after the orjson fast path.
+
+"before" is the old path: whole documents are decoded from BSON, serialized, then passed through
+jsonable_encoder and JSONResponse. "after" decodes only the projected fields, as the driver does
+when Mongo applies the projection, and renders with ORJSONResponse directly. No database is needed.
+
+    python benchmarks/bench_serialization.py --page-sizes 5 20 100 --children 200
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import bson
+from bson.objectid import ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serializer import movie_serializer, comment_serializer, movie_projection, comment_projection  # noqa: E402
+
+
+def project(document: dict, projection: dict) -> dict:
+    return {key: value for key, value in document.items() if key in projection}
+
+
+def movie_document(children: int) -> dict:
+    return {
+        "_id": ObjectId(),
+        "title": "A movie title",
+        "description": "A description long enough to look like a real synopsis of the movie. " * 3,
+        "user_id": str(ObjectId()),
+        "version": 3,
+        "comments": [str(ObjectId()) for _ in range(children)],
+        "ratings": [str(ObjectId()) for _ in range(children)],
+        "rating_count": children,
+        "rating_sum": 4.0 * children,
+        "rating_histogram": {"4": children},
+    }
+
+
+def comment_document() -> dict:
+    return {"_id": ObjectId(), "comment_id": str(ObjectId()), "movie_id": str(ObjectId()), "user_id": str(ObjectId()), "comment": "A comment about the movie"}
+
+
+def before(raw_documents: list, serializer):
+    documents = [bson.decode(raw) for raw in raw_documents]
+    return JSONResponse(jsonable_encoder({"data": [serializer(document) for document in documents], "next_cursor": None})).body
+
+
+def after(raw_documents: list, serializer):
+    documents = [bson.decode(raw) for raw in raw_documents]
+    return ORJSONResponse({"data": [serializer(document) for document in documents], "next_cursor": None}).body
+
+
+def measure(function, number: int) -> float:
+    """Best of 5 runs, in microseconds per call"""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[5, 20, 100])
+    parser.add_argument("--children", type=int, default=200, help="comment/rating ids on each movie document")
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'endpoint':<28}{'page':>6}{'before us':>12}{'after us':>12}{'speedup':>10}")
+    for page_size in args.page_sizes:
+        movies = [movie_document(args.children) for _ in range(page_size)]
+        comments = [comment_document() for _ in range(page_size)]
+        for name, documents, serializer, projection in (
+            ("GET /movies", movies, movie_serializer, movie_projection),
+            ("GET /movies/{id}/comments", comments, comment_serializer, comment_projection),
+        ):
+            full = [bson.encode(document) for document in documents]
+            projected = [bson.encode(project(document, projection)) for document in documents]
+            before_us = measure(lambda: before(full, serializer), args.number)
+            after_us = measure(lambda: after(projected, serializer), args.number)
+            print(f"{name:<28}{page_size:>6}{before_us:>12.1f}{after_us:>12.1f}{before_us / after_us:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Time and memory of the similar movies refresh on a large ratings collection.
+
+Seeds a separate database with synthetic ratings (skipped when it already holds enough), runs a
+full `refresh_similar_movies`, then an incremental one after --new-ratings more ratings:
+
+    python benchmarks/bench_similar_movies.py --ratings 10000000 --movies 50000 --users 500000
+
+Needs MONGO_DB_CONNECTION_URL, like the app. Drop the database afterwards with --drop.
+--compute-only skips Mongo and times the matrix and neighbor stages on generated ratings.
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import MONGO_DB_CONNECTION_URL  # noqa: E402
+from indexes import apply_indexes  # noqa: E402
+from recommendations import SIMILAR_MOVIES_CHUNK_SIZE, SIMILAR_MOVIES_K, RatingsMatrix, refresh_similar_movies, top_neighbors  # noqa: E402
+
+SEED_BATCH_SIZE = 10000
+
+
+def synthetic_ratings(count: int, movies: int, users: int, seed: int = 0):
+    """(user, movie, rating) index arrays, with Zipf-like movie popularity and user activity"""
+    rng = np.random.default_rng(seed)
+    movie_weights = 1 / np.arange(1, movies + 1) ** 0.8
+    user_weights = 1 / np.arange(1, users + 1) ** 0.5
+    return (
+        rng.choice(users, count, p=user_weights / user_weights.sum()).astype(np.int32),
+        rng.choice(movies, count, p=movie_weights / movie_weights.sum()).astype(np.int32),
+        rng.integers(1, 6, count).astype(np.float32),
+    )
+
+
+def seed(database, count: int, movies: int, users: int, start: datetime, seed_value: int = 0):
+    """Inserts `count` ratings with ObjectIds of times from `start`, one millisecond apart"""
+    movie_ids = [str(movie["_id"]) for movie in database["movies"].find({}, {"_id": 1}).sort("_id", 1)]
+    user_index, movie_index, values = synthetic_ratings(count, movies, users, seed_value)
+    for batch_start in range(0, count, SEED_BATCH_SIZE):
+        batch_end = min(batch_start + SEED_BATCH_SIZE, count)
+        database["ratings"].insert_many([
+            {
+                "_id": ObjectId.from_datetime(start + timedelta(milliseconds=position)),
+                "user_id": f"user{user_index[position]}",
+                "movie_id": movie_ids[movie_index[position]],
+                "rating": int(values[position]),
+            }
+            for position in range(batch_start, batch_end)
+        ], ordered=False)
+        print(f"seeded {batch_end}/{count}", end="\r", flush=True)
+    print()
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(name: str, function):
+    start = time.perf_counter()
+    result = function()
+    print(f"{name:<24}{time.perf_counter() - start:>10.2f} s{max_rss_mb():>10.0f} MB max RSS")
+    return result
+
+
+def compute_only(args):
+    user_index, movie_index, values = timed("generate", lambda: synthetic_ratings(args.ratings, args.movies, args.users))
+    matrix = timed("matrix", lambda: RatingsMatrix(user_index, movie_index, values, list(range(args.movies)), args.users))
+    normalized = timed("normalize", lambda: matrix.normalized(np.ones(args.movies, dtype=np.float32)))
+
+    def neighbors(rows):
+        for start in range(0, len(rows), SIMILAR_MOVIES_CHUNK_SIZE):
+            for _ in top_neighbors(normalized, rows[start:start + SIMILAR_MOVIES_CHUNK_SIZE], SIMILAR_MOVIES_K):
+                pass
+        return len(rows)
+
+    timed(f"neighbors of {args.movies}", lambda: neighbors(np.arange(args.movies, dtype=np.int32)))
+    changed = np.unique(movie_index[-args.new_ratings:])
+    rows = timed(f"co-rated of {len(changed)}", lambda: matrix.co_rated(changed))
+    timed(f"neighbors of {len(rows)}", lambda: neighbors(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ratings", type=int, default=10000000)
+    parser.add_argument("--movies", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=500000)
+    parser.add_argument("--new-ratings", type=int, default=1000, help="ratings added before the incremental refresh")
+    parser.add_argument("--database", default="Movie_app_similar_bench")
+    parser.add_argument("--compute-only", action="store_true", help="time the computation on generated ratings, without Mongo")
+    parser.add_argument("--drop", action="store_true", help="drop the benchmark database and exit")
+    args = parser.parse_args()
+
+    if args.compute_only:
+        compute_only(args)
+        return
+    client = MongoClient(MONGO_DB_CONNECTION_URL)
+    if args.drop:
+        client.drop_database(args.database)
+        return
+    database = client[args.database]
+    apply_indexes(database)
+
+    missing_movies = args.movies - database["movies"].estimated_document_count()
+    if missing_movies > 0:
+        database["movies"].insert_many([{"title": f"Movie {number}", "user_id": "bench", "version": 1} for number in range(missing_movies)])
+    # Ratings dated from a day ago, so every seeded one is older than the settle delay
+    now = datetime.now(timezone.utc)
+    missing_ratings = args.ratings - database["ratings"].estimated_document_count()
+    if missing_ratings > 0:
+        seed(database, missing_ratings, args.movies, args.users, now - timedelta(days=1))
+
+    timed("full refresh", lambda: refresh_similar_movies(database, full=True, now=now))
+    seed(database, args.new_ratings, args.movies, args.users, now, seed_value=1)
+    counts = timed("incremental refresh", lambda: refresh_similar_movies(database, now=now + timedelta(days=1)))
+    print(f"incremental refresh recomputed {counts['movies']} movies")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+import orjson
+
+import metrics
+from settings import settings
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # only needed for MOVIE_CACHE_BACKEND=redis
+    redis_asyncio = None
+
+PRINCIPAL_CACHE_SIZE = settings.principal_cache_size
+PRINCIPAL_CACHE_TTL_SECONDS = settings.principal_cache_ttl_seconds
+
+# memory (in-process LRU), redis (shared between workers) or none
+MOVIE_CACHE_BACKEND = settings.movie_cache_backend
+MOVIE_CACHE_SIZE = settings.movie_cache_size
+MOVIE_CACHE_TTL_SECONDS = settings.movie_cache_ttl_seconds
+MOVIE_CACHE_REDIS_URL = settings.movie_cache_redis_url
+
+
+class TTLCache:
+    """Bounded in-process LRU cache whose entries also expire after a TTL
+
+    With a `name`, its hits and misses are counted on /metrics under that cache label.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, name: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                hit = False
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                hit = True
+        if self.name:
+            (metrics.cache_hits if hit else metrics.cache_misses).inc(cache=self.name)
+        return entry[1] if hit else default
+
+    def set(self, key, value, ttl: float = None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _remove(self, key):
+        # Called with the lock held
+        self._entries.pop(key, None)
+
+
+class PrincipalCache(TTLCache):
+    """Authenticated users resolved by get_current_user, keyed by (username, token expiry)
+
+    A user can hold several live tokens, so every key of a username is tracked to drop them
+    all when the user is updated or deleted.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, name: str = "principal"):
+        super().__init__(maxsize, ttl, name)
+        self._keys_by_username = {}
+
+    def set(self, key, value, ttl: float = None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._keys_by_username.setdefault(key[0], set()).add(key)
+        super().set(key, value, ttl)
+
+    def invalidate_user(self, username: str):
+        with self._lock:
+            for key in self._keys_by_username.pop(username, ()):
+                self._entries.pop(key, None)
+        metrics.cache_invalidations.inc(cache=self.name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_username.clear()
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_username.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_username[key[0]]
+
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS)
+
+
+class LocalCacheBackend:
+    """In-process LRU backend of ReadThroughCache. Also the local stand-in for the shared backend in tests"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize, ttl)
+        self._groups = {}
+
+    async def get(self, key):
+        return self._cache.get(key)
+
+    async def set(self, key, value, group: str = None):
+        self._cache.set(key, value)
+        if group:
+            self._groups.setdefault(group, set()).add(key)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self._cache.delete(key)
+
+    async def delete_group(self, group: str):
+        for key in self._groups.pop(group, ()):
+            self._cache.delete(key)
+
+    def size(self) -> int:
+        return self._cache.stats()["size"]
+
+
+class RedisCacheBackend:
+    """Shared backend of ReadThroughCache, so every worker sees the same entries and invalidations"""
+
+    def __init__(self, url: str, ttl: float, prefix: str = "movie_app:"):
+        if redis_asyncio is None:
+            raise RuntimeError("MOVIE_CACHE_BACKEND=redis needs the redis package installed")
+        self._redis = redis_asyncio.from_url(url)
+        self._ttl = max(int(ttl), 1)
+        self._prefix = prefix
+
+    async def get(self, key):
+        value = await self._redis.get(self._prefix + key)
+        return orjson.loads(value) if value is not None else None
+
+    async def set(self, key, value, group: str = None):
+        async with self._redis.pipeline(transaction=False) as pipeline:
+            pipeline.set(self._prefix + key, orjson.dumps(value), ex=self._ttl)
+            if group:
+                pipeline.sadd(self._prefix + group, key)
+                pipeline.expire(self._prefix + group, self._ttl)
+            await pipeline.execute()
+
+    async def delete(self, *keys):
+        await self._redis.delete(*(self._prefix + key for key in keys))
+
+    async def delete_group(self, group: str):
+        keys = await self._redis.smembers(self._prefix + group)
+        await self._redis.delete(self._prefix + group, *(self._prefix + key.decode() for key in keys))
+
+    def size(self) -> int:
+        return None
+
+
+class ReadThroughCache:
+    """Serves values from a backend, loading and storing them on a miss
+
+    Concurrent misses on the same key in this process share one load instead of all hitting Mongo.
+    A value loaded while an invalidation happened is not stored, as it may predate the write.
+    """
+
+    def __init__(self, backend, name: str = "movie"):
+        self.backend = backend
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._locks = {}
+        self._invalidations = 0
+
+    async def get_or_load(self, key: str, loader, group: str = None):
+        if self.backend is None:
+            return await loader()
+        value = await self.backend.get(key)
+        if value is not None:
+            self._hit()
+            return value
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                # Another request may have loaded it while this one waited for the lock
+                value = await self.backend.get(key)
+                if value is not None:
+                    self._hit()
+                    return value
+                self.misses += 1
+                metrics.cache_misses.inc(cache=self.name)
+                invalidations = self._invalidations
+                value = await loader()
+                if value is not None and invalidations == self._invalidations:
+                    await self.backend.set(key, value, group)
+                return value
+        finally:
+            if self._locks.get(key) is lock and not lock.locked():
+                del self._locks[key]
+
+    async def invalidate(self, *keys, groups=()):
+        self._invalidations += 1
+        if self.backend is None:
+            return
+        if keys:
+            await self.backend.delete(*keys)
+        for group in groups:
+            await self.backend.delete_group(group)
+        metrics.cache_invalidations.inc(cache=self.name)
+
+    def _hit(self):
+        self.hits += 1
+        metrics.cache_hits.inc(cache=self.name)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": self.backend.size() if self.backend is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+def build_movie_cache() -> ReadThroughCache:
+    if MOVIE_CACHE_BACKEND == "none":
+        return ReadThroughCache(None)
+    if MOVIE_CACHE_BACKEND == "redis":
+        return ReadThroughCache(RedisCacheBackend(MOVIE_CACHE_REDIS_URL, MOVIE_CACHE_TTL_SECONDS))
+    return ReadThroughCache(LocalCacheBackend(MOVIE_CACHE_SIZE, MOVIE_CACHE_TTL_SECONDS))
+
+
+# Movie documents and the first pages of the movie listing
+movie_cache = build_movie_cache()
+MOVIE_FIRST_PAGES = "movies:first_pages"
+
+
+def movie_key(movie_id: str) -> str:
+    return f"movie:{movie_id}"
+
+
+def movie_first_page_key(limit: int, enrichments: tuple = ()) -> str:
+    return f"movies:first_page:{limit}:{','.join(sorted(enrichments))}"
@@ -0,0 +1,5 @@
+import os
+
+# Tests hash passwords at the lowest bcrypt cost, at the default of 12 signups and logins take most
+# of the run. Set before test_main.py imports the app, as settings.py reads the environment then.
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
@@ -1,82 +1,315 @@
+from datetime import datetime, timezone
 from fastapi.encoders import jsonable_encoder
 from bson.objectid import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 from fastapi import HTTPException, status
-from database import movies_collection, users_collection, ratings_collection, comments_collection
+from database import movies_collection, users_collection, ratings_collection, comments_collection, leaderboard_collection, similar_movies_collection
 from schema import MovieCreate, MovieUpdate, UserCreate, UserBase, UserInDb, UserUpdate, UserCreate, CommentCreate, RatingCreate, MovieDelete
-from serializer import movie_serializer, user_serializer, comment_serializer, rating_serializer, user_serializer_password
+from serializer import movie_serializer, user_serializer, comment_serializer, rating_serializer, user_serializer_password, rating_summary_serializer, comment_projection, rating_projection, movie_projection, user_projection, user_password_projection, rating_summary_projection, enriched_movie_projection, enriched_movie_serializer
+from pagination import keyset_query, keyset_page
+from search import normalize_title
+from cache import principal_cache
 
+# Documents fetched per round trip when streaming a movie's comments or ratings
+STREAM_BATCH_SIZE = 500
+# Most movies GET /movies?ids= returns in one request
+MOVIE_IDS_MAX = 100
+
+
+def rating_star(rating: float) -> str:
+    """Histogram bucket a rating falls in, rounded half up to the nearest whole star
+
+    round() would send halves to the even star, 2.5 to 2 but 3.5 to 4.
+    """
+    return str(int(rating + 0.5))
+
+
+def rating_aggregate_increments(rating: float) -> dict:
+    """$inc document that adds one rating to the aggregates kept on the movie"""
+    return ratings_aggregate_increments([rating])
+
+
+def ratings_aggregate_increments(ratings: list) -> dict:
+    """$inc document that adds a batch of ratings to the aggregates kept on the movie in one update"""
+    increments = {"rating_count": len(ratings), "rating_sum": sum(ratings)}
+    for rating in ratings:
+        key = f"rating_histogram.{rating_star(rating)}"
+        increments[key] = increments.get(key, 0) + 1
+    return increments
+
+
+# Documents are built with a client generated _id, so a write is one insert and the
+# response is serialized from memory instead of reading the document back.
+
+def new_movie_document(movie_data: MovieCreate, user: UserBase) -> dict:
+    movie_data_dict = movie_data.model_dump()
+    movie_data_dict["user_id"] = user["id"]
+    return {
+        "_id": ObjectId(), **jsonable_encoder(movie_data_dict), "title_key": normalize_title(movie_data.title),
+        "version": 1, "updated_at": datetime.now(timezone.utc),
+    }
+
+
+def new_user_document(user_data: UserCreate, hashed_password: str) -> dict:
+    return {
+        "_id": ObjectId(),
+        "username": user_data.username,
+        "full_name": user_data.full_name,
+        "hashed_password": hashed_password,
+    }
+
+
+def new_comment_document(comment_data: CommentCreate, user: UserBase, movie_id: str) -> dict:
+    comment_data_dict = comment_data.model_dump()
+    comment_data_dict['user_id'] = user["id"]
+    comment_data_dict['movie_id'] = movie_id
+    comment_id = ObjectId()
+    return {"_id": comment_id, "comment_id": str(comment_id), **jsonable_encoder(comment_data_dict)}
+
+
+def new_rating_document(rating_data: RatingCreate, user: UserBase, movie_id: str) -> dict:
+    rating_data_dict = rating_data.model_dump()
+    rating_data_dict['user_id'] = user["id"]
+    rating_data_dict['movie_id'] = movie_id
+    rating_id = ObjectId()
+    return {"_id": rating_id, "rating_id": str(rating_id), **jsonable_encoder(rating_data_dict)}
+
+
+def touch_movie(update: dict) -> dict:
+    """Adds the version bump and updated_at of a write to a movie update
+
+    Every write that changes what the movie endpoints return goes through this, the version
+    and updated_at are what the ETag / Last-Modified of those endpoints are built from.
+    """
+    return {
+        **update,
+        "$inc": {**update.get("$inc", {}), "version": 1},
+        "$currentDate": {"updated_at": True},
+    }
+
+
+def owned_movie_filter(movie_id: str, user: UserBase, version: int = None) -> dict:
+    """Filter matching the movie only if the user owns it and, when given, it is still at `version`"""
+    query = {"_id": ObjectId(movie_id), "user_id": user["id"]}
+    if version is not None:
+        # Movies written before versioning have no version field, they count as version 0
+        query["version"] = version if version else {"$in": [0, None]}
+    return query
+
+
+def parse_movie_ids(ids: str) -> list:
+    """ObjectIds of a comma separated list of movie ids, in the given order and without duplicates"""
+    movie_ids = list(dict.fromkeys(movie_id.strip() for movie_id in ids.split(",") if movie_id.strip()))
+    if len(movie_ids) > MOVIE_IDS_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {MOVIE_IDS_MAX} ids per request")
+    invalid = [movie_id for movie_id in movie_ids if not ObjectId.is_valid(movie_id)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid movie ids {', '.join(invalid)}")
+    return [ObjectId(movie_id) for movie_id in movie_ids]
+
+
+def movie_write_allowed(movie: dict, user: UserBase, version: int = None) -> bool:
+    """Whether owned_movie_filter matches the movie, for a movie already read"""
+    return movie.get("user_id") == user["id"] and (version is None or (movie.get("version") or 0) == version)
+
+
+def movie_changes(movie_update_in: MovieUpdate) -> dict:
+    """Fields an update sets on the movie"""
+    # The owner never changes through an update
+    changes = movie_update_in.model_dump(exclude_unset=True, exclude={"user_id"})
+    if "title" in changes:
+        changes["title_key"] = normalize_title(changes["title"])
+    return changes
+
+
+def movie_changed_by(movie: dict, changes: dict) -> bool:
+    return any(movie.get(field) != value for field, value in changes.items())
+
+
+def changed_movie_filter(movie_id: str, user: UserBase, version: int, changes: dict) -> dict:
+    """owned_movie_filter, narrowed to a movie on which `changes` modify at least one field
+
+    An update setting every field to the value it already has matches nothing, so it does not
+    bump the version and updated_at the validators of the movie endpoints are built from.
+    """
+    return {**owned_movie_filter(movie_id, user, version), "$or": [{field: {"$ne": value}} for field, value in changes.items()]}
+
+
+def movie_update(changes: dict) -> dict:
+    return touch_movie({"$set": changes})
+
+
+def raise_for_missed_movie_write(movie: dict, user: UserBase, action: str):
+    """Tells why a conditional write matched nothing on a movie that exists"""
+    if movie.get("user_id") != user["id"]:
+        raise HTTPException(status_code=403, detail=f"Not authorized to {action} this movie")
+    raise HTTPException(status_code=412, detail="Movie was modified since it was fetched")
+
+
+def bulk_results(documents: list, write_errors: dict, serializer) -> list:
+    """Per document outcome of a bulk insert, in the order the documents were given"""
+    return [
+        {"status": "error", "detail": write_errors[index]} if index in write_errors
+        else {"status": "created", "data": serializer(document)}
+        for index, document in enumerate(documents)
+    ]
 
 
 class MovieCRUDservice:
     
     @staticmethod
     def movie_create(movie_data: MovieCreate, user: UserBase):
-        movie_data_dict = movie_data.model_dump()
-        movie_data_dict.get("user_id") == user["id"]
-        movie_data = jsonable_encoder(movie_data_dict)
-        movie_document_data = movies_collection.insert_one(movie_data)
-        movie_id = movie_document_data.inserted_id
-        movie_document = movies_collection.find_one({"_id": ObjectId(movie_id)})
+        movie_document = new_movie_document(movie_data, user)
+        movies_collection.insert_one(movie_document)
         return movie_serializer(movie_document)
     
     @staticmethod
-    def get_all_movies(skip: int = 0, limit: int = 5):
-        movies = movies_collection.find().skip(skip).limit(limit)
-        return [movie_serializer(movie) for movie in movies]
-    
+    def get_all_movies(skip: int = 0, limit: int = 5, enrichments: tuple = ()):
+        movies = movies_collection.find({}, enriched_movie_projection(enrichments)).sort("_id", 1).skip(skip).limit(limit)
+        return [enriched_movie_serializer(enrichments)(movie) for movie in movies]
+
+    @staticmethod
+    def get_movies_page(limit: int = 5, cursor: str = None, enrichments: tuple = ()):
+        movies = movies_collection.find(keyset_query({}, cursor), enriched_movie_projection(enrichments)).sort("_id", 1).limit(limit + 1)
+        return keyset_page(list(movies), limit, enriched_movie_serializer(enrichments))
+
+    @staticmethod
+    def get_movies_by_ids(movie_ids: list, enrichments: tuple = ()):
+        # One $in query for the whole batch, movies that do not exist are left out
+        movies = {movie["_id"]: movie for movie in movies_collection.find({"_id": {"$in": movie_ids}}, enriched_movie_projection(enrichments))}
+        serializer = enriched_movie_serializer(enrichments)
+        return [serializer(movies[movie_id]) for movie_id in movie_ids if movie_id in movies]
+
     @staticmethod
     def get_movies_by_id(movie_id: str):
-        movie = movies_collection.find_one({"_id": ObjectId(movie_id)})
+        movie = movies_collection.find_one({"_id": ObjectId(movie_id)}, movie_projection)
         # print(movie)  # Print the entire movie document
         if movie:
             movie["user_id"] = movie.get("user_id", None)
             return movie_serializer(movie)
         return None
-    
-    @staticmethod
-    def update_movie(movie_id: str, movie_update_in: MovieUpdate, user: UserInDb):
-        movie = movies_collection.find_one({"_id": ObjectId(movie_id)}  )
 
+    @staticmethod
+    def update_movie(movie_id: str, movie_update_in: MovieUpdate, user: UserInDb, version: int = None):
+        # Ownership (and the expected version) is part of the filter, so the check and the write are one atomic command
+        changes = movie_changes(movie_update_in)
+        if changes:
+            movie_updated = movies_collection.find_one_and_update(
+                changed_movie_filter(movie_id, user, version, changes), movie_update(changes),
+                projection=movie_projection, return_document=ReturnDocument.AFTER,
+            )
+            if movie_updated:
+                return movie_serializer(movie_updated)
+        # Nothing written: the update changes nothing, or the movie is missing, someone else's or at another version
+        movie = movies_collection.find_one({"_id": ObjectId(movie_id)}, {**movie_projection, **dict.fromkeys(changes, 1)})
         if not movie:
             return None
-        
-        if movie["user_id"] != user["id"]:
-            raise HTTPException(status_code=403, detail="Not authorized to update this movie")
-
-        movie_update_data = movie_update_in.model_dump(exclude_unset=True)
-        movie_updated = movies_collection.find_one_and_update(
-            {"_id": ObjectId(movie_id)}, {"$set": movie_update_data}, return_document=True
-        )
-
-        return movie_serializer(movie_updated)
+        if movie_write_allowed(movie, user, version) and not movie_changed_by(movie, changes):
+            return movie_serializer(movie)
+        raise_for_missed_movie_write(movie, user, "update")
     
     
     @staticmethod
-    def delete_movie(movie_id: str, user: UserInDb):
-        movie = movies_collection.find_one({"_id": ObjectId(movie_id)})
+    def delete_movie(movie_id: str, user: UserInDb, version: int = None):
+        movie_deleted = movies_collection.find_one_and_delete(owned_movie_filter(movie_id, user, version), {"_id": 1})
+        if movie_deleted:
+            leaderboard_collection.delete_one({"_id": movie_id})
+            similar_movies_collection.delete_one({"_id": movie_id})
+            return True
+        movie = movies_collection.find_one({"_id": ObjectId(movie_id)}, {"user_id": 1})
         if not movie:
             return None
-        if movie["user_id"] != user["id"]:
-            raise HTTPException(status_code=403, detail="Not authorized to delete this movie")
-        movie_deleted = movies_collection.find_one_and_delete({"_id": ObjectId(movie_id)})
-        return True
+        raise_for_missed_movie_write(movie, user, "delete")
 
     
     @staticmethod
-    def add_comment_to_movie(movie_id: str, comment_id: str):
-        movies_collection.update_one({"_id": ObjectId(movie_id)}, {"$push": {"comments": comment_id}})
+    def add_comment_to_movie(movie_id: str):
+        # Only a counter is kept on the movie, its comments are found by their indexed movie_id
+        movies_collection.update_one({"_id": ObjectId(movie_id)}, touch_movie({"$inc": {"comment_count": 1}}))
         
     
     @staticmethod
-    def add_rating_to_movie(movie_id: str, rating_id: str):
-        movies_collection.update_one({"_id": ObjectId(movie_id)}, {"$push": {"ratings": rating_id}})
+    def add_rating_to_movie(movie_id: str, rating: float):
+        # Keep the rating aggregates on the movie in the same update, so reading the average is one document
+        movies_collection.update_one(
+            {"_id": ObjectId(movie_id)},
+            touch_movie({"$inc": rating_aggregate_increments(rating)}),
+        )
+
+    @staticmethod
+    def get_rating_summary(movie_id: str):
+        movie = movies_collection.find_one(
+            {"_id": ObjectId(movie_id)}, rating_summary_projection
+        )
+        if movie:
+            return rating_summary_serializer(movie)
+        return None
 
    
     @staticmethod
     def get_movie_id(movie_id: str):
-        movie = movies_collection.find_one({"_id": ObjectId(movie_id)})
+        movie = movies_collection.find_one({"_id": ObjectId(movie_id)}, {"title": 1})
         return movie.get("title")
-    
+
+    @staticmethod
+    def strip_child_id_arrays(batch_size: int = 1000):
+        """Removes the comments/ratings id arrays older movies carry, setting comment_count from the comments collection
+
+        Works in batches of movies so no single update or bulk write grows with the collection.
+        Each batch resumes after the last _id of the previous one, so the collection is walked once
+        through the _id index rather than scanned again from its start for every batch.
+        Rating aggregates are not touched, `manage.py rebuild-rating-aggregates` recomputes them.
+        """
+        migrated = 0
+        last_id = None
+        while True:
+            query = {"$or": [{"comments": {"$exists": True}}, {"ratings": {"$exists": True}}]}
+            if last_id:
+                query["_id"] = {"$gt": last_id}
+            movie_ids = [movie["_id"] for movie in movies_collection.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size)]
+            if not movie_ids:
+                return migrated
+            last_id = movie_ids[-1]
+            comment_counts = {
+                group["_id"]: group["count"]
+                for group in comments_collection.aggregate([
+                    {"$match": {"movie_id": {"$in": [str(movie_id) for movie_id in movie_ids]}}},
+                    {"$group": {"_id": "$movie_id", "count": {"$sum": 1}}},
+                ])
+            }
+            movies_collection.bulk_write([
+                UpdateOne(
+                    {"_id": movie_id},
+                    touch_movie({"$set": {"comment_count": comment_counts.get(str(movie_id), 0)}, "$unset": {"comments": "", "ratings": ""}}),
+                )
+                for movie_id in movie_ids
+            ], ordered=False)
+            migrated += len(movie_ids)
+
+    @staticmethod
+    def backfill_title_keys(batch_size: int = 1000):
+        """Sets the title_key prefix search relies on for movies created before it existed
+
+        Walks the collection once in _id order, each batch resuming after the last _id of the previous one.
+        """
+        backfilled = 0
+        last_id = None
+        while True:
+            query = {"title_key": {"$exists": False}}
+            if last_id:
+                query["_id"] = {"$gt": last_id}
+            movies = list(movies_collection.find(query, {"title": 1}).sort("_id", 1).limit(batch_size))
+            if not movies:
+                return backfilled
+            last_id = movies[-1]["_id"]
+            # title_key is not returned by the API, so the version is left as is
+            movies_collection.bulk_write([
+                UpdateOne({"_id": movie["_id"]}, {"$set": {"title_key": normalize_title(movie.get("title"))}})
+                for movie in movies
+            ], ordered=False)
+            backfilled += len(movies)
+
 movie_crud_service = MovieCRUDservice
 
 
@@ -84,60 +317,58 @@ class UserCRUDservice:
     
     @staticmethod
     def user_create(user_data: UserCreate, hashed_password: str):
-        # Verify if user exists
-        if users_collection.find_one({"username": user_data.username}):
-            raise HTTPException (detail = "user already exists", status_code= status.HTTP_400_BAD_REQUEST)
-        # Continue if user does not exist
-        user_data = jsonable_encoder(user_data)
-        user_document_data = users_collection.insert_one(
-            {
-                "username": user_data.get('username'),
-                "full_name": user_data.get('full_name'),
-                "hashed_password": hashed_password,
-            }
-        )
-        user_id = user_document_data.inserted_id
-        user_document = users_collection.find_one(
-            {"_id": ObjectId(user_id)}
-        )
+        # The unique username index rejects duplicates, no need to look the user up first
+        user_document = new_user_document(user_data, hashed_password)
+        try:
+            users_collection.insert_one(user_document)
+        except DuplicateKeyError:
+            raise HTTPException (detail = "Username already registered", status_code= status.HTTP_400_BAD_REQUEST)
         return user_serializer(user_document)
     
     @staticmethod
     def get_all_users(skip: int = 0, limit: int = 5):
-        users = users_collection.find().skip(skip).limit(limit)
+        users = users_collection.find({}, user_projection).skip(skip).limit(limit)
         return [user_serializer(user) for user in users]
     
     @staticmethod
     def get_user_by_username(username: str) -> UserInDb:
-        user =users_collection.find_one({"username": username})
+        user = users_collection.find_one({"username": username}, user_projection)
         if user:
             return user_serializer(user)
         return None
     
     @staticmethod
     def get_user_by_username_with_hash(username: str) -> UserInDb:
-        user = users_collection.find_one({"username": username})
+        user = users_collection.find_one({"username": username}, user_password_projection)
         if user:
             return user_serializer_password(user)
         return None
     
     @staticmethod
     def update_user(username: str, user_data: UserUpdate):
-        user = users_collection.find_one({"username": username})
+        user = users_collection.find_one({"username": username}, {"_id": 1})
 
         if not user:
             return None
 
         user_update_data = user_data.model_dump(exclude_unset=True)
         user_updated = users_collection.find_one_and_update(
-            {"username": user_data.username}, {"$set": user_update_data}, return_document=True
+            {"username": user_data.username}, {"$set": user_update_data}, projection=user_projection, return_document=True
         )
+        principal_cache.invalidate_user(username)
+        principal_cache.invalidate_user(user_data.username)
 
         return user_serializer(user_updated)
     
+    @staticmethod
+    def update_password_hash(username: str, hashed_password: str):
+        users_collection.update_one({"username": username}, {"$set": {"hashed_password": hashed_password}})
+
     @staticmethod
     def delete_user(username: str):
-        return users_collection.find_one_and_delete({"username": username})
+        user_deleted = users_collection.find_one_and_delete({"username": username})
+        principal_cache.invalidate_user(username)
+        return user_deleted
    
     
 user_crud_service = UserCRUDservice
@@ -148,23 +379,28 @@ class CommentCRUDservice:
     
     @staticmethod
     def create_comment(comment_data: CommentCreate, user: UserBase, movie_id: str):
-        comment_data_dict = comment_data.model_dump()
-        comment_data_dict['user_id'] = user["id"]
-        comment_data_dict['movie_id'] = movie_id
-        comment_data = jsonable_encoder(comment_data_dict)
-        comment_document_data = comments_collection.insert_one(comment_data)
-        comment_id = comment_document_data.inserted_id
-        comments_collection.update_one({"_id": ObjectId(comment_id)}, {"$set": {"comment_id": str(comment_id)}})
-        movie_crud_service.add_comment_to_movie(movie_id, str(comment_id))
-        comment_document = comments_collection.find_one({"_id": ObjectId(comment_id)})
+        comment_document = new_comment_document(comment_data, user, movie_id)
+        comments_collection.insert_one(comment_document)
+        movie_crud_service.add_comment_to_movie(movie_id)
         return comment_serializer(comment_document)
 
 
 
     @staticmethod
     def get_comments_by_movie(movie_id: str):
-        comments = comments_collection.find({"movie_id": movie_id})
+        comments = comments_collection.find({"movie_id": movie_id}, comment_projection)
         return [comment_serializer(comment) for comment in comments]
+
+    @staticmethod
+    def stream_comments_by_movie(movie_id: str):
+        comments = comments_collection.find({"movie_id": movie_id}, comment_projection).sort("_id", 1).batch_size(STREAM_BATCH_SIZE)
+        for comment in comments:
+            yield comment_serializer(comment)
+
+    @staticmethod
+    def get_comments_page(movie_id: str, limit: int = 20, cursor: str = None):
+        comments = comments_collection.find(keyset_query({"movie_id": movie_id}, cursor), comment_projection).sort("_id", 1).limit(limit + 1)
+        return keyset_page(list(comments), limit, comment_serializer)
     
 comment_crud_service = CommentCRUDservice
 
@@ -173,22 +409,69 @@ class RatingCRUDservice:
     
     @staticmethod
     def create_rating(rating_data: RatingCreate, user: UserBase, movie_id: str):
-        rating_data_dict = rating_data.model_dump()
-        rating_data_dict['user_id'] = user["id"]
-        rating_data_dict['movie_id'] = movie_id
-        rating_data = jsonable_encoder(rating_data_dict)
-        rating_document_data = ratings_collection.insert_one(rating_data)
-        rating_id = rating_document_data.inserted_id
-        ratings_collection.update_one({"_id": ObjectId(rating_id)}, {"$set": {"rating_id": str(rating_id)}})
-        movie_crud_service.add_rating_to_movie(movie_id, str(rating_id))
-        rating_document = ratings_collection.find_one({"_id": ObjectId(rating_id)})
+        rating_document = new_rating_document(rating_data, user, movie_id)
+        ratings_collection.insert_one(rating_document)
+        movie_crud_service.add_rating_to_movie(movie_id, rating_document["rating"])
         return rating_serializer(rating_document)
     
     
     @staticmethod
-    def get_ratings_by_movie(movie_id: str):
-        ratings = ratings_collection.find({"movie_id": movie_id})
+    def get_ratings_by_movie(movie_id: str, skip: int = 0, limit: int = 20):
+        ratings = ratings_collection.find({"movie_id": movie_id}, rating_projection).skip(skip).limit(limit)
         return [rating_serializer(rating) for rating in ratings]
+
+    @staticmethod
+    def stream_ratings_by_movie(movie_id: str):
+        ratings = ratings_collection.find({"movie_id": movie_id}, rating_projection).sort("_id", 1).batch_size(STREAM_BATCH_SIZE)
+        for rating in ratings:
+            yield rating_serializer(rating)
+
+    @staticmethod
+    def get_ratings_page(movie_id: str, limit: int = 20, cursor: str = None):
+        ratings = ratings_collection.find(keyset_query({"movie_id": movie_id}, cursor), rating_projection).sort("_id", 1).limit(limit + 1)
+        return keyset_page(list(ratings), limit, rating_serializer)
+
+    @staticmethod
+    def rebuild_rating_aggregates(batch_size: int = 1000):
+        """Recompute rating_count, rating_sum and rating_histogram on every movie from the ratings collection
+
+        Walks the movies in _id order, batch_size at a time, and aggregates the ratings of each batch
+        only, so memory and every query stay bounded by the batch whatever the size of the collections.
+        The aggregates are $set from what was read, so run it with rating writes stopped: a rating
+        added to a batch's movies between its read and its write would be left out of their totals.
+        """
+        rebuilt = 0
+        last_id = None
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id else {}
+            movies = list(movies_collection.find(query, {"rating_count": 1}).sort("_id", 1).limit(batch_size))
+            if not movies:
+                return rebuilt
+            last_id = movies[-1]["_id"]
+            aggregates = {}
+            for group in ratings_collection.aggregate([
+                {"$match": {"movie_id": {"$in": [str(movie["_id"]) for movie in movies]}}},
+                {"$group": {"_id": {"movie_id": "$movie_id", "rating": "$rating"}, "count": {"$sum": 1}}},
+            ]):
+                aggregate = aggregates.setdefault(group["_id"]["movie_id"], {"rating_count": 0, "rating_sum": 0, "rating_histogram": {}})
+                rating, star = group["_id"]["rating"], rating_star(group["_id"]["rating"])
+                aggregate["rating_count"] += group["count"]
+                aggregate["rating_sum"] += rating * group["count"]
+                aggregate["rating_histogram"][star] = aggregate["rating_histogram"].get(star, 0) + group["count"]
+
+            requests = []
+            for movie in movies:
+                aggregate = aggregates.get(str(movie["_id"]))
+                if aggregate:
+                    requests.append(UpdateOne({"_id": movie["_id"]}, touch_movie({"$set": aggregate})))
+                elif movie.get("rating_count"):
+                    # Movies without any rating left get their aggregates reset
+                    requests.append(UpdateOne(
+                        {"_id": movie["_id"]}, touch_movie({"$set": {"rating_count": 0, "rating_sum": 0, "rating_histogram": {}}}),
+                    ))
+            if requests:
+                movies_collection.bulk_write(requests, ordered=False)
+            rebuilt += len(aggregates)
     
 
 rating_crud_service = RatingCRUDservice
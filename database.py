@@ -1,20 +1,139 @@
-import os
-from pymongo import mongo_client, MongoClient
-from dotenv import load_dotenv
+import asyncio
 
-load_dotenv()
+from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from metrics import MongoCommandMetrics, MongoPoolMetrics
+from logger import get_logger
+from settings import settings
 
-MONGO_DB_CONNECTION_URL = os.environ.get("MONGO_DB_CONNECTION_URL")
+logger = get_logger(__name__)
 
+MONGO_DB_CONNECTION_URL = settings.mongo_db_connection_url
 
-client = mongo_client.MongoClient(MONGO_DB_CONNECTION_URL)
-print ("Connected to MongoDB")
+# Both clients report command durations and pool checkout waits to /metrics
+event_listeners = [MongoCommandMetrics(), MongoPoolMetrics()]
 
-# Get or Create Collection
 
-movies_collection = client["Movie_app"]["movies"]
-users_collection = client["Movie_app"]["users"]
-comments_collection = client["Movie_app"]["comments"]
-ratings_collection = client["Movie_app"]["ratings"]
+def client_options() -> dict:
+    """Pool, timeout, read preference and write concern options of both clients"""
+    write_concern = settings.mongo_write_concern
+    options = {
+        "maxPoolSize": settings.mongo_max_pool_size,
+        "minPoolSize": settings.mongo_min_pool_size,
+        "maxIdleTimeMS": settings.mongo_max_idle_time_ms,
+        "connectTimeoutMS": settings.mongo_connect_timeout_ms,
+        "serverSelectionTimeoutMS": settings.mongo_server_selection_timeout_ms,
+        "socketTimeoutMS": settings.mongo_socket_timeout_ms,
+        "waitQueueTimeoutMS": settings.mongo_wait_queue_timeout_ms,
+        "readPreference": settings.mongo_read_preference,
+        "w": int(write_concern) if write_concern.isdigit() else write_concern,
+        "journal": settings.mongo_journal,
+    }
+    return {name: value for name, value in options.items() if value is not None}
 
 
+class MongoClients:
+    """The sync and async clients, created on first use
+
+    The app's lifespan opens the async client at startup, warming its pool so the first requests
+    do not pay for connecting, and closes both at shutdown. Scripts and tests just use them.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.async_client = None
+        self.ready = False
+
+    def get_client(self) -> MongoClient:
+        if self.client is None:
+            self.client = MongoClient(MONGO_DB_CONNECTION_URL, event_listeners=event_listeners, **client_options())
+        return self.client
+
+    def get_async_client(self) -> AsyncIOMotorClient:
+        if self.async_client is None:
+            self.async_client = AsyncIOMotorClient(MONGO_DB_CONNECTION_URL, event_listeners=event_listeners, **client_options())
+        return self.async_client
+
+    async def open(self):
+        client = self.get_async_client()
+        # Concurrent pings each check out a connection, leaving that many open in the pool
+        warm_connections = settings.mongo_warm_connections
+        if warm_connections is None:
+            warm_connections = settings.mongo_min_pool_size
+        await asyncio.gather(*(client.admin.command("ping") for _ in range(max(warm_connections, 1))))
+        self.ready = True
+        logger.info('Connected to MongoDB with %d warm connections', max(warm_connections, 1))
+
+    async def ping(self) -> bool:
+        try:
+            await asyncio.wait_for(self.get_async_client().admin.command("ping"), settings.readiness_timeout_seconds)
+            return True
+        except Exception as e:
+            logger.warning('MongoDB ping failed: %r', e)
+            return False
+
+    def close(self):
+        self.ready = False
+        for client in (self.client, self.async_client):
+            if client is not None:
+                client.close()
+        self.client = self.async_client = None
+
+
+mongo = MongoClients()
+
+
+class LazyDatabase:
+    """Database of the current client, looked up on use so modules can import it before the client exists"""
+
+    def __init__(self, get_client):
+        self._get_client = get_client
+
+    def _resolve(self):
+        return self._get_client()[settings.mongo_database]
+
+    def __getitem__(self, name):
+        return self._resolve()[name]
+
+    def __getattr__(self, attribute):
+        return getattr(self._resolve(), attribute)
+
+
+class LazyCollection:
+    """Collection of the current client, looked up on use like LazyDatabase"""
+
+    def __init__(self, get_client, name: str):
+        self._get_client = get_client
+        self._name = name
+        self._bound = (None, None)
+
+    def __getattr__(self, attribute):
+        client = self._get_client()
+        bound_client, collection = self._bound
+        if client is not bound_client:
+            # The collection object is kept until the client is replaced
+            collection = client[settings.mongo_database][self._name]
+            self._bound = (client, collection)
+        return getattr(collection, attribute)
+
+
+database = LazyDatabase(mongo.get_client)
+
+movies_collection = LazyCollection(mongo.get_client, "movies")
+users_collection = LazyCollection(mongo.get_client, "users")
+comments_collection = LazyCollection(mongo.get_client, "comments")
+ratings_collection = LazyCollection(mongo.get_client, "ratings")
+leaderboard_collection = LazyCollection(mongo.get_client, "leaderboard")
+similar_movies_collection = LazyCollection(mongo.get_client, "similar_movies")
+
+# Async client used by the API routes, the sync one above stays for scripts and tests
+
+async_database = LazyDatabase(mongo.get_async_client)
+
+async_movies_collection = LazyCollection(mongo.get_async_client, "movies")
+async_users_collection = LazyCollection(mongo.get_async_client, "users")
+async_comments_collection = LazyCollection(mongo.get_async_client, "comments")
+async_ratings_collection = LazyCollection(mongo.get_async_client, "ratings")
+async_leaderboard_collection = LazyCollection(mongo.get_async_client, "leaderboard")
+async_similar_movies_collection = LazyCollection(mongo.get_async_client, "similar_movies")
+async_rating_batches_collection = LazyCollection(mongo.get_async_client, "rating_batches")
@@ -0,0 +1,68 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response
+
+from settings import settings
+
+# max-age of the Cache-Control sent on movie reads, clients revalidate with the ETag afterwards
+HTTP_CACHE_MAX_AGE = settings.http_cache_max_age
+
+
+def _utc(value) -> datetime:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    # Mongo hands back naive datetimes, they are UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def movie_etag(movie: dict) -> str:
+    return f'"{movie.get("version", 0)}"'
+
+
+def listing_etag(request: Request, validators: list, media_type: str = "application/json") -> str:
+    """Strong ETag of a listing, from the request URL, the version of every movie it depends on and its media type
+
+    The JSON and NDJSON bodies of one URL, picked by Accept, are different representations.
+    """
+    digest = hashlib.sha1(request.url.path.encode())
+    digest.update(str(sorted(request.query_params.multi_items())).encode())
+    digest.update(media_type.encode())
+    for validator in validators:
+        digest.update(f'{validator["_id"]}:{validator.get("version", 0)};'.encode())
+    return f'"{digest.hexdigest()[:24]}"'
+
+
+def cache_headers(etag: str, updated_at: list = ()) -> dict:
+    """ETag, Last-Modified and Cache-Control of a read, `updated_at` holds the change dates it depends on
+
+    Pages of movies pass none: deleting one of their movies does not move the newest updated_at
+    forward, so a Last-Modified built from it would answer If-Modified-Since with a stale 304.
+    """
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={HTTP_CACHE_MAX_AGE}, must-revalidate",
+        "Vary": "Accept",
+    }
+    updated_at = [_utc(value) for value in updated_at if value]
+    if updated_at:
+        headers["Last-Modified"] = format_datetime(max(updated_at).replace(microsecond=0), usegmt=True)
+    return headers
+
+
+def not_modified(request: Request, headers: dict):
+    """304 response when the client's copy is still current, None otherwise"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, as RFC 9110 asks for If-None-Match
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        matched = "*" in tags or headers["ETag"] in tags
+    elif request.headers.get("if-modified-since") and "Last-Modified" in headers:
+        try:
+            matched = parsedate_to_datetime(headers["Last-Modified"]) <= _utc(parsedate_to_datetime(request.headers["if-modified-since"]))
+        except (TypeError, ValueError):
+            matched = False
+    else:
+        matched = False
+    return Response(status_code=304, headers=headers) if matched else None
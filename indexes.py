@@ -0,0 +1,151 @@
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+
+from leaderboards import LEADERBOARD_TRENDING_WINDOWS, trending_field
+from logger import get_logger
+from movie_detail import DETAIL_FIELDS, DETAIL_INCLUDES, movie_detail_pipeline
+from pagination import encode_cursor, encode_key_cursor, keyset_query
+from search import text_search_pipeline, title_prefix_query
+from serializer import movie_projection
+
+logger = get_logger(__name__)
+
+# Lifetime of the rating_batches documents, far longer than a write-behind batch is retried
+RATING_BATCH_TTL_SECONDS = 24 * 3600
+
+
+# Every index the app relies on, per collection of database.py. Applied at startup with
+# create_indexes, which is a no-op for indexes that already exist with the same spec.
+INDEXES = {
+    "movies": [
+        IndexModel([("title", TEXT), ("description", TEXT)], name="title_description_text", weights={"title": 10, "description": 1}),
+        IndexModel([("title_key", ASCENDING), ("_id", ASCENDING)], name="title_key_id"),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    "comments": [
+        IndexModel([("movie_id", ASCENDING), ("_id", ASCENDING)], name="movie_id_id"),
+    ],
+    "ratings": [
+        IndexModel([("movie_id", ASCENDING), ("_id", ASCENDING)], name="movie_id_id"),
+    ],
+    "leaderboard": [
+        IndexModel([("score", DESCENDING)], name="score"),
+        *(IndexModel([(trending_field(days), DESCENDING)], name=trending_field(days)) for days in LEADERBOARD_TRENDING_WINDOWS),
+    ],
+    "leaderboard_comment_days": [
+        IndexModel([("_id.day", ASCENDING)], name="day"),
+    ],
+    # Write-behind batches applied to a movie's rating aggregates, read by (batch_id, movie_id) _id
+    "rating_batches": [
+        IndexModel([("applied_at", ASCENDING)], name="applied_at_ttl", expireAfterSeconds=RATING_BATCH_TTL_SECONDS),
+    ],
+    # Read by _id, computed_at finds the entries a full refresh did not rewrite
+    "similar_movies": [
+        IndexModel([("computed_at", ASCENDING)], name="computed_at"),
+    ],
+}
+
+
+def query_shapes(movie_id: str = None):
+    """The queries issued by crud.py and async_crud.py, as (collection, filter or pipeline, sort)
+
+    They are built with the same helpers the services use, with placeholder values and cursors, so a
+    query changed there is checked as it is issued. Aggregations come as a pipeline with no sort.
+    `movie_id` keys the shapes read by movie, an existing one lets the $lookup of the detail run.
+    Maintenance-only queries (such as the rating aggregate rebuild) are meant to scan and are left out.
+    """
+    movie_id = movie_id or str(ObjectId())
+    cursor = encode_cursor(ObjectId())
+    return [
+        ("movies", {"_id": ObjectId(movie_id)}, None),
+        ("movies", {"_id": {"$in": [ObjectId(movie_id), ObjectId()]}}, None),
+        ("movies", keyset_query({}), [("_id", ASCENDING)]),
+        ("movies", keyset_query({}, cursor), [("_id", ASCENDING)]),
+        ("movies", title_prefix_query("title"), [("title_key", ASCENDING), ("_id", ASCENDING)]),
+        ("movies", title_prefix_query("title", encode_key_cursor("title", ObjectId())), [("title_key", ASCENDING), ("_id", ASCENDING)]),
+        ("movies", text_search_pipeline("title", 20, movie_projection), None),
+        ("movies", text_search_pipeline("title", 20, movie_projection, encode_key_cursor(1.0, ObjectId())), None),
+        ("movies", movie_detail_pipeline(movie_id, DETAIL_FIELDS, DETAIL_INCLUDES, 5), None),
+        ("users", {"username": "username"}, None),
+        ("comments", keyset_query({"movie_id": movie_id}), [("_id", ASCENDING)]),
+        ("comments", keyset_query({"movie_id": movie_id}, cursor), [("_id", ASCENDING)]),
+        ("ratings", keyset_query({"movie_id": movie_id}), [("_id", ASCENDING)]),
+        ("ratings", keyset_query({"movie_id": movie_id}, cursor), [("_id", ASCENDING)]),
+        ("similar_movies", {"_id": movie_id}, None),
+        ("leaderboard", {"rating_count": {"$gt": 0}}, [("score", DESCENDING)]),
+        *(
+            ("leaderboard", {trending_field(days): {"$gt": 0}}, [(trending_field(days), DESCENDING)])
+            for days in LEADERBOARD_TRENDING_WINDOWS
+        ),
+    ]
+
+
+def apply_indexes(database):
+    for collection_name, indexes in INDEXES.items():
+        if indexes:
+            database[collection_name].create_indexes(indexes)
+    logger.info('Indexes applied')
+
+
+async def apply_indexes_async(database):
+    for collection_name, indexes in INDEXES.items():
+        if indexes:
+            await database[collection_name].create_indexes(indexes)
+    logger.info('Indexes applied')
+
+
+def _plan_stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _plan_stages(value)
+
+
+def _winning_plans(explain):
+    """Winning plans anywhere in an explain output, an aggregation has one per stage reading a collection"""
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == "winningPlan":
+                yield value
+            else:
+                yield from _winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from _winning_plans(value)
+
+
+def _lookup_collection_scans(explain) -> int:
+    """Collection scans the $lookup stages of an aggregation ran, which their explain reports outside of any plan"""
+    if isinstance(explain, dict):
+        return explain.get("collectionScans", 0) + sum(_lookup_collection_scans(value) for value in explain.values())
+    if isinstance(explain, list):
+        return sum(_lookup_collection_scans(value) for value in explain)
+    return 0
+
+
+def find_collection_scans(database):
+    """Explains every query shape and returns the ones whose winning plan does a COLLSCAN"""
+    movie = database["movies"].find_one({}, {"_id": 1})
+    collection_scans = []
+    for collection_name, query, sort in query_shapes(str(movie["_id"]) if movie else None):
+        if isinstance(query, list):
+            # executionStats runs the pipeline, which is what makes the $lookup report how it read comments
+            explain = database.command(
+                "explain", {"aggregate": collection_name, "pipeline": query, "cursor": {}}, verbosity="executionStats",
+            )
+            scanned = _lookup_collection_scans(explain) > 0
+        else:
+            cursor = database[collection_name].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            explain = cursor.explain()["queryPlanner"]
+            scanned = False
+        if scanned or any("COLLSCAN" in _plan_stages(plan) for plan in _winning_plans(explain)):
+            collection_scans.append((collection_name, query, sort))
+    return collection_scans
@@ -0,0 +1,209 @@
+"""Top rated and trending leaderboards, materialized in the leaderboard collection.
+
+`refresh_leaderboards` folds the ratings and comments written since its last run into the
+leaderboard with $merge pipelines, so reads never aggregate the ratings or comments collections:
+
+- ratings add to each movie's rating_count/rating_sum, and its score is the Bayesian average
+  (rating_sum + m * C) / (rating_count + m), C being the mean of every rating and m LEADERBOARD_PRIOR_WEIGHT
+- comments are counted per movie and day in leaderboard_comment_days, and summed over each
+  window of LEADERBOARD_TRENDING_WINDOWS into a comments_<days>d field of the leaderboard
+
+Documents are picked by the time of their ObjectId, up to LEADERBOARD_SETTLE_SECONDS ago so a write
+still in flight is not skipped. Run it periodically with `python manage.py refresh-leaderboards`.
+
+A run records the end of its range in the state document before merging anything, and each merged
+document records the range it last took in. A run that crashed halfway is finished by the next one,
+over the same range, without counting again what it had already merged.
+"""
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+from fastapi import HTTPException
+
+from logger import get_logger
+from settings import settings
+
+logger = get_logger(__name__)
+
+# Weight m of the prior in the Bayesian average, in ratings: a movie needs about m ratings to move away from the mean
+LEADERBOARD_PRIOR_WEIGHT = settings.leaderboard_prior_weight
+# Trending windows in days, the first one is the default of GET /movies/trending
+LEADERBOARD_TRENDING_WINDOWS = [int(days) for days in settings.leaderboard_trending_windows.split(",")]
+# Age under which writes are left for the next refresh
+LEADERBOARD_SETTLE_SECONDS = settings.leaderboard_settle_seconds
+# Change of the global mean rating after which every score is recomputed, not only those of newly rated movies
+LEADERBOARD_RESCORE_DRIFT = settings.leaderboard_rescore_drift
+
+LEADERBOARD = "leaderboard"
+COMMENT_DAYS = "leaderboard_comment_days"
+STATE = "leaderboard_state"
+STATE_ID = "leaderboard"
+
+
+def trending_field(window_days: int) -> str:
+    if window_days not in LEADERBOARD_TRENDING_WINDOWS:
+        raise HTTPException(status_code=400, detail=f"Trending window must be one of {LEADERBOARD_TRENDING_WINDOWS} days")
+    return f"comments_{window_days}d"
+
+
+def score_stage(mean: float) -> dict:
+    return {"$set": {
+        "average_rating": {"$divide": ["$rating_sum", "$rating_count"]},
+        "score": {"$divide": [
+            {"$add": ["$rating_sum", LEADERBOARD_PRIOR_WEIGHT * mean]},
+            {"$add": ["$rating_count", LEADERBOARD_PRIOR_WEIGHT]},
+        ]},
+    }}
+
+
+def movie_title_stages() -> list:
+    """Adds the movie title to documents keyed by movie_id, dropping those of deleted movies"""
+    return [
+        {"$lookup": {
+            "from": "movies",
+            "let": {"movie_id": {"$convert": {"input": "$_id", "to": "objectId", "onError": None}}},
+            "pipeline": [{"$match": {"$expr": {"$eq": ["$_id", "$$movie_id"]}}}, {"$project": {"title": 1}}],
+            "as": "movie",
+        }},
+        {"$match": {"movie": {"$ne": []}}},
+        {"$set": {"title": {"$first": "$movie.title"}}},
+        {"$unset": "movie"},
+    ]
+
+
+def add_once(field: str, marker: str) -> dict:
+    """Adds the new value of `field` unless the document already took in the range named by `marker`"""
+    return {"$cond": [
+        {"$eq": [f"${marker}", f"$$new.{marker}"]},
+        f"${field}",
+        {"$add": [{"$ifNull": [f"${field}", 0]}, f"$$new.{field}"]},
+    ]}
+
+
+def ratings_pipeline(id_range: dict, mean: float) -> list:
+    return [
+        {"$match": {"_id": id_range}},
+        {"$group": {"_id": "$movie_id", "rating_count": {"$sum": 1}, "rating_sum": {"$sum": "$rating"}}},
+        *movie_title_stages(),
+        # Scores of movies entering the leaderboard, the ones already there are rescored on merge
+        score_stage(mean),
+        {"$set": {"ratings_until": id_range["$lt"]}},
+        {"$merge": {
+            "into": LEADERBOARD,
+            "on": "_id",
+            "whenMatched": [
+                {"$set": {
+                    "title": "$$new.title",
+                    "rating_count": add_once("rating_count", "ratings_until"),
+                    "rating_sum": add_once("rating_sum", "ratings_until"),
+                    "ratings_until": "$$new.ratings_until",
+                }},
+                score_stage(mean),
+            ],
+            "whenNotMatched": "insert",
+        }},
+    ]
+
+
+def comment_days_pipeline(id_range: dict) -> list:
+    return [
+        {"$match": {"_id": id_range}},
+        {"$group": {
+            "_id": {"movie_id": "$movie_id", "day": {"$dateTrunc": {"date": {"$toDate": "$_id"}, "unit": "day"}}},
+            "count": {"$sum": 1},
+        }},
+        {"$set": {"comments_until": id_range["$lt"]}},
+        {"$merge": {
+            "into": COMMENT_DAYS,
+            "on": "_id",
+            "whenMatched": [{"$set": {"count": add_once("count", "comments_until"), "comments_until": "$$new.comments_until"}}],
+            "whenNotMatched": "insert",
+        }},
+    ]
+
+
+def window_starts(now: datetime) -> dict:
+    """First day counted in each trending window, today being its last"""
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return {days: today - timedelta(days=days - 1) for days in LEADERBOARD_TRENDING_WINDOWS}
+
+
+def trending_pipeline(starts: dict, now: datetime) -> list:
+    return [
+        {"$match": {"_id.day": {"$gte": min(starts.values())}}},
+        {"$group": {
+            "_id": "$_id.movie_id",
+            **{
+                trending_field(days): {"$sum": {"$cond": [{"$gte": ["$_id.day", start]}, "$count", 0]}}
+                for days, start in starts.items()
+            },
+        }},
+        *movie_title_stages(),
+        {"$set": {"trending_refreshed_at": now}},
+        {"$merge": {"into": LEADERBOARD, "on": "_id", "whenMatched": "merge", "whenNotMatched": "insert"}},
+    ]
+
+
+def refresh_leaderboards(database, now: datetime = None) -> dict:
+    """Folds the ratings and comments written since the last refresh into the leaderboard
+
+    Returns how many ratings and comments were read.
+    """
+    now = now or datetime.now(timezone.utc)
+    # Mongo keeps milliseconds, trending_refreshed_at is matched against this value afterwards
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    state = database[STATE].find_one({"_id": STATE_ID}) or {}
+    # A pending range is one a previous run did not finish, it is taken again as it was
+    until = state.get("pending_until")
+    if until is None:
+        until = ObjectId.from_datetime(now - timedelta(seconds=LEADERBOARD_SETTLE_SECONDS))
+        database[STATE].update_one({"_id": STATE_ID}, {"$set": {"pending_until": until}}, upsert=True)
+    id_range = {"$lt": until}
+    if state.get("until"):
+        id_range["$gte"] = state["until"]
+
+    new_ratings = next(database["ratings"].aggregate([
+        {"$match": {"_id": id_range}},
+        {"$group": {"_id": None, "count": {"$sum": 1}, "sum": {"$sum": "$rating"}}},
+    ]), {"count": 0, "sum": 0})
+    rating_count = state.get("rating_count", 0) + new_ratings["count"]
+    rating_sum = state.get("rating_sum", 0) + new_ratings["sum"]
+    mean = rating_sum / rating_count if rating_count else 0
+    if new_ratings["count"]:
+        database["ratings"].aggregate(ratings_pipeline(id_range, mean))
+    if abs(mean - state.get("scored_mean", mean)) > LEADERBOARD_RESCORE_DRIFT:
+        database[LEADERBOARD].update_many({"rating_count": {"$gt": 0}}, [score_stage(mean)])
+        scored_mean = mean
+    else:
+        scored_mean = state.get("scored_mean", mean)
+
+    new_comments = database["comments"].count_documents({"_id": id_range})
+    if new_comments:
+        database["comments"].aggregate(comment_days_pipeline(id_range))
+    # Windows slide every day, so trending counts are recomputed from the day buckets even without new comments
+    starts = window_starts(now)
+    database[COMMENT_DAYS].aggregate(trending_pipeline(starts, now))
+    trending_fields = [trending_field(days) for days in starts]
+    database[LEADERBOARD].update_many(
+        {"trending_refreshed_at": {"$ne": now}, "$or": [{field: {"$gt": 0}} for field in trending_fields]},
+        {"$set": {field: 0 for field in trending_fields}},
+    )
+    database[COMMENT_DAYS].delete_many({"_id.day": {"$lt": min(starts.values())}})
+
+    database[STATE].update_one(
+        {"_id": STATE_ID},
+        {
+            "$set": {"until": until, "rating_count": rating_count, "rating_sum": rating_sum, "scored_mean": scored_mean},
+            "$unset": {"pending_until": ""},
+        },
+        upsert=True,
+    )
+    logger.info('Leaderboards refreshed with %d ratings and %d comments', new_ratings["count"], new_comments)
+    return {"ratings": new_ratings["count"], "comments": new_comments}
+
+
+def rebuild_leaderboards(database, now: datetime = None) -> dict:
+    """Drops the leaderboards and refreshes them from every rating and comment"""
+    for collection_name in (LEADERBOARD, COMMENT_DAYS, STATE):
+        database[collection_name].delete_many({})
+    return refresh_leaderboards(database, now)
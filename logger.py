@@ -1,18 +1,105 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import threading
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    # filename = 'log.txt',
-    format = "%(asctime)s %(levelname)s %(name)s %(message)s"
-    )
+import orjson
+
+from settings import settings
+
+# Level of every logger, and overrides for some of them, e.g. "pymongo=WARNING,passlib=WARNING"
+LOG_LEVEL = settings.log_level.upper()
+LOG_LEVELS = settings.log_levels
+# json (one object per line) or text
+LOG_FORMAT = settings.log_format
+# Only one of every N INFO/DEBUG records of a given message is written, warnings and errors always are
+LOG_SAMPLE_EVERY = settings.log_sample_every
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "sample_every", 1) > 1:
+            entry["sample_every"] = record.sample_every
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through the 1st, (N+1)th, (2N+1)th... INFO/DEBUG record of each message
+
+    Records are counted by their unformatted message, so a message logged once is always written.
+    """
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record) -> bool:
+        if self.every <= 1 or record.levelno > logging.INFO:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        record.sample_every = self.every
+        return count % self.every == 0
 
-def get_logger(name):
-    return logging.getLogger(name)
 
-logger = logging.getLogger(__name__)
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, so the message is formatted by the listener thread
 
-logger.debug("This message will be recorded.")
-logger.info("This message will be recorded.")
-logger.warning("This message will be recorded.")
-logger.error("This message will be recorded.")
-logger.critical("This message will be recorded.")
\ No newline at end of file
+    The stock QueueHandler formats it in the logging thread, i.e. on the request path.
+    """
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            # Tracebacks hold frames, render them before the record leaves this thread
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def configure_logging() -> logging.handlers.QueueListener:
+    """Sends every record through a queue to a listener thread that writes it to stderr"""
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    for override in filter(None, LOG_LEVELS.split(",")):
+        name, level = override.split("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Flushes what is still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
+
+
+listener = configure_logging()
+
+
+def get_logger(name):
+    return logging.getLogger(name)
@@ -1,29 +1,134 @@
-from fastapi import FastAPI, HTTPException, status, Depends
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException, status, Depends, Header, Query, Request, Response
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
+import orjson
 from fastapi.security import OAuth2PasswordRequestForm
-from crud import movie_crud_service, user_crud_service, comment_crud_service, rating_crud_service
 from schema import MovieCreate, MovieUpdate, UserInDb,UserCreate, UserBase, CommentCreate, RatingCreate
-from auth import pwd_context, authenticate_user, create_access_token, get_current_user
+from auth import authenticate_user, create_access_token, get_current_user
+from repositories import get_repository, repository
+from leaderboards import LEADERBOARD_TRENDING_WINDOWS
+from search import SEARCH_MODES
+from movie_detail import DETAIL_FIELDS, DETAIL_INCLUDES, DETAIL_COMMENTS_MAX_LIMIT, parse_selector
+from recommendations import SIMILAR_MOVIES_K
+from serializer import MOVIE_ENRICHMENTS
+from crud import parse_movie_ids
+from pagination import MAX_PAGE_SIZE
+import passwords
+from write_behind import RATING_WRITE_BEHIND, rating_write_behind
+from http_cache import movie_etag, listing_etag, cache_headers, not_modified
 from logger import get_logger
+import metrics
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    passwords.start()
+    await repository.open()
+    if RATING_WRITE_BEHIND:
+        rating_write_behind.start(repository.ratings)
+    yield
+    # Queued ratings are written before the clients close
+    await rating_write_behind.stop()
+    repository.close()
+    passwords.shutdown()
+
+# Read routes return ORJSONResponse themselves so their payload skips jsonable_encoder,
+# the other routes still go through it but are rendered with orjson too
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(metrics.MetricsMiddleware)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Largest batch accepted by the bulk ingestion routes
+BULK_MAX_ITEMS = 1000
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def ndjson_response(documents, headers: dict = None) -> StreamingResponse:
+    """Streams serialized documents one JSON line at a time, as the cursor yields them"""
+    async def lines():
+        async for document in documents:
+            yield orjson.dumps(document) + b"\n"
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+
+def validate_batch(items: List[dict], schema):
+    """Validates each item of a bulk request on its own
+
+    Returns the valid items with their index, and the result list with the invalid items filled in.
+    """
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ITEMS} items per request")
+    valid, results = [], [None] * len(items)
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, schema.model_validate(item)))
+        except ValidationError as e:
+            results[index] = {"index": index, "status": "invalid", "errors": e.errors(include_url=False, include_context=False)}
+    return valid, results
+
+
+def bulk_response(valid: list, results: list, written: list) -> dict:
+    for (index, _), result in zip(valid, written):
+        results[index] = {"index": index, **result}
+    created = sum(1 for result in results if result["status"] == "created")
+    return {"created": created, "failed": len(results) - created, "data": results}
+
+
+def parse_if_match(if_match: Optional[str]) -> Optional[int]:
+    """Movie version expected by an If-Match header, None when the write is unconditional"""
+    if not if_match or if_match.strip() == "*":
+        return None
+    # If-Match compares strongly, a weak tag never matches
+    if if_match.strip().startswith("W/"):
+        raise HTTPException(status_code=412, detail="Movie was modified since it was fetched")
+    try:
+        return int(if_match.strip().strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=412, detail="Movie was modified since it was fetched")
+
+
+def parse_enrichments(with_: Optional[str]) -> tuple:
+    """What ?with= asks the movie listings to attach to each movie, nothing when it is not given"""
+    return parse_selector(with_, MOVIE_ENRICHMENTS, "with") if with_ else ()
 
 logger = get_logger(__name__)
 
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    # Liveness: the process answers, whatever the state of Mongo
+    return {"status": "ok"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz(repository=Depends(get_repository)):
+    # Readiness: startup finished and Mongo answers, so the worker can take traffic
+    if not await repository.ping():
+        return ORJSONResponse({"status": "unavailable"}, status_code=503)
+    return {"status": "ok"}
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/signup")
-def signup(user: UserCreate):
-    db_user = user_crud_service.get_user_by_username(username=user.username)
-    logger.info('Creating user....')
-    if db_user:
-        logger.warning(f"user with {user.username} already exists")
-        raise HTTPException(status_code=400, detail="Username already registered")
-    hashed_password = pwd_context.hash(user.password)
-    created_user = user_crud_service.user_create(user_data=user, hashed_password=hashed_password)
-    logger.info('user successfully created')
+async def signup(user: UserCreate, repository=Depends(get_repository)):
+    # Checked before hashing so a taken username does not cost a bcrypt run,
+    # the unique index still rejects a concurrent signup with the same name on insert
+    if await repository.users.get_user_by_username(user.username):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already registered")
+    hashed_password = await passwords.hash_password(user.password)
+    created_user = await repository.users.user_create(user_data=user, hashed_password=hashed_password)
+    logger.info('User %s created', user.username)
     return {"message": "User created successfully", "user": created_user}
 
 @app.post("/login")
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), repository=Depends(get_repository)):
+    user = await authenticate_user(form_data.username, form_data.password, repository.users)
     if not user:
         raise HTTPException(
             status_code=401,
@@ -31,93 +136,208 @@ def login(form_data: OAuth2PasswordRequestForm = Depends()):
             headers={"WWW-Authenticate": "Bearer"},
         )
     access_token = create_access_token(data={"sub": user.get('username')})
-    logger.info('Access token generated')
+    logger.info('Access token generated for %s', user.get('username'))
     return {"access_token": access_token, "token_type": "bearer", "user_id": user.get('id')}
 
 
 @app.post("/movies")
-def create_movie(movie_data: MovieCreate, user: dict = Depends(get_current_user)):
+async def create_movie(movie_data: MovieCreate, user: dict = Depends(get_current_user), repository=Depends(get_repository)):
     # Attach the current user's ID to the movie data
-    logger.info('Movie user_id data')
     movie_data.user_id = user['id']
-    movie = movie_crud_service.movie_create(movie_data, user)
-    logger.info('Movie created successfully')
+    movie = await repository.movies.movie_create(movie_data, user)
+    logger.info('Movie %s created', movie["id"])
     return {"message": "Movie created successfully", "data": movie}
 
+@app.post("/movies/bulk")
+async def create_movies_bulk(movies_data: List[dict], user: dict = Depends(get_current_user), repository=Depends(get_repository)):
+    valid, results = validate_batch(movies_data, MovieCreate)
+    written = await repository.movies.bulk_create_movies([movie for _, movie in valid], user) if valid else []
+    logger.info('%d movies bulk inserted', len(written))
+    return bulk_response(valid, results, written)
+
 @app.get("/movies")
-def get_all_movies(skip: int = 0, limit: int = 5):
-    movies = movie_crud_service.get_all_movies(skip, limit)
-    return {"data": movies}
+async def get_all_movies(request: Request, limit: int = Query(5, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, skip: Optional[int] = Query(None, ge=0), ids: Optional[str] = None, with_: Optional[str] = Query(None, alias="with"), repository=Depends(get_repository)):
+    enrichments = parse_enrichments(with_)
+    if ids is not None:
+        # The movies of a list page the client already knows, all read with one $in query
+        movies = await repository.movies.get_movies_by_ids(parse_movie_ids(ids), enrichments)
+        headers = cache_headers(listing_etag(request, [{"_id": movie["id"], "version": movie["version"]} for movie in movies]))
+        response = not_modified(request, headers)
+        if response:
+            return response
+        return ORJSONResponse({"data": movies}, headers=headers)
+    # A conditional GET is answered from the versions of the page, before loading it
+    validators = await repository.movies.get_movies_page_validators(limit, cursor, skip)
+    headers = cache_headers(listing_etag(request, validators))
+    response = not_modified(request, headers)
+    if response:
+        return response
+    # Passing skip keeps the legacy skip/limit paging, otherwise pages are keyed on _id
+    if skip is not None:
+        movies = await repository.movies.get_all_movies(skip, limit, enrichments)
+        return ORJSONResponse({"data": movies}, headers=headers)
+    movies, next_cursor = await repository.movies.get_movies_page(limit, cursor, enrichments, validators)
+    return ORJSONResponse({"data": movies, "next_cursor": next_cursor}, headers=headers)
+
+# Search and leaderboards are declared before /movies/{movie_id} so their paths are not taken for ids
+@app.get("/movies/search")
+async def search_movies(q: str, mode: str = "text", limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, with_: Optional[str] = Query(None, alias="with"), repository=Depends(get_repository)):
+    # text ranks on title and description by relevance, prefix completes the start of a title
+    if mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"Search mode must be one of {', '.join(SEARCH_MODES)}")
+    movies, next_cursor = await repository.movies.search_movies(q, mode, limit, cursor, parse_enrichments(with_))
+    return ORJSONResponse({"data": movies, "next_cursor": next_cursor})
+
+@app.get("/movies/top")
+async def get_top_movies(limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE), repository=Depends(get_repository)):
+    movies = await repository.leaderboards.get_top_movies(limit)
+    return ORJSONResponse({"data": movies})
+
+@app.get("/movies/trending")
+async def get_trending_movies(window: int = LEADERBOARD_TRENDING_WINDOWS[0], limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE), repository=Depends(get_repository)):
+    movies = await repository.leaderboards.get_trending_movies(window, limit)
+    return ORJSONResponse({"data": movies, "window_days": window})
 
 @app.get("/movies/{movie_id}")
-def get_movies_by_id(movie_id: str):
-    movie = movie_crud_service.get_movies_by_id(movie_id)
+async def get_movies_by_id(movie_id: str, request: Request, repository=Depends(get_repository)):
+    # A conditional GET is answered from the movie version, before loading it
+    validator = await repository.movies.get_movie_validators(movie_id)
+    if not validator:
+        return ORJSONResponse({"message": "movie not found"})
+    response = not_modified(request, cache_headers(movie_etag(validator), [validator.get("updated_at")]))
+    if response:
+        return response
+    movie = await repository.movies.get_movies_by_id(movie_id, validator)
     if not movie:
-        return {"message": "movie not found"}
-    logger.info('Movie generated with ID')
-    return {"data": movie}
+        return ORJSONResponse({"message": "movie not found"})
+    headers = cache_headers(movie_etag(movie), [movie["updated_at"]])
+    logger.info('Movie %s read', movie_id)
+    return ORJSONResponse({"data": movie}, headers=headers)
+
+
+@app.get("/movies/{movie_id}/detail")
+async def get_movie_detail(movie_id: str, request: Request, fields: Optional[str] = None, include: Optional[str] = None, comments_limit: int = Query(5, ge=1, le=DETAIL_COMMENTS_MAX_LIMIT), repository=Depends(get_repository)):
+    # Movie, rating summary and first comments of a movie page in one aggregation,
+    # fields= and include= narrow it down to what the client renders
+    fields = parse_selector(fields, DETAIL_FIELDS, "fields")
+    include = parse_selector(include, DETAIL_INCLUDES, "include")
+    detail = await repository.movies.get_movie_detail(movie_id, fields, include, comments_limit)
+    if not detail:
+        raise HTTPException(status_code=404, detail="Movie not found")
+    # Comment and rating writes bump the movie version too, so it covers every section
+    headers = cache_headers(listing_etag(request, [{"_id": detail["id"], "version": detail["version"]}]), [detail["updated_at"]])
+    response = not_modified(request, headers)
+    if response:
+        return response
+    return ORJSONResponse({"data": detail}, headers=headers)
+
+
+@app.get("/movies/{movie_id}/similar")
+async def get_similar_movies(movie_id: str, limit: int = Query(10, ge=1, le=SIMILAR_MOVIES_K), repository=Depends(get_repository)):
+    # One read of the neighbors kept by `python manage.py refresh-similar-movies`
+    movies = await repository.movies.get_similar_movies(movie_id, limit)
+    if movies is None:
+        raise HTTPException(status_code=404, detail="Movie not found")
+    return ORJSONResponse({"data": movies})
+
+
+async def movie_child_cache_headers(movie_id: str, request: Request, movies, media_type: str = "application/json") -> dict:
+    """Cache headers of a read of a movie's comments or ratings, which bump the movie version when written"""
+    validator = await movies.get_movie_validators(movie_id)
+    if not validator:
+        return {}
+    return cache_headers(listing_etag(request, [validator], media_type), [validator.get("updated_at")])
 
 
 @app.put("/movies/{movie_id}")
-def update_movie(movie_id: str, movie_update_data: MovieUpdate, user: UserInDb = Depends(get_current_user)):
-    # Fetch the movie to check ownership
-    movie = movie_crud_service.get_movies_by_id(movie_id)
-    if not movie:
+async def update_movie(movie_id: str, movie_update_data: MovieUpdate, response: Response, user: UserInDb = Depends(get_current_user), if_match: Optional[str] = Header(None), repository=Depends(get_repository)):
+    # Ownership and If-Match are checked by the update itself
+    updated_movie = await repository.movies.update_movie(movie_id, movie_update_data, user, parse_if_match(if_match))
+    if not updated_movie:
         raise HTTPException(status_code=404, detail="Movie not found")
-    
-    if movie["user_id"] != user["id"]:
-        logger.warning("user not authorized")
-        raise HTTPException(status_code=403, detail="Not authorized to update this movie")
-    
-    
-    updated_movie = movie_crud_service.update_movie(movie_id, movie_update_data, user)
-    logger.info('Movie Updated Successfully with movie_update_data')
+    response.headers["ETag"] = movie_etag(updated_movie)
+    logger.info('Movie %s updated', movie_id)
     return {"message": "Movie updated successfully", "data": updated_movie}
 
 
 @app.delete("/movies/{movie_id}")
-def delete_movie(movie_id: str, user: UserInDb = Depends(get_current_user)):
-    # Fetch the movie to check ownership
-    logger.info('User_id used for deleting')
-    movie = movie_crud_service.get_movies_by_id(movie_id)
-    if not movie:
+async def delete_movie(movie_id: str, user: UserInDb = Depends(get_current_user), if_match: Optional[str] = Header(None), repository=Depends(get_repository)):
+    if not await repository.movies.delete_movie(movie_id, user, parse_if_match(if_match)):
         raise HTTPException(status_code=404, detail="Movie not found")
-    
-    if movie["user_id"] != user["id"]:
-        logger.warning("user not authorized")
-        raise HTTPException(status_code=403, detail="Not authorized to delete this movie")
-    
-    movie_crud_service.delete_movie(movie_id, user)
-    logger.info('Movie deleted successfully')
+    logger.info('Movie %s deleted', movie_id)
     return {"message": "Movie deleted successfully"}
 
 
 @app.post("/movies/{movie_id}/comments")
-def create_comment(movie_id: str, comment_data: CommentCreate, user: UserBase = Depends(get_current_user)):
-    comment = comment_crud_service.create_comment(comment_data, user, movie_id)
-    logger.info(f'Comment created for {user} in {movie_id} Successfully')
+async def create_comment(movie_id: str, comment_data: CommentCreate, user: UserBase = Depends(get_current_user), repository=Depends(get_repository)):
+    comment = await repository.comments.create_comment(comment_data, user, movie_id)
+    logger.info('Comment created in movie %s', movie_id)
     return {"message": "Comment created successfully", "data": comment}
 
+@app.post("/movies/{movie_id}/comments/bulk")
+async def create_comments_bulk(movie_id: str, comments_data: List[dict], user: UserBase = Depends(get_current_user), repository=Depends(get_repository)):
+    valid, results = validate_batch(comments_data, CommentCreate)
+    written = await repository.comments.bulk_create_comments([comment for _, comment in valid], user, movie_id) if valid else []
+    logger.info('%d comments bulk inserted in movie %s', len(written), movie_id)
+    return bulk_response(valid, results, written)
+
 @app.get("/movies/{movie_id}/comments")
-def get_comments_by_movie(movie_id: str):
-    comments = comment_crud_service.get_comments_by_movie(movie_id)
-    return {"data": comments}
+async def get_comments_by_movie(movie_id: str, request: Request, limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, stream: bool = False, repository=Depends(get_repository)):
+    ndjson = stream or wants_ndjson(request)
+    headers = await movie_child_cache_headers(movie_id, request, repository.movies, NDJSON_MEDIA_TYPE if ndjson else "application/json")
+    response = headers and not_modified(request, headers)
+    if response:
+        return response
+    if ndjson:
+        return ndjson_response(repository.comments.stream_comments_by_movie(movie_id), headers)
+    comments, next_cursor = await repository.comments.get_comments_page(movie_id, limit, cursor)
+    return ORJSONResponse({"data": comments, "next_cursor": next_cursor}, headers=headers)
 
 
 @app.post("/movies/{movie_id}/ratings")
-def create_rating(movie_id: str, rating_data: RatingCreate, user: UserBase = Depends(get_current_user)):
-    rating = rating_crud_service.create_rating(rating_data, user, movie_id)
-    logger.info(f'Rating Created for {user} in {movie_id} Successfully')
+async def create_rating(movie_id: str, rating_data: RatingCreate, response: Response, user: UserBase = Depends(get_current_user), repository=Depends(get_repository)):
+    if rating_write_behind.running:
+        # Acknowledged once queued, the rating and the movie aggregates are written with the next batch
+        rating = rating_write_behind.submit(rating_data, user, movie_id)
+        response.status_code = 202
+        return {"message": "Rating accepted", "data": rating}
+    rating = await repository.ratings.create_rating(rating_data, user, movie_id)
+    logger.info('Rating created in movie %s', movie_id)
     return {"message": "Rating created successfully", "data": rating}
 
+@app.post("/movies/{movie_id}/ratings/bulk")
+async def create_ratings_bulk(movie_id: str, ratings_data: List[dict], user: UserBase = Depends(get_current_user), repository=Depends(get_repository)):
+    valid, results = validate_batch(ratings_data, RatingCreate)
+    written = await repository.ratings.bulk_create_ratings([rating for _, rating in valid], user, movie_id) if valid else []
+    logger.info('%d ratings bulk inserted in movie %s', len(written), movie_id)
+    return bulk_response(valid, results, written)
+
 @app.get("/movies/{movie_id}/ratings")
-def get_ratings_by_movie(movie_id: str):
-    ratings = rating_crud_service.get_ratings_by_movie(movie_id)
-    if not ratings:
-        return {"data": []}
-    # Calculate the average rating
-    average_rating = sum(rating["rating"] for rating in ratings) / len(ratings)
-    return {"data": ratings, "average_rating": average_rating}
+async def get_ratings_by_movie(movie_id: str, request: Request, repository=Depends(get_repository)):
+    headers = await movie_child_cache_headers(movie_id, request, repository.movies)
+    response = headers and not_modified(request, headers)
+    if response:
+        return response
+    # Average and distribution are read from the aggregates kept on the movie document
+    summary = await repository.movies.get_rating_summary(movie_id)
+    if not summary:
+        return ORJSONResponse({"message": "movie not found"})
+    return ORJSONResponse({"data": summary, "average_rating": summary["average_rating"]}, headers=headers)
+
+@app.get("/movies/{movie_id}/ratings/list")
+async def list_ratings_by_movie(movie_id: str, request: Request, limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None, skip: Optional[int] = Query(None, ge=0), stream: bool = False, repository=Depends(get_repository)):
+    ndjson = stream or wants_ndjson(request)
+    headers = await movie_child_cache_headers(movie_id, request, repository.movies, NDJSON_MEDIA_TYPE if ndjson else "application/json")
+    response = headers and not_modified(request, headers)
+    if response:
+        return response
+    if ndjson:
+        return ndjson_response(repository.ratings.stream_ratings_by_movie(movie_id), headers)
+    if skip is not None:
+        ratings = await repository.ratings.get_ratings_by_movie(movie_id, skip, limit)
+        return ORJSONResponse({"data": ratings}, headers=headers)
+    ratings, next_cursor = await repository.ratings.get_ratings_page(movie_id, limit, cursor)
+    return ORJSONResponse({"data": ratings, "next_cursor": next_cursor}, headers=headers)
 
 
 
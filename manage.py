@@ -0,0 +1,108 @@
+"""Maintenance commands for the movie app database.
+
+Usage:
+    python manage.py rebuild-rating-aggregates --batch-size 1000
+    python manage.py apply-indexes
+    python manage.py check-query-plans
+    python manage.py strip-child-arrays --batch-size 1000
+    python manage.py refresh-leaderboards [--full]
+    python manage.py refresh-similar-movies [--full]
+    python manage.py backfill-title-keys --batch-size 1000
+"""
+import argparse
+import sys
+
+from crud import movie_crud_service, rating_crud_service
+from database import database
+from indexes import apply_indexes, find_collection_scans
+from leaderboards import refresh_leaderboards, rebuild_leaderboards
+from logger import get_logger
+from recommendations import refresh_similar_movies
+
+logger = get_logger(__name__)
+
+
+def rebuild_rating_aggregates(args):
+    movies_rebuilt = rating_crud_service.rebuild_rating_aggregates(args.batch_size)
+    logger.info('Rating aggregates rebuilt for %d movies', movies_rebuilt)
+
+
+def apply_indexes_command(args):
+    apply_indexes(database)
+
+
+def check_query_plans(args):
+    collection_scans = find_collection_scans(database)
+    for collection_name, query, sort in collection_scans:
+        logger.error('COLLSCAN on %s for filter %s sort %s', collection_name, query, sort)
+    if collection_scans:
+        sys.exit(1)
+    logger.info('Every query shape is served by an index')
+
+
+def strip_child_arrays(args):
+    movies_migrated = movie_crud_service.strip_child_id_arrays(args.batch_size)
+    logger.info('Comment and rating id arrays removed from %d movies', movies_migrated)
+
+
+def backfill_title_keys(args):
+    movies_backfilled = movie_crud_service.backfill_title_keys(args.batch_size)
+    logger.info('title_key set on %d movies', movies_backfilled)
+
+
+def refresh_leaderboards_command(args):
+    # Incremental by default, --full recomputes from every rating and comment
+    if args.full:
+        rebuild_leaderboards(database)
+    else:
+        refresh_leaderboards(database)
+
+
+def refresh_similar_movies_command(args):
+    counts = refresh_similar_movies(database, full=args.full)
+    logger.info('Similar movies written for %d movies', counts["movies"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Movie app maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    aggregates_parser = subparsers.add_parser(
+        "rebuild-rating-aggregates",
+        help="Recompute rating_count, rating_sum and rating_histogram from the ratings collection, with rating writes stopped",
+    )
+    aggregates_parser.add_argument("--batch-size", type=int, default=1000, help="movies rebuilt per bulk write")
+    aggregates_parser.set_defaults(handler=rebuild_rating_aggregates)
+    subparsers.add_parser(
+        "apply-indexes", help="Create the indexes declared in indexes.py"
+    ).set_defaults(handler=apply_indexes_command)
+    subparsers.add_parser(
+        "check-query-plans", help="Explain every query shape of crud.py and fail on a COLLSCAN"
+    ).set_defaults(handler=check_query_plans)
+    strip_parser = subparsers.add_parser(
+        "strip-child-arrays", help="Remove the comments/ratings id arrays from movie documents and backfill comment_count"
+    )
+    strip_parser.add_argument("--batch-size", type=int, default=1000, help="movies migrated per bulk write")
+    strip_parser.set_defaults(handler=strip_child_arrays)
+    leaderboards_parser = subparsers.add_parser(
+        "refresh-leaderboards", help="Fold the ratings and comments written since the last run into the top rated and trending leaderboards"
+    )
+    leaderboards_parser.add_argument("--full", action="store_true", help="rebuild the leaderboards from scratch")
+    leaderboards_parser.set_defaults(handler=refresh_leaderboards_command)
+    similar_parser = subparsers.add_parser(
+        "refresh-similar-movies", help="Recompute the similar movies of the movies affected by the ratings written since the last run"
+    )
+    similar_parser.add_argument("--full", action="store_true", help="recompute every movie and drop the entries of deleted ones")
+    similar_parser.set_defaults(handler=refresh_similar_movies_command)
+    title_keys_parser = subparsers.add_parser(
+        "backfill-title-keys", help="Set the normalized title_key used by prefix search on movies that lack it"
+    )
+    title_keys_parser.add_argument("--batch-size", type=int, default=1000, help="movies updated per bulk write")
+    title_keys_parser.set_defaults(handler=backfill_title_keys)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+from bisect import bisect_right, insort
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+from fastapi import HTTPException, status
+
+from cache import principal_cache
+from crud import touch_movie, ratings_aggregate_increments, bulk_results, movie_update, movie_write_allowed, movie_changes, movie_changed_by, raise_for_missed_movie_write, new_movie_document, new_user_document, new_comment_document, new_rating_document
+from leaderboards import LEADERBOARD_PRIOR_WEIGHT, trending_field
+from pagination import decode_cursor, decode_key_cursor, keyset_page
+from recommendations import SIMILAR_MOVIES_K, compute_similar_movies, neighbor_document
+from schema import MovieCreate, MovieUpdate, UserCreate, UserUpdate, UserBase, UserInDb, CommentCreate, RatingCreate
+from search import normalize_title
+from serializer import movie_serializer, user_serializer, comment_serializer, rating_serializer, user_serializer_password, rating_summary_serializer, movie_detail_serializer, enriched_movie_serializer, leaderboard_serializer
+
+# In-process versions of the services in async_crud.py, over plain dicts instead of Mongo.
+# Documents are built and serialized by the same helpers as in crud.py, so responses are the
+# same as with Mongo. Used by tests and to benchmark the app without a database.
+
+# Text search weights of the text index in indexes.py. Words are matched whole, without Mongo's stemming
+TITLE_WEIGHT = 10
+DESCRIPTION_WEIGHT = 1
+
+
+def _parent(document: dict, path: str):
+    *parents, key = path.split(".")
+    for name in parents:
+        document = document.setdefault(name, {})
+    return document, key
+
+
+def apply_update(document: dict, update: dict):
+    """Applies the $set, $inc, $unset and $currentDate operators crud.py builds, dotted paths included"""
+    for path, value in update.get("$set", {}).items():
+        parent, key = _parent(document, path)
+        parent[key] = value
+    for path, amount in update.get("$inc", {}).items():
+        parent, key = _parent(document, path)
+        parent[key] = parent.get(key, 0) + amount
+    for path in update.get("$unset", {}):
+        parent, key = _parent(document, path)
+        parent.pop(key, None)
+    for path in update.get("$currentDate", {}):
+        parent, key = _parent(document, path)
+        parent[key] = datetime.now(timezone.utc)
+
+
+def after_cursor(documents: list, cursor: str = None) -> list:
+    """Documents sorted on _id that come after the keyset cursor"""
+    if not cursor:
+        return documents
+    return documents[bisect_right(documents, decode_cursor(cursor), key=lambda document: document["_id"]):]
+
+
+def after_key_cursor(documents: list, key: str, cursor: str = None, descending: bool = False) -> list:
+    """Documents sorted on (key, _id) that come after the keyset cursor"""
+    if not cursor:
+        return documents
+    last_key, last_id = decode_key_cursor(cursor)
+    return [
+        document for document in documents
+        if (document[key] < last_key if descending else document[key] > last_key)
+        or (document[key] == last_key and document["_id"] > last_id)
+    ]
+
+
+class MemoryStore:
+    """The collections, with the indexes the services look documents up by"""
+
+    def __init__(self):
+        self.movies = {}
+        # Movie ids in order, for the listing pages
+        self.movie_ids = []
+        # Unique index on username
+        self.users = {}
+        # Comments and ratings by movie_id, each list in _id order
+        self.comments = {}
+        self.ratings = {}
+        # Neighbors of the movies read since the last rating or movie write, by movie_id
+        self.similar_movies = {}
+
+    def movie(self, movie_id: str):
+        return self.movies.get(ObjectId(movie_id)) if ObjectId.is_valid(movie_id) else None
+
+    def update_movie(self, movie_id: str, update: dict):
+        movie = self.movies.get(ObjectId(movie_id))
+        if movie is not None:
+            apply_update(movie, update)
+
+
+class MemoryMovieService:
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    def _insert(self, movie_document: dict):
+        self.store.movies[movie_document["_id"]] = movie_document
+        insort(self.store.movie_ids, movie_document["_id"])
+        self.store.similar_movies.clear()
+
+    def _listing(self) -> list:
+        return [self.store.movies[movie_id] for movie_id in self.store.movie_ids]
+
+    async def movie_create(self, movie_data: MovieCreate, user: UserBase):
+        movie_document = new_movie_document(movie_data, user)
+        self._insert(movie_document)
+        return movie_serializer(movie_document)
+
+    async def bulk_create_movies(self, movies_data: list, user: UserBase):
+        movie_documents = [new_movie_document(movie_data, user) for movie_data in movies_data]
+        for movie_document in movie_documents:
+            self._insert(movie_document)
+        return bulk_results(movie_documents, {}, movie_serializer)
+
+    async def get_all_movies(self, skip: int = 0, limit: int = 5, enrichments: tuple = ()):
+        serializer = enriched_movie_serializer(enrichments)
+        return [serializer(movie) for movie in self._listing()[skip:skip + limit]]
+
+    async def get_movies_page(self, limit: int = 5, cursor: str = None, enrichments: tuple = (), validators: list = None):
+        return keyset_page(after_cursor(self._listing(), cursor)[:limit + 1], limit, enriched_movie_serializer(enrichments))
+
+    async def get_movies_by_ids(self, movie_ids: list, enrichments: tuple = ()):
+        serializer = enriched_movie_serializer(enrichments)
+        return [serializer(self.store.movies[movie_id]) for movie_id in movie_ids if movie_id in self.store.movies]
+
+    async def search_movies(self, q: str, mode: str = "text", limit: int = 20, cursor: str = None, enrichments: tuple = ()):
+        terms = normalize_title(q).split()
+        if not terms:
+            raise HTTPException(status_code=400, detail="Search query is empty")
+        if mode == "prefix":
+            prefix = " ".join(terms)
+            movies = sorted(
+                (movie for movie in self.store.movies.values() if movie.get("title_key", "").startswith(prefix)),
+                key=lambda movie: (movie["title_key"], movie["_id"]),
+            )
+            movies = after_key_cursor(movies, "title_key", cursor)
+            return keyset_page(movies[:limit + 1], limit, enriched_movie_serializer(enrichments), key="title_key")
+        movies = []
+        for movie in self.store.movies.values():
+            title_words = set(normalize_title(movie.get("title")).split())
+            description_words = set(normalize_title(movie.get("description")).split())
+            score = sum(TITLE_WEIGHT * (term in title_words) + DESCRIPTION_WEIGHT * (term in description_words) for term in terms)
+            if score:
+                movies.append({**movie, "text_score": score})
+        movies.sort(key=lambda movie: (-movie["text_score"], movie["_id"]))
+        movies = after_key_cursor(movies, "text_score", cursor, descending=True)
+        return keyset_page(movies[:limit + 1], limit, enriched_movie_serializer(enrichments), key="text_score")
+
+    async def get_movies_by_id(self, movie_id: str, validator: dict = None):
+        movie = self.store.movie(movie_id)
+        return movie_serializer(movie) if movie else None
+
+    async def get_movie_detail(self, movie_id: str, fields: tuple, include: tuple, comments_limit: int = 5):
+        movie = self.store.movie(movie_id)
+        if not movie:
+            return None
+        comments = self.store.comments.get(movie_id, [])[:comments_limit + 1]
+        return movie_detail_serializer({**movie, "comments": comments}, fields, include, comments_limit)
+
+    async def get_similar_movies(self, movie_id: str, limit: int = 10):
+        # Computed from every rating on the first read after a rating or movie write instead of by the batch job
+        if not ObjectId.is_valid(movie_id) or not self.store.movie(movie_id):
+            return None
+        if movie_id not in self.store.similar_movies:
+            ratings = sorted((rating for ratings in self.store.ratings.values() for rating in ratings), key=lambda rating: rating["_id"])
+            titles = {str(movie["_id"]): movie.get("title") for movie in self.store.movies.values()}
+            neighbors = compute_similar_movies(ratings, titles, SIMILAR_MOVIES_K, [movie_id]).get(movie_id, [])
+            self.store.similar_movies[movie_id] = neighbor_document(neighbors, titles, None)["neighbors"]
+        return self.store.similar_movies[movie_id][:limit]
+
+    async def get_movie_validators(self, movie_id: str):
+        movie = self.store.movie(movie_id)
+        if movie:
+            return {"_id": movie["_id"], "version": movie.get("version"), "updated_at": movie.get("updated_at")}
+        return None
+
+    async def get_movies_page_validators(self, limit: int = 5, cursor: str = None, skip: int = None):
+        if skip is not None:
+            movies = self._listing()[skip:skip + limit]
+        else:
+            movies = after_cursor(self._listing(), cursor)[:limit + 1]
+        return [{"_id": movie["_id"], "version": movie.get("version"), "updated_at": movie.get("updated_at")} for movie in movies]
+
+    def _owned_movie(self, movie_id: str, user: UserInDb, version: int, action: str):
+        """The movie if the user may write it at `version`, like owned_movie_filter matches it"""
+        movie = self.store.movie(movie_id)
+        if movie is None:
+            return None
+        if not movie_write_allowed(movie, user, version):
+            raise_for_missed_movie_write(movie, user, action)
+        return movie
+
+    async def update_movie(self, movie_id: str, movie_update_in: MovieUpdate, user: UserInDb, version: int = None):
+        movie = self._owned_movie(movie_id, user, version, "update")
+        if movie is None:
+            return None
+        changes = movie_changes(movie_update_in)
+        # Like changed_movie_filter, an update changing nothing leaves the version as is
+        if movie_changed_by(movie, changes):
+            apply_update(movie, movie_update(changes))
+            # Neighbors carry the titles
+            self.store.similar_movies.clear()
+        return movie_serializer(movie)
+
+    async def delete_movie(self, movie_id: str, user: UserInDb, version: int = None):
+        movie = self._owned_movie(movie_id, user, version, "delete")
+        if movie is None:
+            return None
+        del self.store.movies[movie["_id"]]
+        self.store.movie_ids.remove(movie["_id"])
+        self.store.similar_movies.clear()
+        return True
+
+    async def get_rating_summary(self, movie_id: str):
+        movie = self.store.movie(movie_id)
+        return rating_summary_serializer(movie) if movie else None
+
+
+class MemoryUserService:
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    async def user_create(self, user_data: UserCreate, hashed_password: str):
+        if user_data.username in self.store.users:
+            raise HTTPException(detail="Username already registered", status_code=status.HTTP_400_BAD_REQUEST)
+        user_document = new_user_document(user_data, hashed_password)
+        self.store.users[user_data.username] = user_document
+        return user_serializer(user_document)
+
+    async def get_all_users(self, skip: int = 0, limit: int = 5):
+        return [user_serializer(user) for user in list(self.store.users.values())[skip:skip + limit]]
+
+    async def get_user_by_username(self, username: str):
+        user = self.store.users.get(username)
+        return user_serializer(user) if user else None
+
+    async def get_user_by_username_with_hash(self, username: str):
+        user = self.store.users.get(username)
+        return user_serializer_password(user) if user else None
+
+    async def update_user(self, username: str, user_data: UserUpdate):
+        user = self.store.users.get(username)
+        if not user:
+            return None
+        # The users dict is the unique index on username, a rename moves the user to its new key
+        if user_data.username != username:
+            if user_data.username in self.store.users:
+                raise HTTPException(detail="Username already registered", status_code=status.HTTP_400_BAD_REQUEST)
+            self.store.users[user_data.username] = self.store.users.pop(username)
+        user.update(user_data.model_dump(exclude_unset=True))
+        principal_cache.invalidate_user(username)
+        principal_cache.invalidate_user(user_data.username)
+        return user_serializer(user)
+
+    async def update_password_hash(self, username: str, hashed_password: str):
+        if username in self.store.users:
+            self.store.users[username]["hashed_password"] = hashed_password
+
+    async def delete_user(self, username: str):
+        user_deleted = self.store.users.pop(username, None)
+        principal_cache.invalidate_user(username)
+        return user_deleted
+
+
+class MemoryCommentService:
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    async def create_comment(self, comment_data: CommentCreate, user: UserBase, movie_id: str):
+        return (await self.bulk_create_comments([comment_data], user, movie_id))[0]["data"]
+
+    async def bulk_create_comments(self, comments_data: list, user: UserBase, movie_id: str):
+        comment_documents = [new_comment_document(comment_data, user, movie_id) for comment_data in comments_data]
+        self.store.comments.setdefault(movie_id, []).extend(comment_documents)
+        self.store.update_movie(movie_id, touch_movie({"$inc": {"comment_count": len(comment_documents)}}))
+        return bulk_results(comment_documents, {}, comment_serializer)
+
+    async def get_comments_by_movie(self, movie_id: str):
+        return [comment_serializer(comment) for comment in self.store.comments.get(movie_id, [])]
+
+    async def stream_comments_by_movie(self, movie_id: str):
+        for comment in list(self.store.comments.get(movie_id, [])):
+            yield comment_serializer(comment)
+
+    async def get_comments_page(self, movie_id: str, limit: int = 20, cursor: str = None):
+        comments = after_cursor(self.store.comments.get(movie_id, []), cursor)
+        return keyset_page(comments[:limit + 1], limit, comment_serializer)
+
+
+class MemoryRatingService:
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    async def create_rating(self, rating_data: RatingCreate, user: UserBase, movie_id: str):
+        return (await self.bulk_create_ratings([rating_data], user, movie_id))[0]["data"]
+
+    async def bulk_create_ratings(self, ratings_data: list, user: UserBase, movie_id: str):
+        rating_documents = [new_rating_document(rating_data, user, movie_id) for rating_data in ratings_data]
+        await self.write_ratings_batch(rating_documents, ObjectId())
+        return bulk_results(rating_documents, {}, rating_serializer)
+
+    async def write_ratings_batch(self, rating_documents: list, batch_id: ObjectId) -> int:
+        # A write to the store cannot fail halfway, so there is nothing for batch_id to guard
+        ratings_by_movie = {}
+        for document in rating_documents:
+            self.store.ratings.setdefault(document["movie_id"], []).append(document)
+            ratings_by_movie.setdefault(document["movie_id"], []).append(document["rating"])
+        for movie_id, ratings in ratings_by_movie.items():
+            self.store.update_movie(movie_id, touch_movie({"$inc": ratings_aggregate_increments(ratings)}))
+        self.store.similar_movies.clear()
+        return len(rating_documents)
+
+    async def get_ratings_by_movie(self, movie_id: str, skip: int = 0, limit: int = 20):
+        return [rating_serializer(rating) for rating in self.store.ratings.get(movie_id, [])[skip:skip + limit]]
+
+    async def stream_ratings_by_movie(self, movie_id: str):
+        for rating in list(self.store.ratings.get(movie_id, [])):
+            yield rating_serializer(rating)
+
+    async def get_ratings_page(self, movie_id: str, limit: int = 20, cursor: str = None):
+        ratings = after_cursor(self.store.ratings.get(movie_id, []), cursor)
+        return keyset_page(ratings[:limit + 1], limit, rating_serializer)
+
+
+class MemoryLeaderboardService:
+    # Computed from the store on each read, there is no refresh job to run
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    def _mean(self) -> float:
+        """Average of every rating, the prior the scores are pulled towards"""
+        rating_count = sum(movie.get("rating_count", 0) for movie in self.store.movies.values())
+        return sum(movie.get("rating_sum", 0) for movie in self.store.movies.values()) / rating_count if rating_count else 0
+
+    def _entry(self, movie: dict, mean: float) -> dict:
+        rating_count, rating_sum = movie.get("rating_count", 0), movie.get("rating_sum", 0)
+        return {
+            "_id": str(movie["_id"]),
+            "title": movie.get("title"),
+            "rating_count": rating_count,
+            "average_rating": rating_sum / rating_count if rating_count else None,
+            "score": (rating_sum + LEADERBOARD_PRIOR_WEIGHT * mean) / (rating_count + LEADERBOARD_PRIOR_WEIGHT),
+        }
+
+    async def get_top_movies(self, limit: int = 20):
+        mean = self._mean()
+        rated = [movie for movie in self.store.movies.values() if movie.get("rating_count", 0) > 0]
+        entries = sorted((self._entry(movie, mean) for movie in rated), key=lambda entry: -entry["score"])
+        return [leaderboard_serializer(entry) for entry in entries[:limit]]
+
+    async def get_trending_movies(self, window_days: int, limit: int = 20):
+        field = trending_field(window_days)
+        since = datetime.now(timezone.utc) - timedelta(days=window_days)
+        mean = self._mean()
+        entries = []
+        for movie in self.store.movies.values():
+            count = sum(1 for comment in self.store.comments.get(str(movie["_id"]), []) if comment["_id"].generation_time >= since)
+            if count:
+                entries.append({**self._entry(movie, mean), field: count})
+        entries.sort(key=lambda entry: -entry[field])
+        return [leaderboard_serializer(entry) for entry in entries[:limit]]
+
+
+class MemoryRepository:
+    """Every collection in this process's memory, empty when created"""
+
+    def __init__(self):
+        self.store = MemoryStore()
+        self.movies = MemoryMovieService(self.store)
+        self.users = MemoryUserService(self.store)
+        self.comments = MemoryCommentService(self.store)
+        self.ratings = MemoryRatingService(self.store)
+        self.leaderboards = MemoryLeaderboardService(self.store)
+
+    async def open(self):
+        pass
+
+    async def ping(self) -> bool:
+        return True
+
+    def close(self):
+        pass
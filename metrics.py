@@ -0,0 +1,212 @@
+import threading
+import time
+
+from pymongo import monitoring
+
+from logger import get_logger
+from settings import settings
+
+logger = get_logger(__name__)
+
+# Mongo commands slower than this are logged with their filter/pipeline
+MONGO_SLOW_QUERY_MS = settings.mongo_slow_query_ms
+
+# Seconds, from well under a millisecond (cached reads, pool checkouts) to the bcrypt routes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Parts of a slow command worth logging, documents written are left out
+SLOW_QUERY_FIELDS = ("filter", "sort", "projection", "pipeline", "limit", "skip", "updates", "deletes")
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """Labelled values of one metric, safe to update from the driver's threads"""
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _labels(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: tuple, extra: dict = None) -> str:
+        pairs = [*zip(self.labelnames, values), *(extra or {}).items()]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = list(self._values.items())
+        for values, value in items:
+            lines.extend(self._render_value(values, value))
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_value(self, values: tuple, value) -> list:
+        return [f"{self.name}{self._format_labels(values)} {value}"]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then the sum and the total count
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def _render_value(self, values: tuple, counts: list) -> list:
+        lines = [
+            f"{self.name}_bucket{self._format_labels(values, {'le': bound})} {count}"
+            for bound, count in zip(self.buckets, counts)
+        ]
+        lines.append(f"{self.name}_bucket{self._format_labels(values, {'le': '+Inf'})} {counts[-1]}")
+        lines.append(f"{self.name}_sum{self._format_labels(values)} {counts[-2]}")
+        lines.append(f"{self.name}_count{self._format_labels(values)} {counts[-1]}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Time to answer a request, until the last byte of the body", ["method", "route"]
+)
+http_requests = Counter("http_requests_total", "Requests answered, by status code", ["method", "route", "status"])
+mongo_command_duration = Histogram(
+    "mongo_command_duration_seconds", "Duration of the commands sent to Mongo", ["collection", "command"]
+)
+mongo_commands = Counter("mongo_commands_total", "Commands sent to Mongo, by outcome", ["collection", "command", "outcome"])
+mongo_pool_checkout_wait = Histogram(
+    "mongo_pool_checkout_wait_seconds", "Time spent waiting for a connection from the Mongo pool", ["outcome"]
+)
+
+cache_hits = Counter("cache_hits_total", "Lookups answered from a cache", ["cache"])
+cache_misses = Counter("cache_misses_total", "Lookups not found in a cache, or expired", ["cache"])
+cache_invalidations = Counter("cache_invalidations_total", "Invalidations after writes, each dropping one or more entries", ["cache"])
+
+rating_queue_depth = Gauge("rating_write_behind_queue_depth", "Ratings accepted and waiting to be written to Mongo")
+rating_flush_duration = Histogram("rating_write_behind_flush_seconds", "Time to write one batch of queued ratings")
+rating_write_behind_ratings = Counter(
+    "rating_write_behind_ratings_total", "Ratings through the write-behind queue, by outcome", ["outcome"]
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every request by route template, streamed bodies included"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_and_record(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            # The router puts the matched route in the scope, its path keeps ids out of the labels
+            route = scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            http_request_duration.observe(time.perf_counter() - start, method=scope["method"], route=route)
+            http_requests.inc(method=scope["method"], route=route, status=status)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Records each command's duration by collection, and logs the slow ones"""
+
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        collection = target if isinstance(target, str) else ""
+        details = {field: event.command[field] for field in SLOW_QUERY_FIELDS if field in event.command}
+        self._started[(event.connection_id, event.request_id)] = (collection, details)
+
+    def _finished(self, event, outcome: str):
+        collection, details = self._started.pop((event.connection_id, event.request_id), ("", {}))
+        duration = event.duration_micros / 1e6
+        mongo_command_duration.observe(duration, collection=collection, command=event.command_name)
+        mongo_commands.inc(collection=collection, command=event.command_name, outcome=outcome)
+        if duration * 1000 >= MONGO_SLOW_QUERY_MS:
+            logger.warning('Slow Mongo %s on %s: %.1f ms %.1000s', event.command_name, collection or event.database_name, duration * 1000, details)
+
+    def succeeded(self, event):
+        self._finished(event, "succeeded")
+
+    def failed(self, event):
+        self._finished(event, "failed")
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Records how long operations wait to get a pooled connection"""
+
+    def connection_checked_out(self, event):
+        mongo_pool_checkout_wait.observe(event.duration, outcome="checked_out")
+
+    def connection_check_out_failed(self, event):
+        mongo_pool_checkout_wait.observe(event.duration, outcome=event.reason)
+
+    # The other pool events are not measured
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_checked_in(self, event): pass
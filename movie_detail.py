@@ -0,0 +1,50 @@
+from bson.objectid import ObjectId
+from fastapi import HTTPException
+
+from serializer import comment_projection, rating_summary_projection
+
+# Everything a movie page shows, from one aggregation on movies: the movie fields, the rating
+# summary read from the aggregates kept on the movie, and its first comments joined with a
+# $lookup through the movie_id index of comments.
+
+# id, version and updated_at are always returned, the version is what If-Match expects
+DETAIL_FIELDS = ("title", "description", "user_id", "comment_count", "rating_count")
+DETAIL_INCLUDES = ("rating_summary", "comments")
+# Most comments a detail read embeds, the rest are paged from /movies/{movie_id}/comments
+DETAIL_COMMENTS_MAX_LIMIT = 100
+
+
+def parse_selector(value: str, allowed: tuple, name: str) -> tuple:
+    """Names picked by a comma separated query parameter, every allowed name when it is not given"""
+    if value is None:
+        return allowed
+    names = tuple(dict.fromkeys(part.strip() for part in value.split(",") if part.strip()))
+    unknown = [part for part in names if part not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown {name} {', '.join(unknown)}, must be among {', '.join(allowed)}")
+    return names
+
+
+def movie_detail_pipeline(movie_id: str, fields: tuple, include: tuple, comments_limit: int) -> list:
+    """Pipeline returning the movie with only what `fields` and `include` ask for
+
+    The comments are fetched with one extra to tell whether a next page exists.
+    """
+    projection = {"_id": 1, "version": 1, "updated_at": 1, **{field: 1 for field in fields}}
+    if "rating_summary" in include:
+        projection.update(rating_summary_projection)
+    pipeline = [{"$match": {"_id": ObjectId(movie_id)}}, {"$project": projection}]
+    if "comments" in include:
+        pipeline += [
+            # Comments keep the movie id as a string
+            {"$set": {"movie_key": {"$toString": "$_id"}}},
+            {"$lookup": {
+                "from": "comments",
+                "localField": "movie_key",
+                "foreignField": "movie_id",
+                "pipeline": [{"$sort": {"_id": 1}}, {"$limit": comments_limit + 1}, {"$project": comment_projection}],
+                "as": "comments",
+            }},
+            {"$unset": "movie_key"},
+        ]
+    return pipeline
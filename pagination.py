@@ -0,0 +1,74 @@
+import base64
+import binascii
+
+import orjson
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from fastapi import HTTPException
+
+
+# Keyset (cursor) pagination on _id. A page is read with {"_id": {"$gt": <last id>}} sorted
+# on _id, so Mongo seeks straight to it through the index instead of walking skipped documents,
+# and pages do not drift when documents are inserted or deleted between requests.
+# Listings sorted on another key first, such as search results, page on (key, _id) the same way.
+
+# Largest page a listing route accepts
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(last_id) -> str:
+    """Opaque cursor pointing after the document with the given _id"""
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> ObjectId:
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, InvalidId, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def encode_key_cursor(key, last_id) -> str:
+    """Opaque cursor pointing after the document with the given sort key and _id"""
+    return base64.urlsafe_b64encode(orjson.dumps([key, str(last_id)])).decode()
+
+
+def decode_key_cursor(cursor: str):
+    try:
+        key, last_id = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return key, ObjectId(last_id)
+    except (binascii.Error, orjson.JSONDecodeError, InvalidId, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_query(query: dict, cursor: str = None) -> dict:
+    """Adds the keyset condition for the page after `cursor` to a find filter"""
+    if cursor:
+        return {**query, "_id": {"$gt": decode_cursor(cursor)}}
+    return query
+
+
+def key_keyset_query(query: dict, key: str, cursor: str = None, descending: bool = False) -> dict:
+    """Adds the keyset condition for the page after `cursor` to a filter sorted on (key, _id)"""
+    if not cursor:
+        return query
+    last_key, last_id = decode_key_cursor(cursor)
+    after = "$lt" if descending else "$gt"
+    return {**query, "$or": [{key: {after: last_key}}, {key: last_key, "_id": {"$gt": last_id}}]}
+
+
+def keyset_page(documents: list, limit: int, serializer, key: str = None):
+    """Serializes a page fetched with limit + 1 documents and works out the next cursor
+
+    The extra document only tells whether another page exists, it is not returned.
+    `key` is the field sorted on before _id, if any.
+    """
+    has_more = len(documents) > limit
+    documents = documents[:limit]
+    if not has_more:
+        next_cursor = None
+    elif key:
+        next_cursor = encode_key_cursor(documents[-1][key], documents[-1]["_id"])
+    else:
+        next_cursor = encode_cursor(documents[-1]["_id"])
+    return [serializer(document) for document in documents], next_cursor
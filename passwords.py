@@ -0,0 +1,82 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from logger import get_logger
+from settings import settings
+
+logger = get_logger(__name__)
+
+# bcrypt cost factor. Hashes made with another cost are rehashed on the next successful login
+BCRYPT_ROUNDS = settings.bcrypt_rounds
+# Processes hashing/verifying passwords, i.e. how many bcrypt calls run at once
+PASSWORD_HASH_WORKERS = settings.password_hash_workers or os.cpu_count() or 1
+# Hash/verify jobs allowed in flight (running or queued) before auth routes answer 503
+PASSWORD_HASH_MAX_PENDING = settings.password_hash_max_pending if settings.password_hash_max_pending is not None else PASSWORD_HASH_WORKERS * 4
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+_executor = None
+_pending = 0
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+def start():
+    """Creates the process pool, called by the app's lifespan
+
+    Workers are spawned rather than forked: the app runs the motor and logging threads by then,
+    and a child forked from a multi-threaded process can deadlock on a lock one of them held.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    # Scripts and tests that hash without the app's lifespan get the pool on first use
+    start()
+    return _executor
+
+
+async def _run(function, *args):
+    """Runs a bcrypt job in the process pool, shedding load once too many are pending"""
+    global _pending
+    if _pending >= PASSWORD_HASH_MAX_PENDING:
+        logger.warning('Password hashing queue full, rejecting request')
+        raise HTTPException(status_code=503, detail="Server busy, try again later", headers={"Retry-After": "1"})
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_executor(), function, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _run(_hash, password)
+
+
+async def verify_password(password: str, hashed_password: str):
+    """Returns (valid, new_hash), new_hash is set when the hash was made with another cost factor"""
+    return await _run(_verify_and_update, password, hashed_password)
+
+
+def pending_jobs() -> int:
+    return _pending
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
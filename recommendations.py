@@ -0,0 +1,187 @@
+""""More like this" recommendations, materialized in the similar_movies collection.
+
+`refresh_similar_movies` reads the ratings into a sparse user x movie matrix and keeps, for each
+movie, its SIMILAR_MOVIES_K nearest movies by cosine similarity of their rating columns. The
+similarities are computed for SIMILAR_MOVIES_CHUNK_SIZE movies at a time, as one sparse matrix
+product per chunk, so memory grows with the chunk and not with the square of the catalog.
+GET /movies/{movie_id}/similar then reads one document by _id.
+
+After the first run, only the movies whose similarities can have changed are recomputed: those
+rated since the last run, and those sharing a rater with them. Ratings are picked by the time of
+their ObjectId, up to SIMILAR_MOVIES_SETTLE_SECONDS ago so a write still in flight is not skipped.
+Run it periodically with `python manage.py refresh-similar-movies`.
+"""
+from array import array
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo import ReplaceOne
+from scipy import sparse
+
+from logger import get_logger
+from settings import settings
+
+logger = get_logger(__name__)
+
+# Neighbors kept per movie, the most GET /movies/{movie_id}/similar can return
+SIMILAR_MOVIES_K = settings.similar_movies_k
+# Movies whose neighbors are computed by one matrix product
+SIMILAR_MOVIES_CHUNK_SIZE = settings.similar_movies_chunk_size
+# Age under which ratings are left for the next run
+SIMILAR_MOVIES_SETTLE_SECONDS = settings.similar_movies_settle_seconds
+
+SIMILAR_MOVIES = "similar_movies"
+STATE = "similar_movies_state"
+STATE_ID = "similar_movies"
+# Ratings fetched per round trip while building the matrix
+RATINGS_BATCH_SIZE = 10000
+
+
+class RatingsMatrix:
+    """Ratings as a sparse matrix with one row per user and one column per movie
+
+    `user_index`, `movie_index` and `values` hold the ratings in write order, `movie_ids` the movie
+    id of each column.
+    """
+
+    def __init__(self, user_index: np.ndarray, movie_index: np.ndarray, values: np.ndarray, movie_ids: list, users: int):
+        self.movie_ids = movie_ids
+        self.ratings = len(values)
+        # A user who rated a movie more than once counts with the last of their ratings
+        keys = user_index.astype(np.int64) * max(len(movie_ids), 1) + movie_index
+        _, last_reversed = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last_reversed
+        self.matrix = sparse.csc_matrix(
+            (values[last], (user_index[last], movie_index[last])), shape=(users, len(movie_ids)), dtype=np.float32
+        )
+
+    @classmethod
+    def from_ratings(cls, ratings):
+        """Matrix of rating documents, in the order they were written"""
+        users, movies = {}, {}
+        # Typed arrays hold millions of ratings in a few bytes each, unlike lists of Python objects
+        user_index, movie_index, values = array("i"), array("i"), array("f")
+        for rating in ratings:
+            user_index.append(users.setdefault(rating["user_id"], len(users)))
+            movie_index.append(movies.setdefault(rating["movie_id"], len(movies)))
+            values.append(rating.get("rating") or 0)
+        return cls(
+            np.frombuffer(user_index, dtype=np.int32), np.frombuffer(movie_index, dtype=np.int32),
+            np.frombuffer(values, dtype=np.float32), list(movies), len(users),
+        )
+
+    def normalized(self, eligible: np.ndarray):
+        """Columns scaled to unit length, zeroed for movies that may not be recommended"""
+        norms = np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=0)).ravel())
+        scale = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0) * eligible
+        return (self.matrix @ sparse.diags(scale.astype(np.float32))).tocsc()
+
+    def co_rated(self, movies: np.ndarray) -> np.ndarray:
+        """Movies sharing at least one rater with `movies`, them included"""
+        raters = np.unique(self.matrix[:, movies].indices)
+        return np.unique(self.matrix.tocsr()[raters].indices)
+
+
+def top_neighbors(normalized, movies: np.ndarray, k: int):
+    """Yields (movie, neighbors, scores) for each of `movies`, best neighbor first
+
+    The cosine similarities of the chunk are one sparse product of its columns with every column.
+    """
+    similarities = (normalized[:, movies].T @ normalized).tocsr()
+    for position, movie in enumerate(movies):
+        start, end = similarities.indptr[position], similarities.indptr[position + 1]
+        neighbors, scores = similarities.indices[start:end], similarities.data[start:end]
+        keep = (neighbors != movie) & (scores > 0)
+        neighbors, scores = neighbors[keep], scores[keep]
+        if len(scores) > k:
+            best = np.argpartition(-scores, k)[:k]
+            neighbors, scores = neighbors[best], scores[best]
+        order = np.lexsort((neighbors, -scores))
+        yield movie, neighbors[order], scores[order]
+
+
+def compute_similar_movies(ratings, titles: dict = None, k: int = SIMILAR_MOVIES_K, movies: list = None) -> dict:
+    """Neighbors of `movies` (every rated movie by default) as {movie_id: [(neighbor_id, score)]}
+
+    When `titles` is given, only movies in it are recommended or get neighbors.
+    """
+    matrix = RatingsMatrix.from_ratings(ratings)
+    eligible = np.array([titles is None or movie_id in titles for movie_id in matrix.movie_ids], dtype=np.float32)
+    if movies is None:
+        rows = np.flatnonzero(eligible)
+    else:
+        column = {movie_id: index for index, movie_id in enumerate(matrix.movie_ids)}
+        rows = np.array([column[movie_id] for movie_id in movies if movie_id in column], dtype=np.int32)
+    neighbors = {}
+    normalized = matrix.normalized(eligible)
+    for start in range(0, len(rows), SIMILAR_MOVIES_CHUNK_SIZE):
+        for movie, movie_neighbors, scores in top_neighbors(normalized, rows[start:start + SIMILAR_MOVIES_CHUNK_SIZE], k):
+            neighbors[matrix.movie_ids[movie]] = [(matrix.movie_ids[neighbor], float(score)) for neighbor, score in zip(movie_neighbors, scores)]
+    return neighbors
+
+
+def neighbor_document(neighbors: list, titles: dict, computed_at: datetime) -> dict:
+    return {
+        # Titles are copied so the endpoint reads nothing else, a renamed movie shows its new title after the next run
+        "neighbors": [{"movie_id": movie_id, "title": titles.get(movie_id), "score": round(score, 6)} for movie_id, score in neighbors],
+        "computed_at": computed_at,
+    }
+
+
+def refresh_similar_movies(database, full: bool = False, now: datetime = None) -> dict:
+    """Recomputes the neighbors of the movies affected by the ratings written since the last run
+
+    Every movie on the first run or with `full`. Returns how many ratings were read and movies written.
+    """
+    now = now or datetime.now(timezone.utc)
+    # Mongo keeps milliseconds, computed_at is matched against this value afterwards
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    state = {} if full else database[STATE].find_one({"_id": STATE_ID}) or {}
+    until = ObjectId.from_datetime(now - timedelta(seconds=SIMILAR_MOVIES_SETTLE_SECONDS))
+    since = state.get("until")
+
+    changed = None
+    if since is not None:
+        changed = [group["_id"] for group in database["ratings"].aggregate([
+            {"$match": {"_id": {"$gte": since, "$lt": until}}},
+            {"$group": {"_id": "$movie_id"}},
+        ])]
+        if not changed:
+            database[STATE].update_one({"_id": STATE_ID}, {"$set": {"until": until}}, upsert=True)
+            return {"ratings": 0, "movies": 0}
+
+    # Deleted movies are neither recommended nor given neighbors
+    titles = {str(movie["_id"]): movie.get("title") for movie in database["movies"].find({}, {"title": 1}).batch_size(RATINGS_BATCH_SIZE)}
+    matrix = RatingsMatrix.from_ratings(
+        database["ratings"].find({"_id": {"$lt": until}}, {"_id": 0, "user_id": 1, "movie_id": 1, "rating": 1})
+        .sort("_id", 1).batch_size(RATINGS_BATCH_SIZE)
+    )
+    eligible = np.array([movie_id in titles for movie_id in matrix.movie_ids], dtype=np.float32)
+    if changed is None:
+        rows = np.flatnonzero(eligible)
+    else:
+        column = {movie_id: index for index, movie_id in enumerate(matrix.movie_ids)}
+        changed_columns = np.array([column[movie_id] for movie_id in changed if movie_id in column], dtype=np.int32)
+        rows = matrix.co_rated(changed_columns)
+        rows = rows[eligible[rows] > 0]
+
+    normalized = matrix.normalized(eligible)
+    for start in range(0, len(rows), SIMILAR_MOVIES_CHUNK_SIZE):
+        database[SIMILAR_MOVIES].bulk_write([
+            ReplaceOne(
+                {"_id": matrix.movie_ids[movie]},
+                neighbor_document(
+                    [(matrix.movie_ids[neighbor], float(score)) for neighbor, score in zip(neighbors, scores)], titles, now
+                ),
+                upsert=True,
+            )
+            for movie, neighbors, scores in top_neighbors(normalized, rows[start:start + SIMILAR_MOVIES_CHUNK_SIZE], SIMILAR_MOVIES_K)
+        ], ordered=False)
+    if changed is None:
+        # Movies deleted or left without ratings since the last full run
+        database[SIMILAR_MOVIES].delete_many({"computed_at": {"$lt": now}})
+
+    database[STATE].update_one({"_id": STATE_ID}, {"$set": {"until": until}}, upsert=True)
+    logger.info('Similar movies of %d movies computed from %d ratings', len(rows), matrix.ratings)
+    return {"ratings": matrix.ratings, "movies": len(rows)}
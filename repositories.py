@@ -0,0 +1,114 @@
+from typing import AsyncIterator, Protocol
+
+from bson.objectid import ObjectId
+
+from async_crud import async_movie_crud_service, async_user_crud_service, async_comment_crud_service, async_rating_crud_service, async_leaderboard_crud_service
+from database import async_database, mongo
+from indexes import apply_indexes_async
+from memory_repository import MemoryRepository
+from schema import MovieCreate, MovieUpdate, UserCreate, UserUpdate, UserBase, UserInDb, CommentCreate, RatingCreate
+from settings import settings
+
+# The storage the API routes go through. A repository has the movies, users, comments, ratings
+# and leaderboards services below, and open / ping / close for the app's lifespan and readiness probe.
+#
+# mongo (default) is the motor services of async_crud.py. memory keeps everything in the process,
+# for tests and to benchmark the app layer apart from the database. Both implement every method of
+# the protocols, test_main.py checks their signatures match.
+REPOSITORY_BACKEND = settings.repository_backend
+
+
+class MovieService(Protocol):
+    async def movie_create(self, movie_data: MovieCreate, user: UserBase): ...
+    async def bulk_create_movies(self, movies_data: list, user: UserBase): ...
+    async def get_all_movies(self, skip: int = 0, limit: int = 5, enrichments: tuple = ()): ...
+    async def get_movies_page(self, limit: int = 5, cursor: str = None, enrichments: tuple = (), validators: list = None): ...
+    async def get_movies_by_ids(self, movie_ids: list, enrichments: tuple = ()): ...
+    async def search_movies(self, q: str, mode: str = "text", limit: int = 20, cursor: str = None, enrichments: tuple = ()): ...
+    async def get_movies_by_id(self, movie_id: str, validator: dict = None): ...
+    async def get_movie_detail(self, movie_id: str, fields: tuple, include: tuple, comments_limit: int = 5): ...
+    async def get_similar_movies(self, movie_id: str, limit: int = 10): ...
+    async def get_movie_validators(self, movie_id: str): ...
+    async def get_movies_page_validators(self, limit: int = 5, cursor: str = None, skip: int = None): ...
+    async def update_movie(self, movie_id: str, movie_update_in: MovieUpdate, user: UserInDb, version: int = None): ...
+    async def delete_movie(self, movie_id: str, user: UserInDb, version: int = None): ...
+    async def get_rating_summary(self, movie_id: str): ...
+
+
+class UserService(Protocol):
+    # update_user and delete_user drop the user's entries of the principal cache
+    async def user_create(self, user_data: UserCreate, hashed_password: str): ...
+    async def get_all_users(self, skip: int = 0, limit: int = 5): ...
+    async def get_user_by_username(self, username: str): ...
+    async def get_user_by_username_with_hash(self, username: str): ...
+    async def update_user(self, username: str, user_data: UserUpdate): ...
+    async def update_password_hash(self, username: str, hashed_password: str): ...
+    async def delete_user(self, username: str): ...
+
+
+class CommentService(Protocol):
+    async def create_comment(self, comment_data: CommentCreate, user: UserBase, movie_id: str): ...
+    async def bulk_create_comments(self, comments_data: list, user: UserBase, movie_id: str): ...
+    async def get_comments_by_movie(self, movie_id: str): ...
+    def stream_comments_by_movie(self, movie_id: str) -> AsyncIterator[dict]: ...
+    async def get_comments_page(self, movie_id: str, limit: int = 20, cursor: str = None): ...
+
+
+class RatingService(Protocol):
+    async def create_rating(self, rating_data: RatingCreate, user: UserBase, movie_id: str): ...
+    async def bulk_create_ratings(self, ratings_data: list, user: UserBase, movie_id: str): ...
+    async def write_ratings_batch(self, rating_documents: list, batch_id: ObjectId) -> int: ...
+    async def get_ratings_by_movie(self, movie_id: str, skip: int = 0, limit: int = 20): ...
+    def stream_ratings_by_movie(self, movie_id: str) -> AsyncIterator[dict]: ...
+    async def get_ratings_page(self, movie_id: str, limit: int = 20, cursor: str = None): ...
+
+
+class LeaderboardService(Protocol):
+    async def get_top_movies(self, limit: int = 20): ...
+    async def get_trending_movies(self, window_days: int, limit: int = 20): ...
+
+
+class Repository(Protocol):
+    movies: MovieService
+    users: UserService
+    comments: CommentService
+    ratings: RatingService
+    leaderboards: LeaderboardService
+
+    async def open(self): ...
+    async def ping(self) -> bool: ...
+    def close(self): ...
+
+
+class MongoRepository:
+    """The async_crud.py services, over the Mongo clients of database.py"""
+
+    movies = async_movie_crud_service
+    users = async_user_crud_service
+    comments = async_comment_crud_service
+    ratings = async_rating_crud_service
+    leaderboards = async_leaderboard_crud_service
+
+    async def open(self):
+        await mongo.open()
+        await apply_indexes_async(async_database)
+
+    async def ping(self) -> bool:
+        return mongo.ready and await mongo.ping()
+
+    def close(self):
+        mongo.close()
+
+
+def build_repository() -> Repository:
+    if REPOSITORY_BACKEND == "memory":
+        return MemoryRepository()
+    return MongoRepository()
+
+
+repository = build_repository()
+
+
+def get_repository() -> Repository:
+    """Repository of the routes, tests swap it through app.dependency_overrides"""
+    return repository
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional, List
 # from Comment import comment
 # from RatingBase import Rating
@@ -43,6 +43,8 @@ class Rating(RatingBase):
     pass 
 
 class RatingCreate(RatingBase):
+    # One to five stars, halves allowed
+    rating: float = Field(ge=1, le=5)
     movie_id: str
     pass
 
@@ -0,0 +1,41 @@
+import unicodedata
+
+from fastapi import HTTPException
+
+from pagination import key_keyset_query
+
+# Search on movies: full-text through the text index on title and description, ranked by
+# text score, or title prefix (autocomplete) through the ascending index on title_key.
+
+SEARCH_MODES = ("text", "prefix")
+
+
+def normalize_title(title: str) -> str:
+    """Case and accent insensitive form of a title, stored as title_key for prefix search"""
+    decomposed = unicodedata.normalize("NFKD", title or "")
+    without_accents = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(without_accents.casefold().split())
+
+
+def title_prefix_query(q: str, cursor: str = None) -> dict:
+    """Range filter on title_key for titles starting with `q`, which an index scan answers without a regex"""
+    prefix = normalize_title(q)
+    if not prefix:
+        raise HTTPException(status_code=400, detail="Search query is empty")
+    # Every key starting with the prefix sorts between the prefix and the prefix with its last character bumped
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return key_keyset_query({"title_key": {"$gte": prefix, "$lt": upper}}, "title_key", cursor)
+
+
+def text_search_pipeline(q: str, limit: int, projection: dict, cursor: str = None) -> list:
+    """Movies matching `q` in the text index, best text score first, with one extra to tell whether a next page exists"""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query is empty")
+    return [
+        {"$match": {"$text": {"$search": q}}},
+        {"$set": {"text_score": {"$meta": "textScore"}}},
+        {"$match": key_keyset_query({}, "text_score", cursor, descending=True)},
+        {"$sort": {"text_score": -1, "_id": 1}},
+        {"$limit": limit + 1},
+        {"$project": {**projection, "text_score": 1}},
+    ]
@@ -1,10 +1,32 @@
+from datetime import timezone
+
+from pagination import keyset_page
+
+# Projections with only the fields the matching serializer reads, so nothing else comes over the wire
+movie_projection = {"_id": 1, "title": 1, "description": 1, "user_id": 1, "version": 1, "updated_at": 1, "comment_count": 1, "rating_count": 1}
+movie_validator_projection = {"_id": 1, "version": 1, "updated_at": 1}
+user_projection = {"_id": 1, "username": 1, "full_name": 1}
+user_password_projection = {"_id": 1, "username": 1, "full_name": 1, "hashed_password": 1}
+rating_projection = {"_id": 1, "movie_id": 1, "user_id": 1, "rating": 1}
+rating_summary_projection = {"_id": 1, "rating_count": 1, "rating_sum": 1, "rating_histogram": 1}
+comment_projection = {"_id": 1, "movie_id": 1, "comment": 1, "updated_comment": 1}
+leaderboard_projection = {"rating_sum": 0, "trending_refreshed_at": 0, "ratings_until": 0}
+
+# Extra data the movie listings attach to each movie when asked with ?with=. Both come from the
+# aggregates kept on the movie document, so they are read with the page instead of once per movie.
+MOVIE_ENRICHMENTS = ("rating_summary", "comment_count")
+
 def movie_serializer(movie) -> dict:
     return {
         "id": str(movie["_id"]),
         "title": movie.get ("title"),
         "description": movie.get("description"),
-        "ratings": movie.get("ratings", []),
+        "comment_count": movie.get("comment_count", 0),
+        "rating_count": movie.get("rating_count", 0),
         "user_id": movie.get("user_id"),  # Assuming this field is stored in the movie document
+        "version": movie.get("version", 0),
+        # Mongo hands back naive datetimes, they are UTC
+        "updated_at": movie["updated_at"].replace(tzinfo=timezone.utc).isoformat() if movie.get("updated_at") else None,
     }
 
 # def movie_serializer(movie) -> dict:
@@ -44,6 +66,51 @@ def rating_serializer(rating) -> dict:
         "rating": rating.get("rating")
     }
     
+def rating_summary_serializer(movie) -> dict:
+    """Builds the rating summary of a movie from the aggregates kept on its document"""
+    rating_count = movie.get("rating_count", 0)
+    return {
+        "movie_id": str(movie.get("_id")),
+        "rating_count": rating_count,
+        "average_rating": movie.get("rating_sum", 0) / rating_count if rating_count else None,
+        "distribution": movie.get("rating_histogram", {}),
+    }
+
+def movie_detail_serializer(movie, fields: tuple, include: tuple, comments_limit: int) -> dict:
+    """Movie detail with the selected fields and sections, from a movie_detail_pipeline result"""
+    serialized = movie_serializer(movie)
+    detail = {key: serialized[key] for key in ("id", *fields, "version", "updated_at")}
+    if "rating_summary" in include:
+        detail["rating_summary"] = rating_summary_serializer(movie)
+    if "comments" in include:
+        detail["comments"], detail["comments_next_cursor"] = keyset_page(movie.get("comments", []), comments_limit, comment_serializer)
+    return detail
+
+def enriched_movie_projection(enrichments: tuple) -> dict:
+    if "rating_summary" in enrichments:
+        return {**movie_projection, **rating_summary_projection}
+    return movie_projection
+
+def enriched_movie_serializer(enrichments: tuple):
+    """Serializer of a movie listing asked for `enrichments`, comment_count is part of every movie already"""
+    if "rating_summary" not in enrichments:
+        return movie_serializer
+
+    def serialize(movie) -> dict:
+        return {**movie_serializer(movie), "rating_summary": rating_summary_serializer(movie)}
+    return serialize
+
+def leaderboard_serializer(entry) -> dict:
+    return {
+        "movie_id": entry["_id"],
+        "title": entry.get("title"),
+        "rating_count": entry.get("rating_count", 0),
+        "average_rating": entry.get("average_rating"),
+        "score": entry.get("score"),
+        # One comments_<days>d count per trending window
+        **{key: value for key, value in entry.items() if key.startswith("comments_")},
+    }
+    
 def comment_serializer(comment) -> dict:
     return {
         "comment_id": str(comment.get("_id")),
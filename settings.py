@@ -0,0 +1,76 @@
+from typing import Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    """Configuration of the app, from environment variables (case insensitive) or the .env file
+
+    The modules using a setting document it next to where they read it.
+    """
+
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+    # Storage behind the API routes, see repositories.py
+    repository_backend: str = "mongo"
+
+    # Mongo client, see database.py
+    mongo_db_connection_url: Optional[str] = None
+    mongo_database: str = "Movie_app"
+    mongo_max_pool_size: int = 100
+    mongo_min_pool_size: int = 0
+    mongo_max_idle_time_ms: Optional[int] = None
+    mongo_connect_timeout_ms: int = 10000
+    mongo_server_selection_timeout_ms: int = 5000
+    mongo_socket_timeout_ms: Optional[int] = None
+    mongo_wait_queue_timeout_ms: Optional[int] = None
+    mongo_read_preference: str = "primary"
+    mongo_write_concern: str = "1"
+    mongo_journal: Optional[bool] = None
+    mongo_warm_connections: Optional[int] = None
+    readiness_timeout_seconds: float = 2
+    mongo_slow_query_ms: float = 100
+
+    # Auth
+    secret_key: Optional[str] = None
+    algorithm: Optional[str] = None
+    access_token_expire_minutes: Optional[int] = None
+    bcrypt_rounds: int = 12
+    password_hash_workers: Optional[int] = None
+    password_hash_max_pending: Optional[int] = None
+
+    # Caches
+    principal_cache_size: int = 1024
+    principal_cache_ttl_seconds: float = 60
+    movie_cache_backend: str = "memory"
+    movie_cache_size: int = 1024
+    movie_cache_ttl_seconds: float = 30
+    movie_cache_redis_url: str = "redis://localhost:6379/0"
+    http_cache_max_age: int = 0
+
+    # Write-behind ratings, see write_behind.py
+    rating_write_behind: bool = False
+    rating_flush_interval_ms: float = 100
+    rating_flush_max_items: int = 500
+    rating_queue_size: int = 10000
+    rating_flush_retry_ms: float = 100
+
+    # Leaderboards
+    leaderboard_prior_weight: float = 10
+    leaderboard_trending_windows: str = "7,30"
+    leaderboard_settle_seconds: float = 5
+    leaderboard_rescore_drift: float = 0.01
+
+    # Similar movies, see recommendations.py
+    similar_movies_k: int = 20
+    similar_movies_chunk_size: int = 1000
+    similar_movies_settle_seconds: float = 5
+
+    # Logging
+    log_level: str = "INFO"
+    log_levels: str = ""
+    log_format: str = "json"
+    log_sample_every: int = 1
+
+
+settings = Settings()
@@ -1,11 +1,34 @@
-import pytest, random, string
+import pytest, random, string, json, asyncio
 from fastapi.testclient import TestClient
 from bson import ObjectId
+from pymongo import monitoring
+from motor.motor_asyncio import AsyncIOMotorClient
 from main import app
 from auth import get_current_user
+from database import MONGO_DB_CONNECTION_URL, mongo
+from schema import UserCreate, UserUpdate, MovieCreate, CommentCreate, RatingCreate
+import crud
+import async_crud
+import leaderboards
+import recommendations
+import metrics
+from search import normalize_title
+from pagination import MAX_PAGE_SIZE
+from serializer import leaderboard_serializer
+from datetime import datetime, timedelta, timezone
+from database import database
+from cache import PrincipalCache, ReadThroughCache, LocalCacheBackend, RedisCacheBackend, principal_cache
+from write_behind import RatingWriteBehind, rating_write_behind
+import inspect
+from repositories import REPOSITORY_BACKEND, get_repository, MongoRepository, MovieService, UserService, CommentService, RatingService, LeaderboardService
+from memory_repository import MemoryRepository
+from fastapi import HTTPException
 
 ## Note that for the tests to pass, a user will have to be signed up and logged in the app.
 
+# With REPOSITORY_BACKEND=memory the routes run without a database, these tests talk to Mongo directly
+requires_mongo = pytest.mark.skipif(REPOSITORY_BACKEND == "memory", reason="needs MongoDB")
+
 client = TestClient(app) 
 
 @pytest.fixture(scope="module")
@@ -165,3 +188,702 @@ def test_get_ratings_by_movie(client, test_user):
     data = response.json()
     assert data["average_rating"] == rating_data["rating"]
     
+
+def test_rating_summary_and_list(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    for rating in (4.0, 5.0, 5.0):
+        client.post(f"/movies/{movie_id}/ratings", json={"rating": rating, "movie_id": movie_id}, headers=headers)
+    response = client.get(f"/movies/{movie_id}/ratings")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["average_rating"] == pytest.approx(14.0 / 3)
+    assert data["data"]["rating_count"] == 3
+    assert data["data"]["distribution"] == {"4": 1, "5": 2}
+
+    response = client.get(f"/movies/{movie_id}/ratings/list", params={"limit": 2})
+    assert response.status_code == 200
+    assert len(response.json()["data"]) == 2
+
+def test_rating_range_and_stars(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    for rating in (0.5, 5.5):
+        response = client.post(f"/movies/{movie_id}/ratings", json={"rating": rating, "movie_id": movie_id}, headers=headers)
+        assert response.status_code == 422
+    for rating in (2.5, 3.5):
+        client.post(f"/movies/{movie_id}/ratings", json={"rating": rating, "movie_id": movie_id}, headers=headers)
+    # Halves go up, not to the even star
+    assert client.get(f"/movies/{movie_id}/ratings").json()["data"]["distribution"] == {"3": 1, "4": 1}
+
+def test_comments_cursor_pagination(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    for i in range(3):
+        client.post(f"/movies/{movie_id}/comments", json={"comment": f"comment {i}", "movie_id": movie_id}, headers=headers)
+    response = client.get(f"/movies/{movie_id}/comments", params={"limit": 2})
+    assert response.status_code == 200
+    first_page = response.json()
+    assert [c["comment"] for c in first_page["data"]] == ["comment 0", "comment 1"]
+    assert first_page["next_cursor"]
+
+    response = client.get(f"/movies/{movie_id}/comments", params={"limit": 2, "cursor": first_page["next_cursor"]})
+    second_page = response.json()
+    assert [c["comment"] for c in second_page["data"]] == ["comment 2"]
+    assert second_page["next_cursor"] is None
+
+def test_page_size_is_validated(client):
+    movie_id = str(ObjectId())
+    for path in ("/movies", "/movies/top", "/movies/trending", f"/movies/{movie_id}/comments", f"/movies/{movie_id}/ratings/list"):
+        for limit in (0, -1, MAX_PAGE_SIZE + 1):
+            assert client.get(path, params={"limit": limit}).status_code == 422
+    assert client.get("/movies/search", params={"q": "title", "limit": 0}).status_code == 422
+    assert client.get("/movies", params={"skip": -1}).status_code == 422
+
+def test_invalid_cursor(client):
+    response = client.get("/movies", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+@requires_mongo
+def test_query_plans_use_indexes(client):
+    # The client fixture runs the app lifespan, which applies the indexes
+    from database import database
+    from indexes import find_collection_scans
+    assert find_collection_scans(database) == []
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Records the name of every command sent to Mongo"""
+
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@pytest.fixture
+def command_counter(client):
+    # Swaps the app's motor client for one that records every command, the async collections
+    # rebind to it on their next use. Created on the app's loop, like the client it replaces.
+    counter = CommandCounter()
+
+    async def connect():
+        return AsyncIOMotorClient(MONGO_DB_CONNECTION_URL, event_listeners=[counter])
+
+    app_client, mongo.async_client = mongo.async_client, client.portal.call(connect)
+    yield counter
+    mongo.async_client.close()
+    mongo.async_client = app_client
+
+def _new_user(client):
+    username = "testuser_" + ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
+    return client.portal.call(async_crud.async_user_crud_service.user_create, UserCreate(username=username, full_name="Test User", password="password"), "hash")
+
+@requires_mongo
+def test_write_round_trips(client, command_counter):
+    command_counter.commands.clear()
+    user = _new_user(client)
+    assert command_counter.commands == ["insert"]
+
+    command_counter.commands.clear()
+    movie = client.portal.call(async_crud.async_movie_crud_service.movie_create, MovieCreate(title="Test Movie", description="description", user_id=user["id"]), user)
+    assert command_counter.commands == ["insert"]
+
+    command_counter.commands.clear()
+    client.portal.call(async_crud.async_comment_crud_service.create_comment, CommentCreate(comment="comment", movie_id=movie["id"]), user, movie["id"])
+    assert command_counter.commands == ["insert", "update"]
+
+    command_counter.commands.clear()
+    client.portal.call(async_crud.async_rating_crud_service.create_rating, RatingCreate(rating=4.0, movie_id=movie["id"]), user, movie["id"])
+    assert command_counter.commands == ["insert", "update"]
+
+def test_principal_cache():
+    cache = PrincipalCache(maxsize=2, ttl=60)
+    cache.set(("alice", 1), {"username": "alice"})
+    cache.set(("alice", 2), {"username": "alice"})
+    assert cache.get(("alice", 1)) == {"username": "alice"}
+    assert cache.get(("bob", 1)) is None
+    assert cache.stats() == {"size": 2, "hits": 1, "misses": 1}
+
+    # Least recently used entry is evicted past maxsize
+    cache.set(("bob", 1), {"username": "bob"})
+    assert cache.get(("alice", 2)) is None
+
+    cache.invalidate_user("alice")
+    assert cache.get(("alice", 1)) is None
+    assert cache.get(("bob", 1)) == {"username": "bob"}
+
+    cache.set(("bob", 2), {"username": "bob"}, ttl=0)
+    assert cache.get(("bob", 2)) is None
+
+def test_auth_routes_shed_load(client, monkeypatch):
+    import passwords
+    monkeypatch.setattr(passwords, "PASSWORD_HASH_MAX_PENDING", 0)
+    response = client.post("/signup", json={"username": "busy_user", "full_name": "Busy User", "password": "password"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+def test_update_movie_if_match(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    movie_data = {"user_id": test_user["username"], "title": "Updated Test Movie", "description": "description"}
+    etag = client.get(f"/movies/{movie_id}").headers["ETag"]
+
+    response = client.put(f"/movies/{movie_id}", json=movie_data, headers={**headers, "If-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    # An update that changes nothing keeps the version, the new ETag stays current
+    current_etag = response.headers["ETag"]
+    updated_at = client.get(f"/movies/{movie_id}").json()["data"]["updated_at"]
+    for unchanged in (movie_data, {"user_id": test_user["username"]}):
+        response = client.put(f"/movies/{movie_id}", json=unchanged, headers={**headers, "If-Match": current_etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] == current_etag
+    assert client.get(f"/movies/{movie_id}").json()["data"]["updated_at"] == updated_at
+
+    # If-Match compares strongly, the weak form of the current tag does not match
+    response = client.put(f"/movies/{movie_id}", json=movie_data, headers={**headers, "If-Match": f"W/{current_etag}"})
+    assert response.status_code == 412
+
+    # The stale version is refused for both update and delete
+    response = client.put(f"/movies/{movie_id}", json=movie_data, headers={**headers, "If-Match": etag})
+    assert response.status_code == 412
+    response = client.delete(f"/movies/{movie_id}", headers={**headers, "If-Match": etag})
+    assert response.status_code == 412
+
+    response = client.delete(f"/movies/{movie_id}", headers=headers)
+    assert response.status_code == 200
+    response = client.delete(f"/movies/{movie_id}", headers=headers)
+    assert response.status_code == 404
+
+def test_stream_comments(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    for i in range(3):
+        client.post(f"/movies/{movie_id}/comments", json={"comment": f"comment {i}", "movie_id": movie_id}, headers=headers)
+    response = client.get(f"/movies/{movie_id}/comments", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    comments = [json.loads(line) for line in response.text.splitlines()]
+    assert [c["comment"] for c in comments] == ["comment 0", "comment 1", "comment 2"]
+
+def test_bulk_ratings(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    ratings = [{"rating": 5.0, "movie_id": movie_id}, {"rating": "bad"}, {"rating": 3.0, "movie_id": movie_id}]
+    response = client.post(f"/movies/{movie_id}/ratings/bulk", json=ratings, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["created"], data["failed"]) == (2, 1)
+    assert [result["status"] for result in data["data"]] == ["created", "invalid", "created"]
+
+    summary = client.get(f"/movies/{movie_id}/ratings").json()["data"]
+    assert summary["rating_count"] == 2
+    assert summary["average_rating"] == 4.0
+
+def test_rating_write_behind(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    # Started on the app's event loop, as the lifespan does when RATING_WRITE_BEHIND is set
+    client.portal.call(rating_write_behind.start, get_repository().ratings)
+    try:
+        for rating in (3.0, 4.0, 5.0):
+            response = client.post(f"/movies/{movie_id}/ratings", json={"rating": rating, "movie_id": movie_id}, headers=headers)
+            assert response.status_code == 202
+    finally:
+        # Stopping writes what is still queued
+        client.portal.call(rating_write_behind.stop)
+    summary = client.get(f"/movies/{movie_id}/ratings").json()["data"]
+    assert summary["rating_count"] == 3
+    assert summary["average_rating"] == 4.0
+
+def test_rating_write_behind_backpressure():
+    write_behind = RatingWriteBehind(queue_size=1)
+    user = {"id": "user"}
+    movie_id = str(ObjectId())
+    write_behind.submit(RatingCreate(rating=4.0, movie_id=movie_id), user, movie_id)
+    with pytest.raises(HTTPException) as error:
+        write_behind.submit(RatingCreate(rating=4.0, movie_id=movie_id), user, movie_id)
+    assert error.value.status_code == 503
+
+def test_rating_write_behind_retries():
+    class FlakyRatings:
+        def __init__(self):
+            self.attempts = []
+
+        async def write_ratings_batch(self, rating_documents, batch_id):
+            self.attempts.append(batch_id)
+            if len(self.attempts) == 1:
+                raise ConnectionError("primary stepped down")
+            return len(rating_documents)
+
+    async def scenario():
+        write_behind = RatingWriteBehind(interval_ms=1, retry_ms=1)
+        ratings = FlakyRatings()
+        write_behind.start(ratings)
+        movie_id = str(ObjectId())
+        write_behind.submit(RatingCreate(rating=4.0, movie_id=movie_id), {"id": "user"}, movie_id)
+        await write_behind.stop()
+        return ratings.attempts
+
+    # The accepted rating is written on the second attempt, with the batch id of the first
+    attempts = asyncio.run(scenario())
+    assert len(attempts) == 2 and attempts[0] == attempts[1]
+
+def test_rating_write_behind_gives_up_within_settle_window():
+    class DownRatings:
+        attempts = 0
+
+        async def write_ratings_batch(self, rating_documents, batch_id):
+            self.attempts += 1
+            raise ConnectionError("no primary")
+
+    async def scenario():
+        # No retry window left, so the batch fails after its first attempt instead of landing after the jobs moved on
+        write_behind = RatingWriteBehind(interval_ms=1, retry_ms=1, retry_seconds=0)
+        ratings = DownRatings()
+        write_behind.start(ratings)
+        movie_id = str(ObjectId())
+        write_behind.submit(RatingCreate(rating=4.0, movie_id=movie_id), {"id": "user"}, movie_id)
+        await write_behind.stop()
+        return ratings.attempts
+
+    assert asyncio.run(scenario()) == 1
+
+@requires_mongo
+def test_write_ratings_batch_is_idempotent(client, test_user):
+    movie_id, _ = test_create_movie(client, test_user)
+    documents = [crud.new_rating_document(RatingCreate(rating=rating, movie_id=movie_id), {"id": "user"}, movie_id) for rating in (2.0, 4.0)]
+    batch_id = ObjectId()
+    # A retry after a failure between the insert and the aggregate update counts nothing twice
+    for _ in range(2):
+        assert client.portal.call(get_repository().ratings.write_ratings_batch, documents, batch_id) == 2
+    # Nor does one coming after many other batches on the same movie
+    for _ in range(40):
+        other = [crud.new_rating_document(RatingCreate(rating=3.0, movie_id=movie_id), {"id": "user"}, movie_id)]
+        client.portal.call(get_repository().ratings.write_ratings_batch, other, ObjectId())
+    client.portal.call(get_repository().ratings.write_ratings_batch, documents, batch_id)
+    assert crud.movies_collection.find_one({"_id": ObjectId(movie_id)})["rating_batches"] == []
+
+    # Nor a failure after the aggregate update but before the batch is recorded in rating_batches
+    async def fail(*args, **kwargs):
+        raise ConnectionError("primary stepped down")
+    crashed = [crud.new_rating_document(RatingCreate(rating=5.0, movie_id=movie_id), {"id": "user"}, movie_id)]
+    crashed_id = ObjectId()
+    async_crud.async_rating_batches_collection.bulk_write = fail
+    try:
+        with pytest.raises(ConnectionError):
+            client.portal.call(get_repository().ratings.write_ratings_batch, crashed, crashed_id)
+    finally:
+        del async_crud.async_rating_batches_collection.bulk_write
+    client.portal.call(get_repository().ratings.write_ratings_batch, crashed, crashed_id)
+    summary = client.get(f"/movies/{movie_id}/ratings").json()["data"]
+    assert summary["rating_count"] == 43
+
+@requires_mongo
+def test_rebuild_rating_aggregates(client, test_user):
+    rated_id, headers = test_create_movie(client, test_user)
+    unrated_id, _ = test_create_movie(client, test_user)
+    for rating in (2.0, 4.5):
+        client.post(f"/movies/{rated_id}/ratings", json={"rating": rating, "movie_id": rated_id}, headers=headers)
+    crud.movies_collection.update_many(
+        {"_id": {"$in": [ObjectId(rated_id), ObjectId(unrated_id)]}}, {"$set": {"rating_count": 9, "rating_sum": 9.0}},
+    )
+    # One movie per batch, so both kinds of movie land in batches of their own
+    crud.rating_crud_service.rebuild_rating_aggregates(batch_size=1)
+    rated = crud.movies_collection.find_one({"_id": ObjectId(rated_id)})
+    assert (rated["rating_count"], rated["rating_sum"], rated["rating_histogram"]) == (2, 6.5, {"2": 1, "5": 1})
+    assert crud.movies_collection.find_one({"_id": ObjectId(unrated_id)})["rating_count"] == 0
+
+def test_read_through_cache_single_flight():
+    movie_cache = ReadThroughCache(LocalCacheBackend(maxsize=10, ttl=60))
+    loads = []
+
+    async def load():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return {"title": "Test Movie"}
+
+    async def scenario():
+        # Concurrent misses share one load
+        values = await asyncio.gather(*(movie_cache.get_or_load("movie:1", load, group="pages") for _ in range(10)))
+        assert values == [{"title": "Test Movie"}] * 10
+        assert len(loads) == 1
+        await movie_cache.invalidate(groups=["pages"])
+        await movie_cache.get_or_load("movie:1", load)
+        assert len(loads) == 2
+
+    asyncio.run(scenario())
+    assert movie_cache.stats()["hits"] == 9
+
+def test_cache_metrics():
+    movie_cache = ReadThroughCache(LocalCacheBackend(maxsize=10, ttl=60), name="test")
+
+    async def load():
+        return {"title": "Test Movie"}
+
+    async def scenario():
+        await movie_cache.get_or_load("movie:1", load)
+        await movie_cache.get_or_load("movie:1", load)
+        await movie_cache.invalidate("movie:1")
+
+    asyncio.run(scenario())
+    rendered = metrics.render()
+    for line in ('cache_hits_total{cache="test"} 1', 'cache_misses_total{cache="test"} 1', 'cache_invalidations_total{cache="test"} 1'):
+        assert line in rendered
+
+def test_redis_cache_backend(monkeypatch):
+    # The shared backend, against an in-process Redis
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr("redis.asyncio.from_url", lambda url: fakeredis.FakeAsyncRedis())
+    movie_cache = ReadThroughCache(RedisCacheBackend("redis://localhost:6379/0", ttl=60))
+    loads = []
+
+    async def load():
+        loads.append(1)
+        return {"title": "Test Movie", "version": 1}
+
+    async def scenario():
+        for _ in range(2):
+            assert await movie_cache.get_or_load("movie:1", load) == {"title": "Test Movie", "version": 1}
+        assert len(loads) == 1
+        await movie_cache.get_or_load("movies:first_page:5:", load, group="pages")
+        await movie_cache.invalidate(groups=["pages"])
+        await movie_cache.get_or_load("movies:first_page:5:", load, group="pages")
+        assert len(loads) == 3
+        # Dropping the group left the movie alone
+        await movie_cache.get_or_load("movie:1", load)
+        assert len(loads) == 3
+        await movie_cache.invalidate("movie:1")
+        await movie_cache.get_or_load("movie:1", load)
+        assert len(loads) == 4
+
+    asyncio.run(scenario())
+    assert movie_cache.stats()["hits"] == 2
+
+@requires_mongo
+def test_cached_movie_matches_validator(client, test_user):
+    movie_id, _ = test_create_movie(client, test_user)
+    etag = client.get(f"/movies/{movie_id}").headers["ETag"]
+    # A write handled by another worker leaves the movie cached by this one
+    database["movies"].update_one({"_id": ObjectId(movie_id)}, crud.touch_movie({"$set": {"title": "Updated Elsewhere"}}))
+    response = client.get(f"/movies/{movie_id}")
+    assert response.json()["data"]["title"] == "Updated Elsewhere"
+    assert response.headers["ETag"] != etag
+
+def test_cached_page_matches_validators():
+    # A first page cached before a write on another worker no longer matches the versions read for the ETag
+    page = {"data": [{"id": "a", "version": 1}], "next_cursor": None}
+    assert async_crud.page_matches(page, [{"_id": "a", "version": 1}], 1)
+    assert not async_crud.page_matches(page, [{"_id": "a", "version": 2}], 1)
+    assert not async_crud.page_matches(page, [{"_id": "a", "version": 1}, {"_id": "b", "version": 1}], 1)
+
+def test_conditional_get(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    response = client.get(f"/movies/{movie_id}/comments")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert "Last-Modified" in response.headers
+    assert client.get(f"/movies/{movie_id}/comments", headers={"If-None-Match": etag}).status_code == 304
+
+    # A new comment bumps the movie version, so the old ETag no longer matches
+    client.post(f"/movies/{movie_id}/comments", json={"comment": "comment", "movie_id": movie_id}, headers=headers)
+    assert client.get(f"/movies/{movie_id}/comments", headers={"If-None-Match": etag}).status_code == 200
+
+    response = client.get(f"/movies/{movie_id}")
+    assert client.get(f"/movies/{movie_id}", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+    # The JSON and NDJSON bodies of one URL are different representations
+    etag = client.get(f"/movies/{movie_id}/comments").headers["ETag"]
+    response = client.get(f"/movies/{movie_id}/comments", headers={"If-None-Match": etag, "Accept": "application/x-ndjson"})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+
+def test_invalid_movie_id_reads(client):
+    # Reads keyed by a malformed movie id answer as for a missing movie, not with a 500
+    for path in ("/movies/bad/comments", "/movies/bad/ratings/list"):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert response.json()["data"] == []
+    assert client.get("/movies/bad/ratings").json() == {"message": "movie not found"}
+
+def test_movie_pages_have_no_last_modified(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    response = client.get("/movies", params={"limit": 1})
+    assert "ETag" in response.headers and "Last-Modified" not in response.headers
+    assert "Last-Modified" not in client.get("/movies", params={"ids": movie_id}).headers
+
+@requires_mongo
+def test_list_enrichment_round_trips(client, command_counter):
+    user = _new_user(client)
+    movie_ids = []
+    for i in range(10):
+        movie = client.portal.call(async_crud.async_movie_crud_service.movie_create, MovieCreate(title=f"Movie {i}", description="description", user_id=user["id"]), user)
+        client.portal.call(async_crud.async_rating_crud_service.create_rating, RatingCreate(rating=4.0, movie_id=movie["id"]), user, movie["id"])
+        movie_ids.append(movie["id"])
+
+    # One command per page, whatever its size
+    for size in (1, 10):
+        command_counter.commands.clear()
+        movies = client.portal.call(async_crud.async_movie_crud_service.get_movies_by_ids, [ObjectId(movie_id) for movie_id in movie_ids[:size]], ("rating_summary",))
+        assert command_counter.commands == ["find"]
+        assert [movie["id"] for movie in movies] == movie_ids[:size]
+        assert all(movie["rating_summary"]["average_rating"] == 4.0 for movie in movies)
+
+        command_counter.commands.clear()
+        movies, _ = client.portal.call(async_crud.async_movie_crud_service.get_movies_page, size, None, ("rating_summary", "comment_count"))
+        assert command_counter.commands == ["find"]
+        assert all("rating_summary" in movie and "comment_count" in movie for movie in movies)
+
+def test_get_movies_by_ids(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    other_id, _ = test_create_movie(client, test_user)
+    client.post(f"/movies/{movie_id}/ratings", json={"rating": 5.0, "movie_id": movie_id}, headers=headers)
+
+    response = client.get("/movies", params={"ids": f"{other_id},{ObjectId()},{movie_id}", "with": "rating_summary"})
+    assert response.status_code == 200
+    movies = response.json()["data"]
+    assert [movie["id"] for movie in movies] == [other_id, movie_id]
+    assert movies[1]["rating_summary"]["average_rating"] == 5.0
+    assert "rating_summary" not in client.get("/movies", params={"ids": movie_id}).json()["data"][0]
+    assert client.get("/movies", params={"ids": "not-an-id"}).status_code == 400
+    assert client.get("/movies", params={"with": "reviews"}).status_code == 400
+
+def test_movie_counts_children(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    client.post(f"/movies/{movie_id}/comments", json={"comment": "comment", "movie_id": movie_id}, headers=headers)
+    client.post(f"/movies/{movie_id}/ratings", json={"rating": 4.0, "movie_id": movie_id}, headers=headers)
+    movie = client.get(f"/movies/{movie_id}").json()["data"]
+    assert (movie["comment_count"], movie["rating_count"]) == (1, 1)
+    assert "comments" not in movie and "ratings" not in movie
+
+@requires_mongo
+def test_strip_child_id_arrays(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    client.post(f"/movies/{movie_id}/comments", json={"comment": "comment", "movie_id": movie_id}, headers=headers)
+    # A movie written before the counters, still carrying the id arrays
+    crud.movies_collection.update_one({"_id": ObjectId(movie_id)}, {"$set": {"comments": ["a"], "ratings": ["b"]}, "$unset": {"comment_count": ""}})
+    assert crud.movie_crud_service.strip_child_id_arrays(batch_size=2) >= 1
+    movie = crud.movies_collection.find_one({"_id": ObjectId(movie_id)})
+    assert "comments" not in movie and "ratings" not in movie
+    assert movie["comment_count"] == 1
+
+@requires_mongo
+def test_backfill_title_keys(client, test_user):
+    movie_ids = [test_create_movie(client, test_user)[0] for _ in range(3)]
+    # Movies created before title_key existed
+    crud.movies_collection.update_many({"_id": {"$in": [ObjectId(movie_id) for movie_id in movie_ids]}}, {"$unset": {"title_key": ""}})
+    assert crud.movie_crud_service.backfill_title_keys(batch_size=1) >= 3
+    assert crud.movies_collection.count_documents({"_id": {"$in": [ObjectId(movie_id) for movie_id in movie_ids]}, "title_key": {"$exists": False}}) == 0
+
+@requires_mongo
+def test_leaderboards(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    client.post(f"/movies/{movie_id}/ratings", json={"rating": 5.0, "movie_id": movie_id}, headers=headers)
+    client.post(f"/movies/{movie_id}/comments", json={"comment": "comment", "movie_id": movie_id}, headers=headers)
+    # Pretend the writes have settled
+    leaderboards.refresh_leaderboards(database, datetime.now(timezone.utc) + timedelta(seconds=leaderboards.LEADERBOARD_SETTLE_SECONDS))
+
+    # The shared test database can hold more movies than a page, so the entry is read directly
+    entry = leaderboard_serializer(database["leaderboard"].find_one({"_id": movie_id}))
+    assert entry["rating_count"] == 1
+    assert entry["average_rating"] == 5.0
+    assert entry["comments_7d"] == 1
+    top = client.get("/movies/top", params={"limit": MAX_PAGE_SIZE}).json()["data"]
+    assert [entry["score"] for entry in top] == sorted((entry["score"] for entry in top), reverse=True)
+    assert client.get("/movies/trending", params={"window": 7, "limit": MAX_PAGE_SIZE}).status_code == 200
+    assert client.get("/movies/top", params={"limit": MAX_PAGE_SIZE + 1}).status_code == 422
+    assert client.get("/movies/trending?window=3").status_code == 400
+
+@requires_mongo
+def test_leaderboards_resume_after_crash(client, test_user, monkeypatch):
+    movie_id, headers = test_create_movie(client, test_user)
+    client.post(f"/movies/{movie_id}/ratings", json={"rating": 4.0, "movie_id": movie_id}, headers=headers)
+    client.post(f"/movies/{movie_id}/comments", json={"comment": "comment", "movie_id": movie_id}, headers=headers)
+    now = datetime.now(timezone.utc) + timedelta(seconds=leaderboards.LEADERBOARD_SETTLE_SECONDS + 1)
+
+    # Crash once the ratings and comments are merged, before the state records the new range
+    def crash(now):
+        raise RuntimeError("killed")
+    with monkeypatch.context() as patch:
+        patch.setattr(leaderboards, "window_starts", crash)
+        with pytest.raises(RuntimeError):
+            leaderboards.refresh_leaderboards(database, now)
+    leaderboards.refresh_leaderboards(database, now)
+
+    entry = database["leaderboard"].find_one({"_id": movie_id})
+    assert entry["rating_count"] == 1 and entry["comments_7d"] == 1
+    assert "pending_until" not in database["leaderboard_state"].find_one({"_id": "leaderboard"})
+
+def test_movie_detail(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    for i in range(3):
+        client.post(f"/movies/{movie_id}/comments", json={"comment": f"comment {i}", "movie_id": movie_id}, headers=headers)
+    for rating in (4.0, 5.0):
+        client.post(f"/movies/{movie_id}/ratings", json={"rating": rating, "movie_id": movie_id}, headers=headers)
+
+    response = client.get(f"/movies/{movie_id}/detail", params={"comments_limit": 2})
+    assert response.status_code == 200
+    detail = response.json()["data"]
+    assert detail["rating_summary"]["average_rating"] == 4.5
+    assert detail["rating_summary"]["distribution"] == {"4": 1, "5": 1}
+    assert [c["comment"] for c in detail["comments"]] == ["comment 0", "comment 1"]
+    next_page = client.get(f"/movies/{movie_id}/comments", params={"cursor": detail["comments_next_cursor"]}).json()
+    assert [c["comment"] for c in next_page["data"]] == ["comment 2"]
+
+    detail = client.get(f"/movies/{movie_id}/detail", params={"fields": "title", "include": "rating_summary"}).json()["data"]
+    assert set(detail) == {"id", "title", "version", "updated_at", "rating_summary"}
+    assert client.get(f"/movies/{movie_id}/detail", params={"include": "reviews"}).status_code == 400
+    for comments_limit in (0, 101):
+        assert client.get(f"/movies/{movie_id}/detail", params={"comments_limit": comments_limit}).status_code == 422
+    assert client.get(f"/movies/{ObjectId()}/detail").status_code == 404
+
+@pytest.fixture
+def memory_client(client):
+    # The routes and get_current_user go through a fresh in-memory repository
+    repository = MemoryRepository()
+    app.dependency_overrides[get_repository] = lambda: repository
+    yield client, repository
+    app.dependency_overrides.pop(get_repository)
+
+def test_memory_repository(memory_client):
+    client, repository = memory_client
+    user = {"username": "memory_" + ''.join(random.choices(string.ascii_lowercase, k=6)), "full_name": "Memory User", "password": "password"}
+    assert client.post("/signup", json=user).status_code == 200
+    token = client.post("/login", data={"username": user["username"], "password": user["password"]}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    movie_id = client.post("/movies", json={"title": "Memory Lane", "description": "description", "user_id": user["username"]}, headers=headers).json()["data"]["id"]
+    client.post(f"/movies/{movie_id}/comments", json={"comment": "comment", "movie_id": movie_id}, headers=headers)
+    client.post(f"/movies/{movie_id}/ratings", json={"rating": 4.0, "movie_id": movie_id}, headers=headers)
+
+    assert list(repository.store.movies) == [ObjectId(movie_id)]
+    detail = client.get(f"/movies/{movie_id}/detail").json()["data"]
+    assert detail["rating_summary"]["average_rating"] == 4.0
+    assert [comment["comment"] for comment in detail["comments"]] == ["comment"]
+    assert [movie["id"] for movie in client.get("/movies/search", params={"q": "memo", "mode": "prefix"}).json()["data"]] == [movie_id]
+    assert client.get("/movies/top").json()["data"][0]["movie_id"] == movie_id
+    other_id = client.post("/movies", json={"title": "Memory Road", "description": "description", "user_id": user["username"]}, headers=headers).json()["data"]["id"]
+    client.post(f"/movies/{other_id}/ratings", json={"rating": 2.0, "movie_id": other_id}, headers=headers)
+    assert [(movie["title"], movie["score"]) for movie in client.get(f"/movies/{movie_id}/similar").json()["data"]] == [("Memory Road", 1.0)]
+
+def test_repositories_implement_services():
+    services = {"movies": MovieService, "users": UserService, "comments": CommentService, "ratings": RatingService, "leaderboards": LeaderboardService}
+    for repository in (MongoRepository(), MemoryRepository()):
+        for name, service in services.items():
+            for method_name, method in vars(service).items():
+                if method_name.startswith("_") or not inspect.isfunction(method):
+                    continue
+                expected = [(parameter.name, parameter.default) for parameter in inspect.signature(method).parameters.values()][1:]
+                implemented = inspect.signature(getattr(getattr(repository, name), method_name)).parameters.values()
+                assert [(parameter.name, parameter.default) for parameter in implemented] == expected, f"{type(repository).__name__}.{name}.{method_name}"
+
+def test_memory_user_update_and_delete():
+    users = MemoryRepository().users
+    user = asyncio.run(users.user_create(UserCreate(username="before", full_name="Memory User", password="password"), "hash"))
+    principal_cache.set(("before", 0), user)
+    updated = asyncio.run(users.update_user("before", UserUpdate(username="after", full_name="Renamed", password="password")))
+    assert (updated["username"], updated["full_name"]) == ("after", "Renamed")
+    assert asyncio.run(users.get_user_by_username("before")) is None
+    # The cached principal of the old name is dropped with the update
+    assert principal_cache.get(("before", 0)) is None
+    principal_cache.set(("after", 0), updated)
+    assert asyncio.run(users.delete_user("after"))
+    assert principal_cache.get(("after", 0)) is None
+    assert asyncio.run(users.update_user("after", UserUpdate(username="after", full_name="Gone", password="password"))) is None
+
+def test_memory_similar_movies_cached(monkeypatch):
+    import memory_repository
+    computed = []
+    compute = memory_repository.compute_similar_movies
+    monkeypatch.setattr(memory_repository, "compute_similar_movies", lambda *args: computed.append(1) or compute(*args))
+    repository, user = MemoryRepository(), {"id": "user"}
+
+    async def scenario():
+        movie_ids = [(await repository.movies.movie_create(MovieCreate(title=title, description="description", user_id="user"), user))["id"] for title in ("One", "Two")]
+        for movie_id in movie_ids:
+            await repository.ratings.create_rating(RatingCreate(rating=4.0, movie_id=movie_id), user, movie_id)
+        first = await repository.movies.get_similar_movies(movie_ids[0])
+        assert [movie["title"] for movie in first] == ["Two"]
+        assert await repository.movies.get_similar_movies(movie_ids[0], limit=1) == first[:1]
+        assert len(computed) == 1
+        # A rating makes the next read compute the neighbors again
+        await repository.ratings.create_rating(RatingCreate(rating=2.0, movie_id=movie_ids[1]), {"id": "other"}, movie_ids[1])
+        await repository.movies.get_similar_movies(movie_ids[0])
+        assert len(computed) == 2
+
+    asyncio.run(scenario())
+
+def test_compute_similar_movies():
+    ratings = [
+        {"user_id": "a", "movie_id": "m1", "rating": 5}, {"user_id": "a", "movie_id": "m2", "rating": 1},
+        {"user_id": "b", "movie_id": "m1", "rating": 4}, {"user_id": "b", "movie_id": "m2", "rating": 4},
+        {"user_id": "b", "movie_id": "m3", "rating": 1}, {"user_id": "c", "movie_id": "m3", "rating": 5},
+        # Only the last rating of a user counts
+        {"user_id": "a", "movie_id": "m2", "rating": 5},
+    ]
+    neighbors = recommendations.compute_similar_movies(ratings, k=5)
+    assert [movie_id for movie_id, _ in neighbors["m1"]] == ["m2", "m3"]
+    assert neighbors["m1"][0][1] == pytest.approx(41 / (41 ** 0.5 * 41 ** 0.5))
+    # A movie missing from titles is neither given neighbors nor recommended
+    neighbors = recommendations.compute_similar_movies(ratings, {"m1": "One", "m3": "Three"}, k=5)
+    assert set(neighbors) == {"m1", "m3"} and [movie_id for movie_id, _ in neighbors["m1"]] == ["m3"]
+
+@requires_mongo
+def test_similar_movies(client, test_user):
+    movie_id, headers = test_create_movie(client, test_user)
+    other_id, _ = test_create_movie(client, test_user)
+    for rated_id in (movie_id, other_id):
+        client.post(f"/movies/{rated_id}/ratings", json={"rating": 4.0, "movie_id": rated_id}, headers=headers)
+    # Pretend the ratings have settled, ObjectId times are whole seconds
+    recommendations.refresh_similar_movies(database, now=datetime.now(timezone.utc) + timedelta(seconds=recommendations.SIMILAR_MOVIES_SETTLE_SECONDS + 1))
+
+    similar = client.get(f"/movies/{movie_id}/similar", params={"limit": recommendations.SIMILAR_MOVIES_K}).json()["data"]
+    assert similar and movie_id not in [movie["movie_id"] for movie in similar]
+    assert all(movie["score"] > 0 and "title" in movie for movie in similar)
+    assert client.get(f"/movies/{movie_id}/similar", params={"limit": 0}).status_code == 422
+    assert client.get(f"/movies/{ObjectId()}/similar").status_code == 404
+
+def test_normalize_title():
+    assert normalize_title("  Amélie   Poulain ") == "amelie poulain"
+    assert normalize_title("STRASSE") == normalize_title("Straße")
+
+def test_search_movies(client, test_user):
+    login_data = {"username": test_user["username"], "password": test_user["password"]}
+    headers = {"Authorization": f"Bearer {client.post('/login', data=login_data).json()['access_token']}"}
+    word = "zq" + ''.join(random.choices(string.ascii_lowercase, k=8))
+    for title in (f"{word} Returns", f"{word.upper()} Forever", "Another Movie"):
+        client.post("/movies", json={"title": title, "description": f"about {word}", "user_id": test_user["username"]}, headers=headers)
+
+    response = client.get(f"/movies/search?q={word[:6].upper()}&mode=prefix&limit=1")
+    assert response.status_code == 200
+    first = response.json()
+    assert len(first["data"]) == 1
+    second = client.get(f"/movies/search?q={word[:6]}&mode=prefix&limit=1&cursor={first['next_cursor']}").json()
+    assert {first["data"][0]["title"], second["data"][0]["title"]} == {f"{word} Returns", f"{word.upper()} Forever"}
+    assert second["next_cursor"] is None
+
+    results = client.get(f"/movies/search?q={word}").json()["data"]
+    # A match in the title outranks a match in the description only
+    assert len(results) == 3
+    assert results[-1]["title"] == "Another Movie"
+    assert client.get("/movies/search?q=x&mode=fuzzy").status_code == 400
+
+
+@requires_mongo
+def test_metrics(client):
+    movie_id = str(ObjectId())
+    client.get(f"/movies/{movie_id}")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    # Routes are labelled by their template, not the requested path
+    assert 'http_requests_total{method="GET",route="/movies/{movie_id}",status="200"}' in response.text
+    assert movie_id not in response.text
+    assert 'mongo_command_duration_seconds_count{collection="movies",command="find"}' in response.text
+
+def test_health_probes(client):
+    assert client.get("/healthz").json() == {"status": "ok"}
+    # The fixture's client ran the lifespan, so the pool is open
+    response = client.get("/readyz")
+    assert response.status_code == 200
+
@@ -0,0 +1,140 @@
+import asyncio
+import time
+
+from bson.objectid import ObjectId
+from fastapi import HTTPException
+
+import metrics
+from crud import new_rating_document
+from logger import get_logger
+from schema import RatingCreate, UserBase
+from serializer import rating_serializer
+from settings import settings
+
+logger = get_logger(__name__)
+
+# Opt-in write-behind for POST /movies/{movie_id}/ratings: a rating is acknowledged once it is
+# queued, and a background task writes the queue to Mongo in batches. Ratings still queued when
+# the process dies without a graceful shutdown are lost.
+RATING_WRITE_BEHIND = settings.rating_write_behind
+# A batch is written once it holds this many ratings, or this long after it was started
+RATING_FLUSH_MAX_ITEMS = settings.rating_flush_max_items
+RATING_FLUSH_INTERVAL_MS = settings.rating_flush_interval_ms
+# Ratings allowed in the queue before the route answers 503
+RATING_QUEUE_SIZE = settings.rating_queue_size
+# A batch whose write fails is retried after this delay, doubled on each attempt.
+# The queue keeps filling meanwhile and the route answers 503 once it is full.
+RATING_FLUSH_RETRY_MS = settings.rating_flush_retry_ms
+# The leaderboard and similar movies jobs take ratings by the time of their _id, set when queued, up to
+# their settle delay ago. A batch is only retried for the first half of that delay after its oldest
+# rating was queued, leaving the rest to the last attempt, and then failed: written any later, its
+# ratings would be behind the range those jobs already took and never counted by them.
+RATING_FLUSH_RETRY_SECONDS = min(settings.leaderboard_settle_seconds, settings.similar_movies_settle_seconds) / 2
+
+
+class RatingWriteBehind:
+    """Bounded queue of rating documents, and the task writing it to Mongo"""
+
+    def __init__(self, max_items: int = RATING_FLUSH_MAX_ITEMS, interval_ms: float = RATING_FLUSH_INTERVAL_MS, queue_size: int = RATING_QUEUE_SIZE, retry_ms: float = RATING_FLUSH_RETRY_MS, retry_seconds: float = RATING_FLUSH_RETRY_SECONDS):
+        self.max_items = max_items
+        self.interval = interval_ms / 1000
+        self.queue_size = queue_size
+        self.retry = retry_ms / 1000
+        self.retry_seconds = retry_seconds
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._ratings = None
+        self._task = None
+        self._stopping = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._stopping
+
+    def start(self, ratings):
+        """Starts writing the queue through `ratings`, the ratings service of the app's repository"""
+        self._ratings = ratings
+        # A fresh queue, as an asyncio queue only works with the loop it was first used in
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Writes every queued rating, then ends the flush task"""
+        if self._task is None:
+            return
+        self._stopping = True
+        await self._task
+        self._task = None
+
+    def submit(self, rating_data: RatingCreate, user: UserBase, movie_id: str) -> dict:
+        if not ObjectId.is_valid(movie_id):
+            raise HTTPException(status_code=400, detail="Invalid movie id")
+        rating_document = new_rating_document(rating_data, user, movie_id)
+        try:
+            self._queue.put_nowait(rating_document)
+        except asyncio.QueueFull:
+            metrics.rating_write_behind_ratings.inc(outcome="rejected")
+            logger.warning('Rating queue full, rejecting rating')
+            raise HTTPException(status_code=503, detail="Server busy, try again later", headers={"Retry-After": "1"})
+        metrics.rating_queue_depth.set(self._queue.qsize())
+        return rating_serializer(rating_document)
+
+    async def _next_batch(self) -> list:
+        """Ratings queued within one interval, up to max_items, without waiting once stopping"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.interval
+        batch = []
+        while len(batch) < self.max_items:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0 or self._stopping:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while not (self._stopping and self._queue.empty()):
+            batch = await self._next_batch()
+            metrics.rating_queue_depth.set(self._queue.qsize())
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        """Writes a batch, retrying with backoff until it goes through or its retry window ends
+
+        The ratings were acknowledged already, so a failed batch is retried rather than dropped.
+        Retries reuse the batch id, which lets write_ratings_batch skip what an earlier attempt wrote.
+        """
+        batch_id = ObjectId()
+        delay = self.retry
+        # ObjectId times are whole seconds rounded down, so the window never ends late
+        deadline = min(document["_id"].generation_time.timestamp() for document in batch) + self.retry_seconds
+        while True:
+            start = time.perf_counter()
+            try:
+                written = await self._ratings.write_ratings_batch(batch, batch_id)
+                break
+            except Exception:
+                logger.exception('Writing %d queued ratings failed', len(batch))
+            finally:
+                metrics.rating_flush_duration.observe(time.perf_counter() - start)
+            if time.time() + delay > deadline:
+                logger.error('Giving up on %d queued ratings, retried for %.1fs', len(batch), self.retry_seconds)
+                metrics.rating_write_behind_ratings.inc(len(batch), outcome="failed")
+                return
+            metrics.rating_write_behind_ratings.inc(len(batch), outcome="retried")
+            await asyncio.sleep(delay)
+            delay *= 2
+        metrics.rating_write_behind_ratings.inc(written, outcome="written")
+        if written < len(batch):
+            # Rejected by Mongo itself, such as by a validation rule, another attempt would fail the same way
+            logger.warning('%d of %d queued ratings were rejected', len(batch) - written, len(batch))
+            metrics.rating_write_behind_ratings.inc(len(batch) - written, outcome="failed")
+
+
+rating_write_behind = RatingWriteBehind()